@@ -0,0 +1,339 @@
+"""
+Детерминированный генератор синтетических данных в формате Olist:
+все девять таблиц data_store.TABLE_FILES с правдоподобными кардинальностями.
+
+Масштаб 1x — размер исходного датасета (99 441 заказ, ~96 тыс. клиентов,
+~1 млн строк geolocation); 0.1x — ~10 тыс. заказов, 10x — ~1 млн.
+
+Запуск из каталога app:
+    python -m benchmarks.olist_generator /tmp/olist_1x --scale 1 --seed 0
+
+Пропорции взяты из исходного датасета:
+  - у каждого заказа свой customer_id; ~3% клиентов (customer_unique_id)
+    покупают повторно, отдельные — до полутора десятков раз;
+  - позиций на заказ в среднем ~1.14 (у отменённых и недоступных часто ни одной),
+    платежей ~1.04 (доплата ваучером), отзывов ~1 (иногда 0 или 2);
+  - почтовых префиксов до ~19 тыс., ~50 строк geolocation на префикс, у части
+    префиксов несколько написаний города (размножение строк при объединении);
+  - заказов со временем становится больше, штаты распределены как у клиентов Olist.
+"""
+import argparse
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+import pandas as pd
+
+from segmentation_tasks.data_store import TABLE_FILES
+
+# Заказов в исходном датасете (olist_orders_dataset) — масштаб 1x
+BASE_ORDERS = 99441
+# Сколько почтовых префиксов в geolocation при полном охвате и строк на префикс
+MAX_ZIP_PREFIXES = 19015
+GEO_ROWS_PER_PREFIX = 52
+# Справочники, которые есть в репозитории (категории берутся из перевода)
+RESEARCH_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "research", "clean_data")
+
+STATES = {
+    "SP": 0.420, "RJ": 0.129, "MG": 0.117, "RS": 0.055, "PR": 0.051, "SC": 0.037, "BA": 0.034,
+    "DF": 0.021, "ES": 0.020, "GO": 0.020, "PE": 0.017, "CE": 0.013, "PA": 0.010, "MT": 0.009,
+    "MA": 0.008, "MS": 0.007, "PB": 0.005, "PI": 0.005, "RN": 0.005, "AL": 0.004, "SE": 0.003,
+    "TO": 0.003, "RO": 0.003, "AM": 0.002, "AC": 0.001, "AP": 0.001, "RR": 0.001,
+}
+ORDER_STATUSES = {
+    "delivered": 0.970, "shipped": 0.011, "canceled": 0.006, "unavailable": 0.006,
+    "invoiced": 0.003, "processing": 0.003, "created": 0.0005, "approved": 0.0005,
+}
+PAYMENT_TYPES = {"credit_card": 0.74, "boleto": 0.19, "voucher": 0.055, "debit_card": 0.015}
+REVIEW_SCORES = {5: 0.577, 4: 0.193, 3: 0.082, 2: 0.032, 1: 0.116}
+FIRST_ORDER = pd.Timestamp("2016-09-04")
+LAST_ORDER = pd.Timestamp("2018-09-03")
+
+
+def hex_ids(rng, n):
+    """n случайных 32-символьных hex id, как в Olist."""
+    raw = rng.bytes(16 * n).hex()
+    return np.array([raw[i:i + 32] for i in range(0, 32 * n, 32)], dtype=object)
+
+
+def choice(rng, weights, n):
+    values = list(weights)
+    p = np.array([weights[v] for v in values], dtype=float)
+    return np.array(values, dtype=object)[rng.choice(len(values), n, p=p / p.sum())]
+
+
+def counts(rng, probabilities, n):
+    """n случайных количеств по {количество: вероятность}."""
+    return choice(rng, probabilities, n).astype(int)
+
+
+def _timestamps(rng, n):
+    # Плотность заказов растёт линейно: позже — больше заказов
+    span = (LAST_ORDER - FIRST_ORDER).total_seconds()
+    offsets = np.sqrt(rng.random(n)) * span
+    return FIRST_ORDER + pd.to_timedelta(np.sort(offsets).astype("int64"), unit="s")
+
+
+def _fmt(values):
+    return pd.Series(values).dt.strftime("%Y-%m-%d %H:%M:%S").where(pd.Series(values).notna())
+
+
+def generate_geolocation(rng, n_orders):
+    n_prefixes = int(min(MAX_ZIP_PREFIXES, max(20, n_orders * 0.19)))
+    prefixes = np.sort(rng.choice(np.arange(1000, 99991), n_prefixes, replace=False))
+    state = choice(rng, STATES, n_prefixes)
+    # Центр префикса: широта/долгота в пределах Бразилии
+    lat = rng.uniform(-33.0, 4.0, n_prefixes)
+    lng = rng.uniform(-73.0, -35.0, n_prefixes)
+    # У ~15% префиксов несколько написаний города
+    n_cities = counts(rng, {1: 0.85, 2: 0.12, 3: 0.03}, n_prefixes)
+
+    rows = rng.poisson(GEO_ROWS_PER_PREFIX - 1, n_prefixes) + 1
+    prefix_row = np.repeat(np.arange(n_prefixes), rows)
+    city_variant = rng.integers(0, n_cities[prefix_row])
+    geo = pd.DataFrame({
+        "geolocation_zip_code_prefix": prefixes[prefix_row],
+        "geolocation_lat": lat[prefix_row] + rng.normal(0, 0.02, len(prefix_row)),
+        "geolocation_lng": lng[prefix_row] + rng.normal(0, 0.02, len(prefix_row)),
+        "geolocation_city": [f"cidade {p // 100}" + (f" {v}" if v else "")
+                             for p, v in zip(prefixes[prefix_row], city_variant)],
+        "geolocation_state": state[prefix_row],
+    })
+    return geo, pd.DataFrame({"prefix": prefixes, "state": state})
+
+
+def generate_customers(rng, n_orders, prefixes):
+    """customer_unique_id каждого заказа и строки customers (по одной на заказ)."""
+    n_unique = max(1, int(n_orders / 1.035))
+    # Первые n_unique заказов — по одному на клиента, остальные — повторные покупки
+    # небольшой доли клиентов с тяжёлым хвостом (Zipf)
+    repeaters = rng.choice(n_unique, max(1, n_unique // 33), replace=False)
+    extra = repeaters[np.minimum(rng.zipf(1.6, n_orders - n_unique) - 1, len(repeaters) - 1)]
+    unique_of_order = rng.permutation(np.concatenate([np.arange(n_unique), extra]))
+
+    unique_ids = hex_ids(rng, n_unique)
+    home = rng.integers(0, len(prefixes), n_unique)
+    zip_row = home[unique_of_order]
+    # Часть повторных заказов — с другого адреса
+    moved = rng.random(n_orders) < 0.05
+    zip_row[moved] = rng.integers(0, len(prefixes), moved.sum())
+    zip_prefix = prefixes["prefix"].to_numpy()[zip_row]
+    # ~0.3% адресов с префиксом, которого нет в geolocation
+    unknown = rng.random(n_orders) < 0.003
+    zip_prefix[unknown] = rng.integers(1000, 99991, unknown.sum())
+
+    return pd.DataFrame({
+        "customer_id": hex_ids(rng, n_orders),
+        "customer_unique_id": unique_ids[unique_of_order],
+        "customer_zip_code_prefix": zip_prefix,
+        "customer_city": [f"cidade {p // 100}" for p in zip_prefix],
+        "customer_state": prefixes["state"].to_numpy()[zip_row],
+    })
+
+
+def generate_catalog(rng, n_orders, prefixes):
+    categories = pd.read_csv(os.path.join(RESEARCH_DIR, TABLE_FILES["category_translation"]))
+    n_products = max(10, int(n_orders * 0.33))
+    category = categories["product_category_name"].to_numpy(dtype=object)[
+        np.minimum(rng.zipf(1.3, n_products) - 1, len(categories) - 1)]
+    category[rng.random(n_products) < 0.02] = None
+    products = pd.DataFrame({
+        "product_id": hex_ids(rng, n_products),
+        "product_category_name": category,
+        "product_name_lenght": rng.integers(5, 77, n_products).astype(float),
+        "product_description_lenght": rng.integers(4, 3993, n_products).astype(float),
+        "product_photos_qty": rng.integers(1, 8, n_products).astype(float),
+        "product_weight_g": rng.lognormal(6.5, 1.2, n_products).round(),
+        "product_length_cm": rng.integers(7, 106, n_products).astype(float),
+        "product_height_cm": rng.integers(2, 106, n_products).astype(float),
+        "product_width_cm": rng.integers(6, 119, n_products).astype(float),
+    })
+    # У товаров без категории нет и описания (как в исходных данных)
+    products.loc[products["product_category_name"].isna(),
+                 ["product_name_lenght", "product_description_lenght", "product_photos_qty"]] = np.nan
+
+    n_sellers = max(5, int(n_orders * 0.031))
+    seller_zip = rng.integers(0, len(prefixes), n_sellers)
+    sellers = pd.DataFrame({
+        "seller_id": hex_ids(rng, n_sellers),
+        "seller_zip_code_prefix": prefixes["prefix"].to_numpy()[seller_zip],
+        "seller_city": [f"cidade {p // 100}" for p in prefixes["prefix"].to_numpy()[seller_zip]],
+        "seller_state": prefixes["state"].to_numpy()[seller_zip],
+    })
+    return products, sellers, categories
+
+
+def generate_orders(rng, customers):
+    n_orders = len(customers)
+    purchase = _timestamps(rng, n_orders)
+    status = choice(rng, ORDER_STATUSES, n_orders)
+    approved = purchase + pd.to_timedelta(rng.exponential(10 * 3600, n_orders).astype("int64"), unit="s")
+    carrier = approved + pd.to_timedelta(rng.exponential(3 * 86400, n_orders).astype("int64"), unit="s")
+    delivered = carrier + pd.to_timedelta(rng.exponential(9 * 86400, n_orders).astype("int64"), unit="s")
+    estimated = (purchase + pd.to_timedelta(rng.integers(10, 40, n_orders), unit="D")).normalize()
+
+    not_approved = np.isin(status, ["created", "canceled"]) & (rng.random(n_orders) < 0.5)
+    not_shipped = ~np.isin(status, ["delivered", "shipped"])
+    not_delivered = status != "delivered"
+    approved = approved.where(~not_approved)
+    carrier = carrier.where(~(not_shipped | not_approved))
+    delivered = delivered.where(~not_delivered)
+
+    return pd.DataFrame({
+        "order_id": hex_ids(rng, n_orders),
+        "customer_id": customers["customer_id"].to_numpy(),
+        "order_status": status,
+        "order_purchase_timestamp": _fmt(purchase),
+        "order_approved_at": _fmt(approved),
+        "order_delivered_carrier_date": _fmt(carrier),
+        "order_delivered_customer_date": _fmt(delivered),
+        "order_estimated_delivery_date": _fmt(estimated),
+    })
+
+
+def generate_items(rng, orders, products, sellers):
+    n_orders = len(orders)
+    n_items = counts(rng, {1: 0.90, 2: 0.075, 3: 0.012, 4: 0.007, 5: 0.003, 6: 0.003}, n_orders)
+    # У отменённых и недоступных заказов обычно нет позиций
+    empty = np.isin(orders["order_status"].to_numpy(), ["unavailable", "canceled"]) & (rng.random(n_orders) < 0.9)
+    n_items[empty] = 0
+
+    order_row = np.repeat(np.arange(n_orders), n_items)
+    first = np.r_[0, np.cumsum(n_items)[:-1]]
+    item_number = np.arange(len(order_row)) - np.repeat(first, n_items) + 1
+    # Популярность товаров и продавцов с тяжёлым хвостом
+    product = np.minimum(rng.zipf(1.2, len(order_row)) - 1, len(products) - 1)
+    product = rng.permutation(len(products))[product]
+    seller = rng.integers(0, len(sellers), len(products))[product]
+    purchase = pd.to_datetime(orders["order_purchase_timestamp"].to_numpy()[order_row])
+    return pd.DataFrame({
+        "order_id": orders["order_id"].to_numpy()[order_row],
+        "order_item_id": item_number,
+        "product_id": products["product_id"].to_numpy()[product],
+        "seller_id": sellers["seller_id"].to_numpy()[seller],
+        "shipping_limit_date": _fmt(purchase + pd.Timedelta(days=6)),
+        "price": rng.lognormal(4.3, 0.9, len(order_row)).round(2),
+        "freight_value": rng.gamma(3.0, 7.0, len(order_row)).round(2),
+    })
+
+
+def generate_payments(rng, orders, items):
+    n_orders = len(orders)
+    totals = (items["price"] + items["freight_value"]).groupby(items["order_id"]).sum()
+    total = totals.reindex(orders["order_id"]).fillna(0).to_numpy()
+    total[total == 0] = rng.lognormal(4.5, 0.8, (total == 0).sum()).round(2)
+
+    # Иногда часть суммы доплачивается ваучерами (до нескольких платежей)
+    n_payments = counts(rng, {1: 0.965, 2: 0.025, 3: 0.006, 4: 0.004}, n_orders)
+    order_row = np.repeat(np.arange(n_orders), n_payments)
+    first = np.r_[0, np.cumsum(n_payments)[:-1]]
+    sequential = np.arange(len(order_row)) - np.repeat(first, n_payments) + 1
+    share = rng.dirichlet(np.ones(4), n_orders)
+    value = np.where(n_payments[order_row] == 1, total[order_row],
+                     total[order_row] * share[order_row, np.minimum(sequential - 1, 3)]
+                     / share[order_row, :].cumsum(axis=1)[np.arange(len(order_row)), n_payments[order_row] - 1])
+    payment_type = choice(rng, PAYMENT_TYPES, len(order_row))
+    payment_type[sequential > 1] = "voucher"
+    installments = np.where(payment_type == "credit_card", counts(rng, {
+        1: 0.49, 2: 0.12, 3: 0.10, 4: 0.07, 5: 0.05, 6: 0.04, 8: 0.04, 10: 0.06, 12: 0.01, 24: 0.01,
+    }, len(order_row)), 1)
+    return pd.DataFrame({
+        "order_id": orders["order_id"].to_numpy()[order_row],
+        "payment_sequential": sequential,
+        "payment_type": payment_type,
+        "payment_installments": installments,
+        "payment_value": value.round(2),
+    })
+
+
+def generate_reviews(rng, orders):
+    n_orders = len(orders)
+    n_reviews = counts(rng, {1: 0.986, 0: 0.008, 2: 0.006}, n_orders)
+    order_row = np.repeat(np.arange(n_orders), n_reviews)
+    purchase = pd.to_datetime(orders["order_purchase_timestamp"].to_numpy()[order_row])
+    created = (purchase + pd.to_timedelta(rng.integers(3, 30, len(order_row)), unit="D")).normalize()
+    answered = created + pd.to_timedelta(rng.exponential(2 * 86400, len(order_row)).astype("int64"), unit="s")
+    return pd.DataFrame({
+        "review_id": hex_ids(rng, len(order_row)),
+        "order_id": orders["order_id"].to_numpy()[order_row],
+        "review_score": choice(rng, REVIEW_SCORES, len(order_row)).astype(int),
+        "review_creation_date": _fmt(created),
+        "review_answer_timestamp": _fmt(answered),
+    })
+
+
+def order_count(scale):
+    return max(10, int(BASE_ORDERS * scale))
+
+
+def generate(out_dir, scale=1.0, seed=0):
+    """
+    Пишет девять CSV (имена как в data_store.TABLE_FILES) в out_dir
+    и возвращает {таблица: число строк}. Одинаковые scale и seed дают одинаковые файлы.
+    """
+    rng = np.random.default_rng(seed)
+    n_orders = order_count(scale)
+
+    geolocation, prefixes = generate_geolocation(rng, n_orders)
+    customers = generate_customers(rng, n_orders, prefixes)
+    products, sellers, categories = generate_catalog(rng, n_orders, prefixes)
+    orders = generate_orders(rng, customers)
+    items = generate_items(rng, orders, products, sellers)
+    tables = {
+        "customers": customers,
+        "geolocation": geolocation,
+        "order_payments": generate_payments(rng, orders, items),
+        "order_reviews": generate_reviews(rng, orders),
+        "orders": orders,
+        "items": items,
+        "category_translation": categories,
+        "products": products,
+        "sellers": sellers,
+    }
+
+    os.makedirs(out_dir, exist_ok=True)
+    for table, df in tables.items():
+        df.to_csv(os.path.join(out_dir, TABLE_FILES[table]), index=False)
+    return {table: len(df) for table, df in tables.items()}
+
+
+def ensure_dataset(out_dir, scale, seed=0):
+    """Генерирует набор, если в out_dir ещё нет набора с тем же числом заказов и seed."""
+    manifest_path = os.path.join(out_dir, "generator.json")
+    # orders — чтобы набор, собранный при другом BASE_ORDERS, был пересобран
+    expected = {"scale": scale, "seed": seed, "orders": order_count(scale)}
+    try:
+        with open(manifest_path, encoding="utf-8") as f:
+            manifest = json.load(f)
+        if {key: manifest.get(key) for key in expected} == expected:
+            return manifest
+    except (OSError, ValueError):
+        pass
+
+    shutil.rmtree(out_dir, ignore_errors=True)
+    started = time.perf_counter()
+    rows = generate(out_dir, scale, seed)
+    manifest = {**expected, "rows": rows, "seconds": round(time.perf_counter() - started, 2)}
+    with open(manifest_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+    return manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("out_dir")
+    parser.add_argument("--scale", type=float, default=1.0, help=f"1x = {BASE_ORDERS} заказов")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    rows = generate(args.out_dir, args.scale, args.seed)
+    for table, n_rows in rows.items():
+        print(f"{table:<22}{n_rows:>12}")
+    print(f"{'seconds':<22}{time.perf_counter() - started:>12.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""
+Сверка и бенчмарк векторизованного ядра RFM (segmentation_tasks.rfm_core)
+с прежней реализацией process_data.
+
+Запуск из каталога app:
+    python -m benchmarks.rfm_core_bench --rows 1000000 10000000 50000000
+    python -m benchmarks.rfm_core_bench --rows 200000 --check
+
+Прежняя реализация на десятках миллионов строк работает очень долго,
+поэтому по умолчанию она запускается только до --legacy-max-rows строк.
+С --check любое расхождение с прежней реализацией даёт код возврата 1.
+"""
+import argparse
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from segmentation_tasks.rfm_core import CHURN_LABELS, aggregate_rows, score_customers
+
+
+def make_rows(n_rows, seed=0):
+    """Строки заказов: ~3 строки на клиента, платежи с тяжёлым хвостом."""
+    rng = np.random.default_rng(seed)
+    n_customers = max(1, n_rows // 3)
+    start = np.datetime64('2016-09-01T00:00:00')
+    return pd.DataFrame({
+        'customer_unique_id': rng.integers(0, n_customers, n_rows).astype(str),
+        'order_id': rng.integers(0, n_rows, n_rows),
+        'order_purchase_timestamp': start + rng.integers(0, 730 * 86400, n_rows).astype('timedelta64[s]'),
+        'payment_value': rng.gamma(2.0, 80.0, n_rows).round(2),
+    })
+
+
+def legacy_process_data(df):
+    """Прежний process_data (time_pipeline) без изменений логики."""
+    df = df.dropna()
+    current_date = df['order_purchase_timestamp'].max() + pd.Timedelta(days=1)
+    rfm = df.groupby('customer_unique_id').agg({
+        'order_purchase_timestamp': lambda x: (current_date - x.max()).days,
+        'order_id': 'count',
+        'payment_value': 'sum'
+    }).rename(columns={
+        'order_purchase_timestamp': 'recency',
+        'order_id': 'frequency',
+        'payment_value': 'monetary'
+    }).reset_index()
+
+    rfm['r_quartile'] = pd.qcut(rfm['recency'], 4, labels=False, duplicates='drop')
+    rfm['f_quartile'] = pd.qcut(rfm['frequency'], 4, labels=False, duplicates='drop')
+    rfm['m_quartile'] = pd.qcut(rfm['monetary'], 4, labels=False, duplicates='drop')
+    rfm['rfm_score'] = rfm[['r_quartile', 'f_quartile', 'm_quartile']].sum(axis=1)
+    rfm['RFM_Weighted'] = rfm['r_quartile'] * 0.5 + rfm['f_quartile'] * 0.3 + rfm['m_quartile'] * 0.2
+    rfm['Churn_Risk'] = pd.qcut(rfm['RFM_Weighted'], q=[0, 0.25, 0.75, 1], labels=CHURN_LABELS)
+
+    rfm = rfm.sort_values('monetary', ascending=False)
+    rfm['cumulative_value'] = rfm['monetary'].cumsum()
+    rfm['cumulative_percent'] = rfm['cumulative_value'] / rfm['monetary'].sum() * 100
+
+    def assign_abc_category(row):
+        if row['cumulative_percent'] <= 80:
+            return 'A'
+        elif row['cumulative_percent'] <= 95:
+            return 'B'
+        else:
+            return 'C'
+
+    rfm['abc_class'] = rfm.apply(assign_abc_category, axis=1)
+
+    rfm['std_dev'] = df.groupby('customer_unique_id')['payment_value'].transform(lambda x: x.std())
+    rfm['x_category'] = pd.cut(rfm['std_dev'], bins=[-1, 0.01, 50, float('inf')], labels=['X', 'Y', 'Z'])
+    rfm['x_category'] = rfm['x_category'].cat.add_categories(['Single Purchase']).fillna('Single Purchase')
+    rfm['segment'] = rfm['abc_class'].astype(str) + "_" + rfm['x_category'].astype(str)
+    return rfm
+
+
+def new_process_data(df):
+    return score_customers(aggregate_rows(df))
+
+
+# std_dev, x_category и segment не сверяются: прежний код присваивал std через transform
+# по индексу широкого фрейма (std чужих клиентов); новое поведение проверяет
+# tests/test_rfm_core.py
+PARITY_COLUMNS = ['recency', 'frequency', 'monetary', 'r_quartile', 'f_quartile', 'm_quartile',
+                  'rfm_score', 'RFM_Weighted', 'Churn_Risk', 'abc_class']
+
+
+def check_parity(legacy, new, tolerance=1e-9):
+    """Возвращает {колонка: число расхождений} по совпадающим customer_unique_id."""
+    legacy = legacy.set_index('customer_unique_id').sort_index()
+    new = new.set_index('customer_unique_id').sort_index()
+    if not legacy.index.equals(new.index):
+        return {'customer_unique_id': int(legacy.index.symmetric_difference(new.index).size)}
+
+    report = {}
+    for column in PARITY_COLUMNS:
+        a, b = legacy[column], new[column]
+        if pd.api.types.is_numeric_dtype(a) and pd.api.types.is_numeric_dtype(b):
+            a, b = a.astype('float64'), b.astype('float64')
+            equal = np.isclose(a, b, rtol=tolerance, atol=tolerance, equal_nan=True)
+        else:
+            equal = a.astype(str).values == b.astype(str).values
+        report[column] = int((~equal).sum())
+    return report
+
+
+def timed(func, *args):
+    started = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, nargs='+', default=[1_000_000, 10_000_000, 50_000_000])
+    parser.add_argument('--legacy-max-rows', type=int, default=1_000_000)
+    parser.add_argument('--check', action='store_true', help='сверить результат с прежней реализацией')
+    args = parser.parse_args()
+
+    mismatches = 0
+    print(f"{'rows':>12}{'customers':>12}{'legacy, s':>12}{'new, s':>10}{'speedup':>9}")
+    for n_rows in args.rows:
+        df = make_rows(n_rows)
+        new, new_seconds = timed(new_process_data, df)
+
+        legacy_seconds = None
+        if n_rows <= args.legacy_max_rows or args.check:
+            legacy, legacy_seconds = timed(legacy_process_data, df)
+            if args.check:
+                report = check_parity(legacy, new)
+                mismatches += sum(report.values())
+                print(f"  parity @ {n_rows}: {report}")
+
+        legacy_text = f"{legacy_seconds:.2f}" if legacy_seconds is not None else "-"
+        speedup = f"{legacy_seconds / new_seconds:.1f}x" if legacy_seconds is not None else "-"
+        print(f"{n_rows:>12}{len(new):>12}{legacy_text:>12}{new_seconds:>10.2f}{speedup:>9}")
+
+    if mismatches:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,176 @@
+"""
+Масштабный бенчмарк DAG на синтетических данных (benchmarks.olist_generator):
+время, пиковый RSS и разбивка по этапам на 0.1x/1x/10x (1x — размер исходного
+датасета, ~99 тыс. заказов), сравнение с эталоном.
+
+Запуск из каталога app:
+    python -m benchmarks.scaling_bench --scales 0.1 1 --out bench.json
+    python -m benchmarks.scaling_bench --scales 0.1 1 --save-baseline baseline.json
+    python -m benchmarks.scaling_bench --scales 0.1 1 --baseline baseline.json
+
+Redis не нужен: DAG запускается без записи результатов (writers не передаются).
+Каждый прогон выполняется в отдельном процессе с OLIST_DATA_DIR/OLIST_SNAPSHOT_DIR
+набора, чтобы пиковый RSS относился только к нему. Снапшоты parquet и индекс
+центроидов собираются заранее (время — в snapshot_seconds), артефакты этапов
+отключены: каждый прогон считает все этапы заново.
+
+С --baseline прогон с временем или пиковым RSS выше эталона больше чем на допуск
+(и на абсолютный запас, гасящий шум на маленьких наборах) считается регрессией;
+код возврата — 1.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+from benchmarks.olist_generator import BASE_ORDERS, ensure_dataset
+
+DEFAULT_DATA_ROOT = os.path.join(os.getenv("TMPDIR", "/tmp"), "olist_scaling")
+# Допуски регрессии: доля от эталона и абсолютный запас
+TIME_TOLERANCE = 0.25
+TIME_SLACK_SECONDS = 0.5
+RSS_TOLERANCE = 0.15
+RSS_SLACK_MB = 50.0
+
+# Код дочерних процессов: окружение набора задаётся до импорта data_store
+_PREPARE_CODE = """
+from segmentation_tasks.data_store import TABLE_FILES, load_table
+from segmentation_tasks.geo_index import load_zip_index
+for table in TABLE_FILES:
+    load_table(table)
+load_zip_index()
+"""
+_RUN_CODE = """
+import json, sys
+from segmentation_tasks.dag import _peak_rss_mb, run_pipeline
+report = run_pipeline(sys.argv[1:] or None, use_artifacts=False)
+report["peak_rss_mb"] = _peak_rss_mb()
+print(json.dumps(report))
+"""
+
+
+def _child(code, data_dir, args=()):
+    """Запускает код в отдельном процессе на наборе data_dir; (stdout, секунды)."""
+    env = dict(os.environ,
+               OLIST_DATA_DIR=data_dir,
+               OLIST_SNAPSHOT_DIR=os.path.join(data_dir, "_snapshot"),
+               PYTHONPATH=os.pathsep.join(filter(None, [os.getcwd(), os.getenv("PYTHONPATH")])))
+    started = time.perf_counter()
+    completed = subprocess.run([sys.executable, "-c", code, *args], env=env,
+                               capture_output=True, text=True, check=True)
+    return completed.stdout, time.perf_counter() - started
+
+
+def run_scale(scale, data_root, seed=0, leaves=None, repeat=1):
+    data_dir = os.path.join(data_root, f"x{scale:g}-s{seed}")
+    manifest = ensure_dataset(data_dir, scale, seed)
+    _, snapshot_seconds = _child(_PREPARE_CODE, data_dir)
+
+    runs = {}
+    for leaf in leaves or [None]:
+        best = None
+        # Из нескольких повторов берётся самый быстрый
+        for _ in range(repeat):
+            stdout, wall_seconds = _child(_RUN_CODE, data_dir, [leaf] if leaf else [])
+            report = json.loads(stdout.strip().splitlines()[-1])
+            if best is None or wall_seconds < best["wall_seconds"]:
+                best = {
+                    "wall_seconds": round(wall_seconds, 3),
+                    "pipeline_seconds": report["total_seconds"],
+                    "peak_rss_mb": report["peak_rss_mb"],
+                    "stages": {row["stage"]: {"seconds": row["seconds"], "rows": row["rows"],
+                                              "peak_rss_mb": row["peak_rss_mb"]}
+                               for row in report["stages"]},
+                }
+        runs[leaf or "all"] = best
+
+    return {
+        "scale": scale,
+        "orders": manifest["rows"]["orders"],
+        "rows": manifest["rows"],
+        "snapshot_seconds": round(snapshot_seconds, 3),
+        "runs": runs,
+    }
+
+
+def _exceeds(value, reference, tolerance, slack):
+    return value > reference * (1 + tolerance) + slack
+
+
+def compare(results, baseline):
+    """
+    Список регрессий относительно эталона (сравниваются только прогоны на наборах
+    с тем же числом заказов: эталон, снятый при другом BASE_ORDERS, не сопоставляется).
+    """
+    reference = {entry["orders"]: entry for entry in baseline["scales"]}
+    regressions = []
+    for entry in results["scales"]:
+        base = reference.get(entry["orders"])
+        if base is None:
+            continue
+        for name, run in entry["runs"].items():
+            base_run = base["runs"].get(name)
+            if base_run is None:
+                continue
+            checks = [("wall_seconds", run["wall_seconds"], base_run["wall_seconds"],
+                       TIME_TOLERANCE, TIME_SLACK_SECONDS),
+                      ("peak_rss_mb", run["peak_rss_mb"], base_run["peak_rss_mb"],
+                       RSS_TOLERANCE, RSS_SLACK_MB)]
+            checks += [(f"stage {stage}", stats["seconds"], base_run["stages"][stage]["seconds"],
+                        TIME_TOLERANCE, TIME_SLACK_SECONDS)
+                       for stage, stats in run["stages"].items() if stage in base_run["stages"]]
+            for metric, value, base_value, tolerance, slack in checks:
+                if _exceeds(value, base_value, tolerance, slack):
+                    regressions.append({"scale": entry["scale"], "run": name, "metric": metric,
+                                        "value": value, "baseline": base_value})
+    return regressions
+
+
+def print_results(results):
+    print(f"{'scale':>7}{'orders':>10}{'run':>10}{'wall, s':>10}{'peak MB':>10}  slowest stages")
+    for entry in results["scales"]:
+        for name, run in entry["runs"].items():
+            slowest = sorted(run["stages"].items(), key=lambda item: -item[1]["seconds"])[:3]
+            stages = ", ".join(f"{stage} {stats['seconds']:.2f}" for stage, stats in slowest)
+            print(f"{entry['scale']:>6g}x{entry['orders']:>10}{name:>10}{run['wall_seconds']:>10.2f}"
+                  f"{run['peak_rss_mb']:>10.1f}  {stages}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scales", type=float, nargs="+", default=[0.1, 1, 10],
+                        help=f"масштабы, 1x = {BASE_ORDERS} заказов")
+    parser.add_argument("--leaf", action="append", choices=["segments", "cohort", "timeline"],
+                        help="отдельный прогон листа (можно несколько); по умолчанию — весь DAG")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=1, help="повторов прогона, берётся лучший")
+    parser.add_argument("--data-root", default=DEFAULT_DATA_ROOT, help="каталог сгенерированных наборов")
+    parser.add_argument("--out", help="записать результаты в JSON")
+    parser.add_argument("--baseline", help="эталон для поиска регрессий")
+    parser.add_argument("--save-baseline", help="сохранить результаты как эталон")
+    args = parser.parse_args()
+
+    results = {"python": sys.version.split()[0], "seed": args.seed, "scales": []}
+    for scale in args.scales:
+        results["scales"].append(run_scale(scale, args.data_root, args.seed, args.leaf, args.repeat))
+    print_results(results)
+
+    for path in filter(None, [args.out, args.save_baseline]):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare(results, json.load(f))
+        for item in regressions:
+            print(f"РЕГРЕССИЯ {item['scale']:g}x {item['run']} {item['metric']}: "
+                  f"{item['value']} (эталон {item['baseline']})")
+        if regressions:
+            sys.exit(1)
+        print("регрессий нет")
+
+
+if __name__ == "__main__":
+    main()
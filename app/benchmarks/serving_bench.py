@@ -0,0 +1,143 @@
+"""
+Пропускная способность API под конкурентной нагрузкой: запросов в секунду,
+МБ/с и задержки (p50/p95/p99) при разном числе одновременных клиентов.
+
+Запуск из каталога app:
+    python -m benchmarks.serving_bench --serve sync gthread --concurrency 1 8 32
+    python -m benchmarks.serving_bench --url http://localhost:8000 --path /segments /cohort
+
+С --serve для каждого режима воркеров поднимается gunicorn (-w --workers) на свободном
+порту с этим кодом; Redis (REDIS_HOST/REDIS_PORT) должен быть доступен и уже содержать
+данные (после /reload). С --url нагружается уже запущенный сервис.
+Клиенты — потоки с keep-alive соединением; тело ответа читается целиком.
+"""
+import argparse
+import http.client
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+
+import numpy as np
+
+DEFAULT_PATHS = ["/segments", "/cohort", "/timeline", "/segments/meta"]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(worker_class, workers, threads):
+    """gunicorn с указанным режимом воркеров; (процесс, базовый URL)."""
+    port = free_port()
+    env = dict(os.environ, GUNICORN_WORKER_CLASS=worker_class, GUNICORN_THREADS=str(threads))
+    process = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "-w", str(workers), "-t", "120",
+         "-b", f"127.0.0.1:{port}", "--log-level", "warning", "main:app"],
+        env=env, stdout=subprocess.DEVNULL)
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"gunicorn ({worker_class}) завершился с кодом {process.returncode}")
+        try:
+            connection = http.client.HTTPConnection("127.0.0.1", port, timeout=1)
+            connection.request("GET", "/ping")
+            if connection.getresponse().status == 200:
+                return process, url
+        except OSError:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError(f"gunicorn ({worker_class}) не ответил на /ping")
+
+
+def run_load(url, path, concurrency, duration, headers):
+    """Нагрузка одним путём: concurrency потоков в течение duration секунд."""
+    parsed = urllib.parse.urlsplit(url)
+    latencies = [[] for _ in range(concurrency)]
+    received = [0] * concurrency
+    errors = [0] * concurrency
+    stop_at = time.perf_counter() + duration
+
+    def client(n):
+        connection = http.client.HTTPConnection(parsed.hostname, parsed.port, timeout=60)
+        while time.perf_counter() < stop_at:
+            started = time.perf_counter()
+            try:
+                connection.request("GET", path, headers=headers)
+                response = connection.getresponse()
+                body = response.read()
+            except (OSError, http.client.HTTPException):
+                errors[n] += 1
+                connection.close()
+                continue
+            if response.status != 200:
+                errors[n] += 1
+                continue
+            latencies[n].append(time.perf_counter() - started)
+            received[n] += len(body)
+        connection.close()
+
+    started = time.perf_counter()
+    clients = [threading.Thread(target=client, args=(n,)) for n in range(concurrency)]
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    all_latencies = np.concatenate([np.array(values) for values in latencies])
+    p50, p95, p99 = (np.percentile(all_latencies, [50, 95, 99]) * 1000 if len(all_latencies)
+                     else (float("nan"),) * 3)
+    return {
+        "requests": len(all_latencies),
+        "errors": sum(errors),
+        "rps": len(all_latencies) / elapsed,
+        "mb_per_s": sum(received) / elapsed / 2 ** 20,
+        "p50_ms": p50, "p95_ms": p95, "p99_ms": p99,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--url", help="адрес запущенного API")
+    target.add_argument("--serve", nargs="+", choices=["sync", "gthread", "gevent"],
+                        help="поднять gunicorn в каждом из режимов воркеров")
+    parser.add_argument("--workers", type=int, default=2, help="процессов gunicorn (с --serve)")
+    parser.add_argument("--threads", type=int, default=8, help="потоков на процесс для gthread (с --serve)")
+    parser.add_argument("--path", nargs="+", default=DEFAULT_PATHS)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--duration", type=float, default=10.0, help="секунд на каждое сочетание")
+    parser.add_argument("--encoding", default="gzip", help="Accept-Encoding запросов")
+    args = parser.parse_args()
+
+    headers = {"Accept-Encoding": args.encoding}
+    setups = [(args.url, None)] if args.url else [(None, worker_class) for worker_class in args.serve]
+
+    print(f"{'server':>10}{'path':>16}{'clients':>9}{'req/s':>10}{'MB/s':>9}"
+          f"{'p50, ms':>10}{'p95, ms':>10}{'p99, ms':>10}{'errors':>8}")
+    for url, worker_class in setups:
+        process = None
+        if worker_class:
+            process, url = start_server(worker_class, args.workers, args.threads)
+        try:
+            for path in args.path:
+                for concurrency in args.concurrency:
+                    result = run_load(url, path, concurrency, args.duration, headers)
+                    print(f"{worker_class or 'url':>10}{path:>16}{concurrency:>9}{result['rps']:>10.1f}"
+                          f"{result['mb_per_s']:>9.1f}{result['p50_ms']:>10.1f}{result['p95_ms']:>10.1f}"
+                          f"{result['p99_ms']:>10.1f}{result['errors']:>8}")
+        finally:
+            if process:
+                process.terminate()
+                process.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""
+Стоимость старта процессов: время импорта точки входа, RSS после импорта,
+загруженные тяжёлые модули (pandas, numpy, pyarrow, пайплайны) и самые дорогие
+прямые импорты по -X importtime.
+
+Запуск из каталога app:
+    python -m benchmarks.startup_bench
+    python -m benchmarks.startup_bench --process api --repeat 5 --top 15
+    python -m benchmarks.startup_bench --check
+
+Каждый замер — в новом процессе интерпретатора, Redis не нужен (соединения
+создаются лениво). Время — медиана по --repeat запускам. С --check код возврата 1,
+если процесс API загрузил хотя бы один тяжёлый модуль.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+# Точки входа процессов: API (gunicorn main:app), воркер Celery и стартовая задача
+PROCESSES = {
+    "api": "main",
+    "worker": "segmentation_tasks.tasks",
+    "startup": "startup_tasks",
+}
+HEAVY_MODULES = [
+    "pandas", "numpy", "pyarrow", "scipy", "sklearn",
+    "segmentation_tasks.dag", "segmentation_tasks.tasks", "segmentation_tasks.rfm_core",
+    "segmentation_tasks.data_store",
+]
+
+_CHILD_CODE = """
+import importlib, json, os, sys, time
+started = time.perf_counter()
+importlib.import_module(sys.argv[1])
+seconds = time.perf_counter() - started
+with open("/proc/self/statm") as f:
+    rss_mb = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+print(json.dumps({"seconds": seconds, "rss_mb": rss_mb, "modules": len(sys.modules),
+                  "heavy": [m for m in json.loads(sys.argv[2]) if m in sys.modules]}))
+"""
+
+
+def _child(module, importtime=False):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [os.getcwd(), os.getenv("PYTHONPATH")])))
+    command = [sys.executable, *(["-X", "importtime"] if importtime else []),
+               "-c", _CHILD_CODE, module, json.dumps(HEAVY_MODULES)]
+    completed = subprocess.run(command, env=env, capture_output=True, text=True)
+    if completed.returncode != 0:
+        raise RuntimeError(f"импорт {module} завершился с ошибкой:\n{completed.stderr}")
+    return json.loads(completed.stdout.splitlines()[-1]), completed.stderr
+
+
+def top_imports(importtime_log, top):
+    """Прямые импорты точки входа и модули верхнего уровня: (модуль, накопленные секунды)."""
+    rows = []
+    for line in importtime_log.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|", 2)
+        if not cumulative.strip().isdigit():
+            continue  # строка заголовка
+        depth = (len(name) - len(name.lstrip(" ")) - 1) // 2
+        if depth <= 1:
+            rows.append((name.strip(), int(cumulative) / 1e6))
+    return sorted(rows, key=lambda row: -row[1])[:top]
+
+
+def measure(module, repeat, top):
+    runs = [_child(module)[0] for _ in range(repeat)]
+    report, log = _child(module, importtime=True)
+    return {
+        "module": module,
+        "import_seconds": round(statistics.median(run["seconds"] for run in runs), 3),
+        "rss_mb": round(statistics.median(run["rss_mb"] for run in runs), 1),
+        "modules": report["modules"],
+        "heavy": report["heavy"],
+        "top_imports": [{"module": name, "seconds": round(seconds, 3)} for name, seconds in top_imports(log, top)],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--process", nargs="+", choices=list(PROCESSES), default=list(PROCESSES))
+    parser.add_argument("--repeat", type=int, default=3, help="запусков на процесс (медиана)")
+    parser.add_argument("--top", type=int, default=10, help="сколько самых дорогих импортов показать")
+    parser.add_argument("--out", help="сохранить отчёт в JSON")
+    parser.add_argument("--check", action="store_true", help="код 1, если API загрузил тяжёлые модули")
+    args = parser.parse_args()
+
+    results = {name: measure(PROCESSES[name], args.repeat, args.top) for name in args.process}
+
+    print(f"{'process':<10}{'module':<28}{'import, s':>10}{'RSS MB':>9}{'modules':>9}  heavy")
+    for name, result in results.items():
+        print(f"{name:<10}{result['module']:<28}{result['import_seconds']:>10}{result['rss_mb']:>9}"
+              f"{result['modules']:>9}  {', '.join(result['heavy']) or '-'}")
+    for name, result in results.items():
+        print(f"\n{name}: самые дорогие импорты")
+        for row in result["top_imports"]:
+            print(f"{row['seconds']:>10}  {row['module']}")
+
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+    if args.check and results.get("api", {}).get("heavy"):
+        print(f"\nAPI загружает тяжёлые модули: {', '.join(results['api']['heavy'])}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
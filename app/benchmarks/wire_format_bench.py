@@ -0,0 +1,78 @@
+"""
+Размер выдачи /segments и время её разбора клиентом (pandas)
+в JSON, Arrow IPC и MessagePack.
+
+Запуск из каталога app:
+    python -m benchmarks.wire_format_bench --rows 100000 1000000
+
+Кодирование выполняется теми же функциями, что и при записи в Redis
+(wire_formats); время кодирования тратится один раз на версию и приведено для справки.
+"""
+import argparse
+import gzip
+import json
+import time
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+import wire_formats
+from segmentation_tasks.rfm_core import ABC_CLASSES, XYZ_CATEGORIES
+from segmentation_tasks.segmentation_pipeline import CHURN_LABELS
+
+
+def make_segments(n_rows, seed=0):
+    """Выдача /segments: риск оттока, сегмент и координаты клиента."""
+    rng = np.random.default_rng(seed)
+    segments = [f"{abc}_{xyz}" for abc in ABC_CLASSES for xyz in XYZ_CATEGORIES]
+    return pd.DataFrame({
+        "Churn_Risk": pd.Categorical(rng.choice(CHURN_LABELS, n_rows), categories=CHURN_LABELS),
+        "segment": pd.Categorical(rng.choice(segments, n_rows)),
+        "geolocation_lat": rng.uniform(-33, 5, n_rows).round(10),
+        "geolocation_lng": rng.uniform(-73, -35, n_rows).round(10),
+    })
+
+
+def encode(df):
+    """{формат: (тело, секунды кодирования)}."""
+    encoders = {
+        "json": lambda: df.to_json(orient="records", force_ascii=False).encode("utf-8"),
+        "arrow": lambda: wire_formats.arrow_frame(df),
+    }
+    if "msgpack" in wire_formats.BINARY_FORMATS:
+        encoders["msgpack"] = lambda: (wire_formats.msgpack_array_header(len(df))
+                                       + wire_formats.msgpack_records(df))
+    return {name: timed(func) for name, func in encoders.items()}
+
+
+DECODERS = {
+    "json": lambda body: pd.DataFrame(json.loads(body)),
+    "arrow": lambda body: pa.ipc.open_stream(body).read_pandas(),
+    "msgpack": lambda body: pd.DataFrame(wire_formats.msgpack.unpackb(body)),
+}
+
+
+def timed(func, *args):
+    started = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, nargs="+", default=[100_000, 1_000_000])
+    args = parser.parse_args()
+
+    print(f"{'rows':>10}{'format':>9}{'bytes':>13}{'gzip bytes':>13}{'encode, s':>11}{'decode, s':>11}")
+    for n_rows in args.rows:
+        df = make_segments(n_rows)
+        for name, (body, encode_seconds) in encode(df).items():
+            decoded, decode_seconds = timed(DECODERS[name], body)
+            assert len(decoded) == n_rows
+            print(f"{n_rows:>10}{name:>9}{len(body):>13}{len(gzip.compress(body, 6)):>13}"
+                  f"{encode_seconds:>11.3f}{decode_seconds:>11.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+import glob
+import gzip
+import hashlib
+import io
+import json
+import os
+import shutil
+import time
+from datetime import datetime
+from typing import TYPE_CHECKING
+
+from redis_cache import (
+    PAYLOAD_GZIP_LEVEL, cohort_payload, iter_segment_records, segments_output, timeline_payload)
+from segmentation_tasks.constants import SNAPSHOT_DIR
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+# Локальная копия опубликованных наборов на диске.
+# Запись в Redis сопровождается записью на диск: результат пайплайна (для восстановления
+# Redis без пересчёта) и готовое сжатое тело полной выдачи (для ответа API, когда Redis
+# недоступен, пуст или не укладывается в бюджет задержки). Раскладка:
+#   <каталог>/<набор>/<id>/<файлы>   — файлы версии
+#   <каталог>/<набор>/current.json   — манифест текущей версии: sha256 и размер файлов,
+#                                      etag и updated_at выдачи, версия исходных данных
+# Файлы версии пишутся до манифеста, манифест заменяется атомарно, поэтому читатель
+# видит либо прежнюю, либо новую версию целиком. Контрольные суммы проверяются при чтении.
+
+DISK_SNAPSHOT_DIR = os.getenv("DISK_SNAPSHOT_DIR", os.path.join(SNAPSHOT_DIR, "serving"))
+# Сколько версий каждого набора хранить на диске
+DISK_SNAPSHOT_KEEP = max(1, int(os.getenv("DISK_SNAPSHOT_KEEP", "2")))
+DISK_SNAPSHOT_FORMAT_VERSION = 1
+BODY_FILE = "body.json.gz"
+
+
+def _dataset_dir(dataset):
+    return os.path.join(DISK_SNAPSHOT_DIR, dataset)
+
+
+def _manifest_path(dataset):
+    return os.path.join(_dataset_dir(dataset), "current.json")
+
+
+def save_snapshot(dataset, files: dict, body: bytes, updated_at, data_version=None) -> dict:
+    """
+    Пишет новую версию набора: files — {имя файла: байты} результата пайплайна,
+    body — несжатое тело полной выдачи (хранится в gzip). Возвращает манифест.
+    """
+    snapshot_id = f"{int(time.time() * 1000)}-{os.getpid()}"
+    version_dir = os.path.join(_dataset_dir(dataset), snapshot_id)
+    os.makedirs(version_dir, exist_ok=True)
+
+    files = {**files, BODY_FILE: gzip.compress(body, PAYLOAD_GZIP_LEVEL, mtime=0)}
+    for name, data in files.items():
+        with open(os.path.join(version_dir, name), "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+
+    manifest = {
+        "format": DISK_SNAPSHOT_FORMAT_VERSION,
+        "dataset": dataset,
+        "id": snapshot_id,
+        "updated_at": updated_at,
+        "etag": hashlib.sha1(body).hexdigest(),
+        "data_version": data_version,
+        "files": {name: {"sha256": hashlib.sha256(data).hexdigest(), "bytes": len(data)}
+                  for name, data in files.items()},
+    }
+    _write_manifest(dataset, manifest)
+
+    # Старые версии удаляются (текущая всегда остаётся)
+    versions = sorted((d for d in glob.glob(os.path.join(_dataset_dir(dataset), "*")) if os.path.isdir(d)),
+                      key=os.path.getmtime, reverse=True)
+    for old in versions[DISK_SNAPSHOT_KEEP:]:
+        if os.path.basename(old) != snapshot_id:
+            shutil.rmtree(old, ignore_errors=True)
+    return manifest
+
+
+def _write_manifest(dataset, manifest):
+    path = _manifest_path(dataset)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, path)
+
+
+def load_manifest(dataset) -> dict | None:
+    """Манифест текущей версии набора или None, если на диске её нет или она снята (invalidate)."""
+    try:
+        with open(_manifest_path(dataset), encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if manifest.get("format") != DISK_SNAPSHOT_FORMAT_VERSION or manifest.get("invalidated"):
+        return None
+    return manifest
+
+
+def invalidate(dataset, reason) -> dict | None:
+    """
+    Снимает текущую версию набора на диске (например, после отката версии в Redis):
+    её больше не отдаёт API и не восстанавливает в Redis тёплый старт — набор считается
+    отсутствующим и пересчитывается. Файлы остаются до следующей записи набора.
+    Возвращает снятый манифест или None, если снимать нечего.
+    """
+    manifest = load_manifest(dataset)
+    if manifest is None:
+        return None
+    manifest["invalidated"] = {"reason": reason, "at": datetime.utcnow().isoformat()}
+    _write_manifest(dataset, manifest)
+    return manifest
+
+
+def read_file(manifest, name) -> bytes:
+    """Файл версии с проверкой контрольной суммы (ValueError при несовпадении)."""
+    with open(os.path.join(_dataset_dir(manifest["dataset"]), manifest["id"], name), "rb") as f:
+        data = f.read()
+    if hashlib.sha256(data).hexdigest() != manifest["files"][name]["sha256"]:
+        raise ValueError(f"Контрольная сумма {manifest['dataset']}/{manifest['id']}/{name} не совпадает")
+    return data
+
+
+# =====================
+# Наборы данных
+# =====================
+# Для каждого набора: запись результата пайплайна (аргументов записи в Redis)
+# вместе с телом выдачи и чтение этих аргументов обратно.
+
+def save_segments(df: "pd.DataFrame", updated_at, data_version=None):
+    buffer = io.BytesIO()
+    df.to_parquet(buffer, index=False)
+    # Тело собирается так же, как куски в Redis, поэтому ETag совпадает
+    records = [",".join(chunk_records) for _, _, chunk_records in iter_segment_records(segments_output(df))]
+    body = f"[{','.join(records)}]".encode("utf-8")
+    return save_snapshot("segments", {"result.parquet": buffer.getvalue()}, body, updated_at, data_version)
+
+
+def save_cohort(cohort_json: dict, data_version=None):
+    body = json.dumps(cohort_payload(cohort_json), ensure_ascii=False).encode("utf-8")
+    result = json.dumps(cohort_json, ensure_ascii=False).encode("utf-8")
+    return save_snapshot("cohort", {"result.json": result}, body, cohort_json["updated_at"], data_version)
+
+
+def save_timeline(by_segment_json: str, by_churn_json: str, updated_at, rollup=None, data_version=None):
+    body = json.dumps(timeline_payload(by_segment_json, by_churn_json, updated_at), ensure_ascii=False)
+    result = json.dumps({"by_segment": by_segment_json, "by_churn": by_churn_json, "rollup": rollup},
+                        ensure_ascii=False, separators=(",", ":"))
+    return save_snapshot("timeline", {"result.json": result.encode("utf-8")}, body.encode("utf-8"),
+                         updated_at, data_version)
+
+
+def load_result(manifest):
+    """Аргументы записи набора в Redis (cache_*_to_redis) из версии на диске."""
+    import pandas as pd
+
+    dataset = manifest["dataset"]
+    if dataset == "segments":
+        return (pd.read_parquet(io.BytesIO(read_file(manifest, "result.parquet"))),)
+    result = json.loads(read_file(manifest, "result.json"))
+    if dataset == "cohort":
+        return (result,)
+    # Копии, записанные до куба свёрток, восстанавливаются без него
+    return result["by_segment"], result["by_churn"], result.get("rollup")
+
+
+def read_body(manifest) -> bytes:
+    """Тело полной выдачи в gzip."""
+    return read_file(manifest, BODY_FILE)
@@ -0,0 +1,18 @@
+import os
+
+# Конфигурация gunicorn (читается из рабочего каталога автоматически).
+# Число процессов, таймаут и адрес (-w, -t, -b) задаются в командной строке docker-compose.
+
+# Потоковые воркеры: пока один запрос ждёт Redis или отдаёт многомегабайтный ответ,
+# остальные потоки процесса обслуживают другие запросы. gevent тоже поддерживается
+# (GUNICORN_WORKER_CLASS=gevent при установленном gevent); sync — прежний режим.
+# Соединения с Redis потоки берут из общего ограниченного пула (REDIS_MAX_CONNECTIONS)
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+threads = int(os.getenv("GUNICORN_THREADS", "8"))
+worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", "100"))
+
+
+def on_starting(server):
+    # Файлы метрик прошлого запуска (PROMETHEUS_MULTIPROC_DIR) не должны суммироваться с новыми
+    from metrics import reset_multiproc_dir
+    reset_multiproc_dir()
@@ -1,14 +1,31 @@
-from flask import Flask, jsonify, Response
+from flask import Flask, copy_current_request_context, g, jsonify, Response, request
 from flask_compress import Compress
 from flasgger import Swagger
-from redis_cache import get_segments_json_from_redis, get_segments_updated_at, load_cohort_from_redis, load_timeline_from_redis
-from segmentation_tasks.tasks import run_segmentation
+from redis_cache import (
+    PAYLOAD_ENCODINGS, REDIS_MAX_CONNECTIONS, SEGMENTS_DEFAULT_LIMIT, SEGMENTS_LOOKUP_MAX_IDS, SEGMENTS_MAX_LIMIT,
+    SNAPSHOT_DATASETS, get_cohort_slice, get_customer_segments, get_payload_body, get_payload_meta,
+    get_profile, get_segments_in_area, get_segments_page, get_segments_updated_at, get_timeline_rollup,
+    get_timeline_slice, iter_segment_chunks, list_snapshots, rollback_snapshot, rollup_query)
+from payload_cache import payload_cache
+import disk_snapshot
+import metrics
+from wire_formats import ARROW_MIMETYPE, BINARY_FORMATS, MSGPACK_MIMETYPES
+from segmentation_tasks.celery_app import celery_app
+from segmentation_tasks.constants import (
+    CHURN_LABELS as TIMELINE_CHURN_LABELS, LEAVES, ROLLUP_LEVELS, SEGMENT_CHURN_LABELS as CHURN_LABELS,
+    SEGMENT_DESCRIPTIONS)
+from segmentation_tasks.refresh import submit_refresh
 from celery.result import AsyncResult
-import sys
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+import gzip
 import logging
+import os
+import redis
 from flask_cors import CORS
 import json
-from datetime import datetime
+import re
+import time
+from datetime import datetime, timezone
 
 logging.basicConfig(level=logging.INFO)
 
@@ -16,6 +33,22 @@ app = Flask(__name__)
 Compress(app)
 CORS(app)
 
+
+@app.before_request
+def start_timer():
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def observe_request(response):
+    # Потоковые ответы учитываются до отправки тела; маршрут — шаблон правила, а не путь
+    started = g.pop("request_started", None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        metrics.observe_request(request.method, route, response.status_code, time.perf_counter() - started)
+    return response
+
+
 swagger = Swagger(app, parse=True, template={
     "swagger": "2.0",
     "info": {
@@ -25,6 +58,137 @@ swagger = Swagger(app, parse=True, template={
     }
 })
 
+# Форматы выдачи по заголовку Accept: JSON (по умолчанию), NDJSON (только выдача кусками),
+# Arrow IPC и MessagePack (см. wire_formats)
+JSON_MIMETYPE = "application/json"
+NDJSON_MIMETYPES = ["application/x-ndjson", "application/ndjson"]
+BINARY_MIMETYPES = {"arrow": [ARROW_MIMETYPE], "msgpack": MSGPACK_MIMETYPES}
+
+
+def negotiate_format(chunked):
+    """Формат ответа и его mimetype по заголовку Accept."""
+    offered = {JSON_MIMETYPE: "json"}
+    if chunked:
+        offered.update(dict.fromkeys(NDJSON_MIMETYPES, "ndjson"))
+    for name in BINARY_FORMATS:
+        offered.update(dict.fromkeys(BINARY_MIMETYPES[name], name))
+    mimetype = request.accept_mimetypes.best_match(list(offered)) or JSON_MIMETYPE
+    return offered[mimetype], mimetype
+
+
+def conditional_state(etag, updated_at):
+    """Last-Modified по updated_at и признак ответа 304 по If-None-Match / If-Modified-Since."""
+    last_modified = None
+    try:
+        last_modified = datetime.fromisoformat(updated_at).replace(tzinfo=timezone.utc, microsecond=0)
+    except (TypeError, ValueError):
+        pass
+
+    if request.if_none_match:
+        not_modified = request.if_none_match.contains(etag)
+    else:
+        not_modified = bool(last_modified and request.if_modified_since
+                            and last_modified <= request.if_modified_since)
+    return last_modified, not_modified
+
+
+def payload_response(dataset):
+    """
+    Готовый ответ набора данных из текущей версии снапшота.
+    Тело уже собрано и сжато при записи: выбирается кодировка по Accept-Encoding,
+    при совпадении ETag или If-Modified-Since тело из Redis не читается вовсе (304).
+    Выдача, хранящаяся кусками (сегменты), отдаётся потоком.
+    """
+    meta = get_payload_meta(dataset)
+    if meta is None:
+        raise ValueError(f"Данные {dataset} ещё не закэшированы")
+
+    chunked = "chunks" in meta
+    body_format, mimetype = negotiate_format(chunked)
+    etag = meta["etag"] if body_format == "json" else f"{meta['etag']}-{body_format}"
+    last_modified, not_modified = conditional_state(etag, meta["updated_at"])
+
+    if not_modified:
+        response = Response(status=304)
+    else:
+        # Заранее сжимается только JSON; бинарные форматы и NDJSON отдаются как есть
+        encoding = "identity"
+        if body_format == "json":
+            encoding = request.accept_encodings.best_match(PAYLOAD_ENCODINGS) or "identity"
+        name = encoding if body_format == "json" else body_format
+
+        if chunked:
+            body = iter_segment_chunks(meta["version"], int(meta["chunks"]), name)
+        else:
+            body = get_payload_body(dataset, meta["version"], name)
+            if body is None:
+                raise ValueError(f"Версия {dataset} обновляется, повторите запрос")
+        if body_format in BINARY_FORMATS:
+            response = Response(body, content_type=mimetype)
+        else:
+            response = Response(body, content_type=f"{mimetype}; charset=utf-8")
+        if encoding != "identity":
+            # Flask-Compress не сжимает ответы с уже заданным Content-Encoding
+            response.headers["Content-Encoding"] = encoding
+
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.vary.add("Accept-Encoding")
+    response.vary.add("Accept")
+    return response
+
+# Бюджет задержки чтения готового ответа из Redis. Если Redis недоступен, пуст (после
+# перезапуска) или не ответил за это время, полная выдача отдаётся из копии на диске
+# (disk_snapshot) в JSON с заголовком X-Served-From: disk. Для потоковой выдачи сегментов
+# в бюджет входит чтение метаданных версии. 0 — ждать Redis без ограничения
+REDIS_READ_BUDGET_SECONDS = float(os.getenv("REDIS_READ_BUDGET_SECONDS", "1"))
+_redis_reads = ThreadPoolExecutor(max_workers=REDIS_MAX_CONNECTIONS, thread_name_prefix="redis-read")
+
+
+def disk_payload_response(dataset):
+    """Полная выдача набора из копии на диске или None, если копии нет."""
+    manifest = disk_snapshot.load_manifest(dataset)
+    if manifest is None:
+        return None
+    last_modified, not_modified = conditional_state(manifest["etag"], manifest["updated_at"])
+
+    if not_modified:
+        response = Response(status=304)
+    else:
+        cache_name = f"disk:{dataset}"
+        payload_cache.observe_version(cache_name, manifest["id"])
+        body = payload_cache.get((cache_name, manifest["id"], "body:gzip"))
+        if body is None:
+            body = disk_snapshot.read_body(manifest)
+            payload_cache.put((cache_name, manifest["id"], "body:gzip"), body, len(body))
+        if request.accept_encodings.best_match(["gzip", "identity"]) == "gzip":
+            response = Response(body, content_type=f"{JSON_MIMETYPE}; charset=utf-8")
+            response.headers["Content-Encoding"] = "gzip"
+        else:
+            response = Response(gzip.decompress(body), content_type=f"{JSON_MIMETYPE}; charset=utf-8")
+
+    response.set_etag(manifest["etag"])
+    response.last_modified = last_modified
+    response.vary.add("Accept-Encoding")
+    response.headers["X-Served-From"] = "disk"
+    return response
+
+
+def served_payload(dataset):
+    """Готовый ответ из Redis в пределах REDIS_READ_BUDGET_SECONDS, иначе — с диска."""
+    future = _redis_reads.submit(copy_current_request_context(payload_response), dataset)
+    try:
+        return future.result(timeout=REDIS_READ_BUDGET_SECONDS or None)
+    except (FutureTimeoutError, redis.RedisError, ValueError) as e:
+        reason = (f"Redis не ответил за {REDIS_READ_BUDGET_SECONDS} с"
+                  if isinstance(e, FutureTimeoutError) else str(e))
+        response = disk_payload_response(dataset)
+        if response is None:
+            raise RuntimeError(reason) from e
+        logging.warning(f"[api] {dataset} отдан с диска: {reason}")
+        return response
+
+
 @app.route("/ping", methods=["GET"])
 def ping():
     """
@@ -41,6 +205,35 @@ def segment():
     """
     Получить сегментированных клиентов
     ---
+    description: >
+      Без параметров возвращает все сегменты одним массивом, потоком по кускам;
+      с заголовком Accept: application/x-ndjson — по записи на строку,
+      application/vnd.apache.arrow.stream — Arrow IPC (segment и Churn_Risk словарями),
+      application/msgpack — массив MessagePack.
+      С любым из параметров segment, churn_risk, limit, cursor возвращает страницу
+      {"items": [...], "total": N, "next_cursor": M}; следующая страница
+      запрашивается с cursor=next_cursor, пока он не станет null.
+      Если Redis недоступен или не ответил за REDIS_READ_BUDGET_SECONDS, полная выдача
+      отдаётся в JSON из копии на диске (заголовок X-Served-From: disk).
+    parameters:
+      - name: segment
+        in: query
+        type: string
+        description: Сегмент, например "A_X"
+      - name: churn_risk
+        in: query
+        type: string
+        enum: ["High_risk", "Avg_risg", "Low_risk"]
+      - name: limit
+        in: query
+        type: integer
+        default: 1000
+        description: Размер страницы (не больше 10000)
+      - name: cursor
+        in: query
+        type: integer
+        default: 0
+        description: Курсор из next_cursor предыдущей страницы
     responses:
       200:
         description: JSON с данными сегментов клиентов
@@ -100,26 +293,334 @@ def segment():
               segment_description:
                 type: string
                 example: "Клиенты с одной покупкой, низкий денежный объем."
+      304:
+        description: Данные не изменились (If-None-Match / If-Modified-Since)
+      400:
+        description: Некорректные limit или cursor
       500:
         description: Ошибка Redis или парсинга
     """
+    if any(name in request.args for name in ("segment", "churn_risk", "limit", "cursor")):
+        return segments_page()
+
+    try:
+        return served_payload("segments")
+    except Exception as e:
+        return jsonify({"error": f"Ошибка чтения сегментов: {str(e)}"}), 500
+
+
+def segments_page():
+    try:
+        limit = int(request.args.get("limit", SEGMENTS_DEFAULT_LIMIT))
+        cursor = int(request.args.get("cursor", 0))
+    except ValueError:
+        return jsonify({"error": "limit и cursor должны быть целыми числами"}), 400
+    if not 1 <= limit <= SEGMENTS_MAX_LIMIT or cursor < 0:
+        return jsonify({"error": f"Ожидается 1 <= limit <= {SEGMENTS_MAX_LIMIT} и cursor >= 0"}), 400
+
+    try:
+        page = get_segments_page(request.args.get("segment"), request.args.get("churn_risk"), cursor, limit)
+    except Exception as e:
+        return jsonify({"error": f"Ошибка чтения сегментов: {str(e)}"}), 500
+
+    # Записи уже лежат в Redis как JSON — склеиваем без повторной сериализации
+    body = (f'{{"items":[{",".join(page["items"])}],"total":{page["total"]},'
+            f'"next_cursor":{json.dumps(page["next_cursor"])}}}')
+    return Response(body, mimetype='application/json')
+
+
+def customer_record(customer_id, raw_record):
+    # Добавляем id в уже сериализованную запись, не разбирая JSON
+    return f'{{"customer_unique_id":{json.dumps(customer_id)},{raw_record[1:]}'
+
+
+@app.route("/segments/<customer_unique_id>", methods=["GET"])
+def get_customer_segment(customer_unique_id):
+    """
+    Сегмент одного клиента
+    ---
+    parameters:
+      - name: customer_unique_id
+        in: path
+        type: string
+        required: true
+    responses:
+      200:
+        description: Сегмент, риск оттока и координаты клиента
+        schema:
+          type: object
+          properties:
+            customer_unique_id:
+              type: string
+              example: "317cfc692e3f86c45c95697c61c853a6"
+            Churn_Risk:
+              type: string
+              example: "High_risk"
+            segment:
+              type: string
+              example: "C_Single Purchase"
+      404:
+        description: Клиент не найден
+      500:
+        description: Ошибка Redis
+    """
+    try:
+        raw_record = get_customer_segments([customer_unique_id])[customer_unique_id]
+    except Exception as e:
+        return jsonify({"error": f"Ошибка чтения сегментов: {str(e)}"}), 500
+    if raw_record is None:
+        return jsonify({"error": "Клиент не найден"}), 404
+    return Response(customer_record(customer_unique_id, raw_record), mimetype='application/json')
+
+
+@app.route("/segments/lookup", methods=["POST"])
+def lookup_customer_segments():
+    """
+    Сегменты списка клиентов
+    ---
+    parameters:
+      - name: body
+        in: body
+        required: true
+        schema:
+          type: object
+          properties:
+            ids:
+              type: array
+              items:
+                type: string
+              example: ["317cfc692e3f86c45c95697c61c853a6"]
+    responses:
+      200:
+        description: Найденные записи и id, которых нет в сегментах
+        schema:
+          type: object
+          properties:
+            items:
+              type: array
+              items:
+                type: object
+            missing:
+              type: array
+              items:
+                type: string
+      400:
+        description: Нет списка ids или в нём больше 5000 id
+      500:
+        description: Ошибка Redis
+    """
+    payload = request.get_json(silent=True) or {}
+    customer_ids = payload.get("ids")
+    if not isinstance(customer_ids, list) or not all(isinstance(i, str) for i in customer_ids):
+        return jsonify({"error": "Ожидается {\"ids\": [строки]}"}), 400
+    if len(customer_ids) > SEGMENTS_LOOKUP_MAX_IDS:
+        return jsonify({"error": f"Не больше {SEGMENTS_LOOKUP_MAX_IDS} id за запрос"}), 400
+
+    try:
+        records = get_customer_segments(dict.fromkeys(customer_ids))
+    except Exception as e:
+        return jsonify({"error": f"Ошибка чтения сегментов: {str(e)}"}), 500
+
+    items = ",".join(customer_record(i, raw) for i, raw in records.items() if raw is not None)
+    missing = [i for i, raw in records.items() if raw is None]
+    body = f'{{"items":[{items}],"missing":{json.dumps(missing)}}}'
+    return Response(body, mimetype='application/json')
+
+
+# Самый большой радиус поиска по области — половина экватора
+SEGMENTS_AREA_MAX_RADIUS_KM = 20000
+
+
+def parse_area():
+    """Область из параметров запроса: ({"bbox": ...} или {"center": ..., "radius_km": ...}, ошибка)."""
+    try:
+        if "bbox" in request.args:
+            bbox = [float(v) for v in request.args["bbox"].split(",")]
+            if len(bbox) != 4:
+                raise ValueError
+            min_lng, min_lat, max_lng, max_lat = bbox
+            if not (-180 <= min_lng <= max_lng <= 180 and -90 <= min_lat <= max_lat <= 90):
+                return None, "Ожидается bbox=min_lng,min_lat,max_lng,max_lat в градусах, min <= max"
+            return {"bbox": tuple(bbox)}, None
+        lat, lng = float(request.args["lat"]), float(request.args["lng"])
+        radius_km = float(request.args["radius_km"])
+    except (KeyError, ValueError):
+        return None, "Ожидается bbox=min_lng,min_lat,max_lng,max_lat или lat, lng и radius_km"
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180 and 0 < radius_km <= SEGMENTS_AREA_MAX_RADIUS_KM):
+        return None, f"Ожидаются координаты в градусах и 0 < radius_km <= {SEGMENTS_AREA_MAX_RADIUS_KM}"
+    return {"center": (lng, lat), "radius_km": radius_km}, None
+
+
+@app.route("/segments/area", methods=["GET"])
+def get_segments_area():
+    """
+    Сегменты клиентов в области карты
+    ---
+    description: >
+      Клиенты, чьи координаты попадают в прямоугольник bbox или в круг lat/lng/radius_km,
+      ближние к центру области первыми. Поиск идёт по GEO-индексу текущей версии сегментов.
+    parameters:
+      - name: bbox
+        in: query
+        type: string
+        description: min_lng,min_lat,max_lng,max_lat, например "-46.8,-23.7,-46.4,-23.4"
+      - name: lat
+        in: query
+        type: number
+      - name: lng
+        in: query
+        type: number
+      - name: radius_km
+        in: query
+        type: number
+      - name: limit
+        in: query
+        type: integer
+        default: 1000
+        description: Сколько записей вернуть (не больше 10000)
+    responses:
+      200:
+        description: '{"items": [...], "total": N} — total считает всех клиентов в области'
+      400:
+        description: Не задана область или некорректный limit
+      500:
+        description: Ошибка Redis
+    """
+    area, error = parse_area()
+    if error:
+        return jsonify({"error": error}), 400
+    try:
+        limit = int(request.args.get("limit", SEGMENTS_DEFAULT_LIMIT))
+    except ValueError:
+        limit = 0
+    if not 1 <= limit <= SEGMENTS_MAX_LIMIT:
+        return jsonify({"error": f"Ожидается 1 <= limit <= {SEGMENTS_MAX_LIMIT}"}), 400
 
     try:
-        raw_json = get_segments_json_from_redis()
-        logging.info(f"Размер JSON в байтах: {sys.getsizeof(raw_json)}")
-        return Response(raw_json, mimetype='application/json')
+        found = get_segments_in_area(limit=limit, **area)
     except Exception as e:
         return jsonify({"error": f"Ошибка чтения сегментов: {str(e)}"}), 500
 
+    body = f'{{"items":[{",".join(found["items"])}],"total":{found["total"]}}}'
+    return Response(body, mimetype='application/json')
+
+
+# Что можно пересчитать через /reload
+RELOAD_TARGETS = {"all": LEAVES, **{leaf: [leaf] for leaf in LEAVES}}
+
+
+def query_flag(name):
+    return request.args.get(name, "0").lower() in ("1", "true", "yes")
+
+
+def refresh_response(leaves, message):
+    mode = request.args.get("mode", "full")
+    if mode not in ("full", "incremental"):
+        return jsonify({"error": f"Неизвестный режим: {mode}"}), 400
+    try:
+        submitted = submit_refresh(leaves, incremental=(mode == "incremental"),
+                                   profile=query_flag("profile"), trace_memory=query_flag("memory"))
+    except Exception as e:
+        return jsonify({"error": f"Не удалось поставить задачу: {str(e)}"}), 500
+    if submitted["coalesced"]:
+        message = "Пересчёт уже выполняется, возвращена текущая задача"
+    return {"status": "ok", "message": message, **submitted}
+
+
+@app.route("/reload", methods=["POST"])
+def reload_data():
+    """
+    Пересчёт сегментов, когорт и/или таймлайна в фоне
+    ---
+    description: >
+      Один пересчёт на лист: если лист уже пересчитывается (задача поставлена или
+      выполняется), запрос присоединяется к этой задаче и возвращает её task_id;
+      новая задача ставится только для свободных листов и стартует с задержкой
+      REFRESH_DEBOUNCE_SECONDS, собирая повторные запросы за это время.
+    parameters:
+      - name: target
+        in: query
+        type: string
+        enum: ["all", "segments", "cohort", "timeline"]
+        default: all
+      - name: mode
+        in: query
+        type: string
+        enum: ["full", "incremental"]
+        default: full
+        description: incremental — учесть только заказы новее последнего пересчёта (сегменты)
+      - name: profile
+        in: query
+        type: boolean
+        default: false
+        description: Профилировать прогон (cProfile), результат — /profiles/<task_id>
+      - name: memory
+        in: query
+        type: boolean
+        default: false
+        description: С profile — дополнительно пик памяти каждого этапа (tracemalloc)
+    responses:
+      200:
+        description: Задача поставлена или найдена уже выполняющаяся
+        schema:
+          type: object
+          properties:
+            status:
+              type: string
+              example: "ok"
+            message:
+              type: string
+              example: "Запущена фоновая задача пересчёта"
+            task_id:
+              type: string
+              example: "b66fc3a9-932e-4d9f-8438-f7bdf80e09ac"
+            coalesced:
+              type: boolean
+              description: true — новая задача не ставилась, все листы уже пересчитываются
+            tasks:
+              type: object
+              description: Задача, пересчитывающая каждый лист
+              example: {"segments": "b66fc3a9-932e-4d9f-8438-f7bdf80e09ac"}
+            profiled:
+              type: boolean
+              description: Новая задача профилируется (при присоединении к выполняющейся — false)
+      400:
+        description: Неизвестные target или mode
+      500:
+        description: Ошибка Redis или брокера
+    """
+    target = request.args.get("target", "all")
+    if target not in RELOAD_TARGETS:
+        return jsonify({"error": f"Неизвестная цель: {target}"}), 400
+    return refresh_response(RELOAD_TARGETS[target], "Запущена фоновая задача пересчёта")
+
 
 @app.route("/reload_segments", methods=["POST"])
 def reload_segments():
     """
     Перезапуск сегментации в фоне
     ---
+    description: То же, что /reload?target=segments.
+    parameters:
+      - name: mode
+        in: query
+        type: string
+        enum: ["full", "incremental"]
+        default: full
+        description: incremental — учесть только заказы новее последнего пересчёта
+      - name: profile
+        in: query
+        type: boolean
+        default: false
+        description: Профилировать прогон (cProfile), результат — /profiles/<task_id>
+      - name: memory
+        in: query
+        type: boolean
+        default: false
+        description: С profile — дополнительно пик памяти каждого этапа (tracemalloc)
     responses:
       200:
-        description: Запущена фоновая задача
+        description: Запущена фоновая задача или возвращена уже выполняющаяся
         schema:
           type: object
           properties:
@@ -132,13 +633,12 @@ def reload_segments():
             task_id:
               type: string
               example: "b66fc3a9-932e-4d9f-8438-f7bdf80e09ac"
+            coalesced:
+              type: boolean
+            profiled:
+              type: boolean
     """
-    task = run_segmentation.delay()
-    return {
-        "status": "ok",
-        "message": "Запущена фоновая задача сегментации",
-        "task_id": task.id,
-    }
+    return refresh_response(["segments"], "Запущена фоновая задача сегментации")
 
 @app.route("/status/<task_id>", methods=["GET"])
 def get_status(task_id):
@@ -152,16 +652,114 @@ def get_status(task_id):
         required: true
     responses:
       200:
-        description: Статус задачи
+        description: >
+          Статус задачи; во время пересчёта state = PROGRESS, а progress содержит
+          текущий этап DAG, число завершённых этапов и листьев
+        schema:
+          type: object
+          properties:
+            state:
+              type: string
+              example: "PROGRESS"
+            progress:
+              type: object
+              example: {"stage": "customer_totals", "status": "running", "stages_done": 2,
+                        "leaves": ["segments", "cohort", "timeline"], "leaves_done": 0}
     """
-    result = AsyncResult(task_id)
+    result = AsyncResult(task_id, app=celery_app)
     return jsonify({
         "state": result.state,
         "ready": result.ready(),
         "successful": result.successful(),
+        "progress": result.info if result.state == "PROGRESS" else None,
         "result": str(result.result) if result.ready() else None
     })
 
+@app.route("/profiles/<task_id>", methods=["GET"])
+def get_task_profile(task_id):
+    """
+    Горячие функции профилированного пересчёта
+    ---
+    description: >
+      Доступно для задач, запущенных с profile=1 (/reload, /reload_segments или kwarg задачи),
+      в течение PROFILE_TTL_SECONDS. Полная статистика cProfile — в файле path на воркере.
+    parameters:
+      - name: task_id
+        in: path
+        type: string
+        required: true
+      - name: sort
+        in: query
+        type: string
+        enum: ["cumulative", "tottime"]
+        default: cumulative
+        description: cumulative — с учётом вызываемых функций, tottime — собственное время
+      - name: limit
+        in: query
+        type: integer
+        default: 20
+    responses:
+      200:
+        description: Горячие функции и отчёт по этапам (с traced_peak_mb при memory=1)
+        schema:
+          type: object
+          properties:
+            task_id:
+              type: string
+            leaves:
+              type: array
+              items:
+                type: string
+              example: ["segments"]
+            total_calls:
+              type: integer
+              example: 2841377
+            trace_memory:
+              type: boolean
+            hotspots:
+              type: array
+              items:
+                type: object
+                properties:
+                  function:
+                    type: string
+                    example: "segmentation_tasks/join_plan.py:116(build_order_frame)"
+                  calls:
+                    type: integer
+                  tottime:
+                    type: number
+                  cumtime:
+                    type: number
+            stages:
+              type: array
+              items:
+                type: object
+            path:
+              type: string
+              example: "research/clean_data/_snapshot/profiles/b66fc3a9-932e-4d9f-8438-f7bdf80e09ac.prof"
+      400:
+        description: Неверные sort или limit
+      404:
+        description: Профиля нет (задача не профилировалась, ещё выполняется или профиль устарел)
+    """
+    sort = request.args.get("sort", "cumulative")
+    try:
+        limit = int(request.args.get("limit", 20))
+    except ValueError:
+        return jsonify({"error": "limit должен быть целым числом"}), 400
+    if sort not in ("cumulative", "tottime") or limit < 1:
+        return jsonify({"error": "sort: cumulative или tottime, limit >= 1"}), 400
+
+    try:
+        profile = get_profile(task_id)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+    if profile is None:
+        return jsonify({"error": f"Профиль задачи {task_id} не найден"}), 404
+
+    hotspots = profile.pop("hotspots")
+    return jsonify({**profile, "sort": sort, "hotspots": hotspots[sort][:limit]})
+
 @app.route("/segments/meta", methods=["GET"])
 def get_segments_meta():
     """
@@ -189,6 +787,31 @@ def get_latest_cohort_result():
     """
     Получить последние когортные данные
     ---
+    description: >
+      Таблицы когорт разреженные — {"columns": [...], "data": [[...], ...]}, только
+      существующие пары когорта × смещение; cohort_index — разница календарных месяцев
+      между заказом и первым заказом клиента, retention — доля клиентов когорты (смещение 0).
+      По заголовку Accept также отдаётся Arrow IPC (application/vnd.apache.arrow.stream —
+      длинная таблица customer_state, cohort_month, cohort_index, customers, retention;
+      пустой customer_state — все штаты) и MessagePack (application/msgpack — та же
+      структура, что и JSON).
+      С любым из параметров state, from, to возвращается JSON-срез: только когорты
+      с месяцем в [from, to] и, если задан state, regional_cohort только этого штата.
+      Если Redis недоступен или не ответил за REDIS_READ_BUDGET_SECONDS, полная выдача
+      отдаётся в JSON из копии на диске (заголовок X-Served-From: disk).
+    parameters:
+      - name: state
+        in: query
+        type: string
+        description: Штат, например "SP"
+      - name: from
+        in: query
+        type: string
+        description: Первый месяц когорты, YYYY-MM
+      - name: to
+        in: query
+        type: string
+        description: Последний месяц когорты включительно, YYYY-MM
     responses:
       200:
         description: Успешное получение когортного анализа
@@ -204,40 +827,118 @@ def get_latest_cohort_result():
                 type: string
               example: ["SP", "RJ", "MG"]
             retention:
-              type: array
-              items:
-                type: object
-              example: [{"cohort": "2018-01", "0": 1.0, "1": 0.4}]
+              type: object
+              example: {"columns": ["cohort_month", "cohort_index", "retention"],
+                        "data": [["2018-01", 0, 1.0], ["2018-01", 1, 0.0412]]}
             cohort_data:
-              type: array
-              items:
-                type: object
-              example: [{"cohort": "2018-01", "customer_id": "abc", "month": 0}]
+              type: object
+              example: {"columns": ["cohort_month", "cohort_index", "customers"],
+                        "data": [["2018-01", 0, 7069], ["2018-01", 1, 291]]}
             regional_cohort:
-              type: array
-              items:
-                type: object
-              example: [{"state": "SP", "cohort": "2018-01", "retention": [1.0, 0.6, 0.3]}]
+              type: object
+              example: {"columns": ["customer_state", "cohort_month", "cohort_index", "customers", "retention"],
+                        "data": [["SP", "2018-01", 0, 2980, 1.0], ["SP", "2018-01", 1, 131, 0.044]]}
+      304:
+        description: Данные не изменились (If-None-Match / If-Modified-Since)
       500:
         description: Ошибка получения данных из Redis
     """
+    if any(name in request.args for name in ("state", "from", "to")):
+        return cohort_slice()
+
     try:
-        result = load_cohort_from_redis()
-        return jsonify({
-            "updated_at": result["updated_at"],
-            "state_list": result["state_list"],
-            "retention": result["retention"],
-            "cohort_data": result["cohort_data"],
-            "regional_cohort": result["regional_cohort"]
-        })
+        return served_payload("cohort")
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+
+MONTH_PATTERN = re.compile(r"^\d{4}-(0[1-9]|1[0-2])$")
+
+
+def month_range():
+    """Параметры from/to: (from, to, ошибка)."""
+    month_from, month_to = request.args.get("from") or None, request.args.get("to") or None
+    for value in (month_from, month_to):
+        if value is not None and not MONTH_PATTERN.match(value):
+            return None, None, "from и to ожидаются в формате YYYY-MM"
+    if month_from and month_to and month_from > month_to:
+        return None, None, "from не может быть позже to"
+    return month_from, month_to, None
+
+
+def slice_response(body):
+    # Срез собирается из уже сериализованных строк; ETag — по телу среза
+    response = Response(body, mimetype="application/json")
+    response.add_etag()
+    return response.make_conditional(request)
+
+
+def cohort_slice():
+    month_from, month_to, error = month_range()
+    if error:
+        return jsonify({"error": error}), 400
+
+    try:
+        found = get_cohort_slice(request.args.get("state") or None, month_from, month_to)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+    if found is None:
+        return jsonify({"error": "Данные cohort ещё не закэшированы"}), 500
+
+    tables = ",".join(
+        f'"{table}":{{"columns":{json.dumps(columns)},"data":[{",".join(rows)}]}}'
+        for table, (columns, rows) in found["tables"].items())
+    return slice_response(
+        f'{{"updated_at":{json.dumps(found["updated_at"])},"state_list":{found["state_list"]},{tables}}}')
+
 @app.route("/timeline", methods=["GET"])
 def get_latest_timeline():
     """
     Получить временные данные сегментов и оттока
     ---
+    description: >
+      По заголовку Accept также отдаётся Arrow IPC (application/vnd.apache.arrow.stream —
+      длинная таблица series, order_purchase_timestamp, value, count)
+      и MessagePack (application/msgpack — та же структура, что и JSON).
+      С любым из параметров from, to, segment, churn_risk возвращается JSON-срез:
+      месяцы в [from, to], by_segment — только сегмент segment, by_churn — только churn_risk.
+      С параметром granularity или dimensions возвращается свёртка из предрассчитанного куба
+      (день, неделя, месяц, квартал × сегмент × риск оттока × штат): count (строки, как в сериях),
+      orders (заказы) и monetary (сумма платежей) по периоду и измерениям dimensions;
+      segment, churn_risk и state отбирают строки, from и to — периоды по дате начала
+      (YYYY, YYYY-MM или YYYY-MM-DD). Неделя начинается с понедельника и обозначается его датой.
+      Если Redis недоступен или не ответил за REDIS_READ_BUDGET_SECONDS, полная выдача
+      отдаётся в JSON из копии на диске (заголовок X-Served-From: disk).
+    parameters:
+      - name: from
+        in: query
+        type: string
+        description: Первый месяц, YYYY-MM
+      - name: to
+        in: query
+        type: string
+        description: Последний месяц включительно, YYYY-MM
+      - name: segment
+        in: query
+        type: string
+        description: Код сегмента ("A_X") или его описание
+      - name: churn_risk
+        in: query
+        type: string
+        description: Риск оттока, как в /segments ("High_risk") или в таймлайне ("Высокий риск")
+      - name: granularity
+        in: query
+        type: string
+        enum: ["day", "week", "month", "quarter"]
+        description: Период свёртки (по умолчанию month, если задан dimensions)
+      - name: dimensions
+        in: query
+        type: string
+        description: Измерения свёртки через запятую из segment, churn_risk, state (пусто — только период)
+      - name: state
+        in: query
+        type: string
+        description: Штат клиента для свёртки ("SP")
     responses:
       200:
         description: Успешное получение временных данных
@@ -275,20 +976,236 @@ def get_latest_timeline():
                   count:
                     type: integer
                     example: 2353
+      304:
+        description: Данные не изменились (If-None-Match / If-Modified-Since)
       500:
         description: Ошибка получения данных из Redis
     """
 
+    if any(name in request.args for name in ("granularity", "dimensions")):
+        return timeline_rollup()
+    if any(name in request.args for name in ("from", "to", "segment", "churn_risk")):
+        return timeline_slice()
+
     try:
-        result = load_timeline_from_redis()
+        return served_payload("timeline")
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
 
-        if isinstance(result.get("updated_at"), datetime):
-            result["updated_at"] = result["updated_at"].isoformat()
 
-        json_str = json.dumps(result, ensure_ascii=False)
-        return Response(json_str, content_type="application/json; charset=utf-8")
+# Метки риска оттока из /segments -> метки в таймлайне
+TIMELINE_CHURN_BY_SEGMENT_LABEL = dict(zip(CHURN_LABELS, TIMELINE_CHURN_LABELS))
+
+
+def timeline_slice():
+    month_from, month_to, error = month_range()
+    if error:
+        return jsonify({"error": error}), 400
+    segment = request.args.get("segment") or None
+    churn_risk = request.args.get("churn_risk") or None
+
+    try:
+        found = get_timeline_slice(
+            month_from, month_to,
+            segment=SEGMENT_DESCRIPTIONS.get(segment, segment),
+            churn_risk=TIMELINE_CHURN_BY_SEGMENT_LABEL.get(churn_risk, churn_risk))
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+    if found is None:
+        return jsonify({"error": "Данные timeline ещё не закэшированы"}), 500
+
+    return slice_response(
+        f'{{"by_churn":[{",".join(found["by_churn"])}],"by_segment":[{",".join(found["by_segment"])}],'
+        f'"updated_at":{json.dumps(found["updated_at"])}}}')
+
+
+# Измерения свёртки таймлайна: параметр запроса -> колонка куба
+ROLLUP_DIMENSION_PARAMS = {"segment": "segment_description", "churn_risk": "Churn_Risk", "state": "customer_state"}
+PERIOD_PATTERN = re.compile(r"^\d{4}(-(0[1-9]|1[0-2])(-(0[1-9]|[12]\d|3[01]))?)?$")
+
+
+def timeline_rollup():
+    level = request.args.get("granularity") or "month"
+    if level not in ROLLUP_LEVELS:
+        return jsonify({"error": f"granularity ожидается одним из {ROLLUP_LEVELS}"}), 400
+    params = [name for name in (request.args.get("dimensions") or "").split(",") if name]
+    unknown = [name for name in params if name not in ROLLUP_DIMENSION_PARAMS]
+    if unknown:
+        return jsonify({"error": f"Неизвестные измерения {unknown}, допустимы {list(ROLLUP_DIMENSION_PARAMS)}"}), 400
+    period_from, period_to = request.args.get("from") or None, request.args.get("to") or None
+    for value in (period_from, period_to):
+        if value is not None and not PERIOD_PATTERN.match(value):
+            return jsonify({"error": "from и to ожидаются в формате YYYY, YYYY-MM или YYYY-MM-DD"}), 400
+
+    filters = {}
+    if request.args.get("segment"):
+        segment = request.args["segment"]
+        filters["segment_description"] = SEGMENT_DESCRIPTIONS.get(segment, segment)
+    if request.args.get("churn_risk"):
+        churn_risk = request.args["churn_risk"]
+        filters["Churn_Risk"] = TIMELINE_CHURN_BY_SEGMENT_LABEL.get(churn_risk, churn_risk)
+    if request.args.get("state"):
+        filters["customer_state"] = request.args["state"]
+
+    try:
+        found = get_timeline_rollup(level)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
+    if found is None:
+        return jsonify({"error": "Данные timeline ещё не закэшированы"}), 500
+
+    dimensions = list(dict.fromkeys(ROLLUP_DIMENSION_PARAMS[name] for name in params))
+    # Готовый ответ кэшируется вместе с разобранным кубом до смены версии timeline
+    cache_key = ("timeline", found["version"], "rollup-query:" + json.dumps(
+        [level, dimensions, sorted(filters.items()), period_from, period_to], ensure_ascii=False))
+    body = payload_cache.get(cache_key)
+    if body is None:
+        result = rollup_query(found["cube"], dimensions, filters, period_from, period_to)
+        body = json.dumps({"updated_at": found["updated_at"], "granularity": level, **result}, ensure_ascii=False)
+        payload_cache.put(cache_key, body, len(body))
+    return slice_response(body)
+
+@app.route("/cache/metrics", methods=["GET"])
+def get_cache_metrics():
+    """
+    Счётчики кэша готовых ответов в памяти воркера
+    ---
+    description: Значения относятся к воркеру gunicorn, обработавшему запрос (pid в ответе).
+    responses:
+      200:
+        description: Попадания, промахи и заполненность кэша
+        schema:
+          type: object
+          properties:
+            pid:
+              type: integer
+              example: 12
+            hits:
+              type: integer
+              example: 1520
+            misses:
+              type: integer
+              example: 6
+            hit_ratio:
+              type: number
+              example: 0.9961
+            evictions:
+              type: integer
+              example: 0
+            invalidations:
+              type: integer
+              example: 3
+            entries:
+              type: integer
+              example: 6
+            bytes:
+              type: integer
+              example: 1843200
+            max_bytes:
+              type: integer
+              example: 268435456
+    """
+    return jsonify(payload_cache.stats())
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    """
+    Метрики Prometheus
+    ---
+    description: >
+      Время запросов по маршрутам, команды Redis (время и объём), этапы пайплайнов
+      (время и число строк), длительность задач Celery и ожидание в очереди.
+      При заданном PROMETHEUS_MULTIPROC_DIR значения сведены по всем воркерам gunicorn
+      и каталогам METRICS_EXTRA_DIRS (воркеры Celery).
+    produces:
+      - text/plain
+    responses:
+      200:
+        description: Метрики в текстовом формате Prometheus
+    """
+    body, content_type = metrics.render()
+    return Response(body, content_type=content_type)
+
+@app.route("/snapshots/<dataset>", methods=["GET"])
+def get_snapshots(dataset):
+    """
+    Версии снапшота набора данных в Redis
+    ---
+    parameters:
+      - name: dataset
+        in: path
+        type: string
+        enum: ["segments", "cohort", "timeline"]
+        required: true
+    responses:
+      200:
+        description: Текущая версия и хранимые версии (новые в начале)
+        schema:
+          type: object
+          properties:
+            current:
+              type: string
+              example: "12"
+            versions:
+              type: array
+              items:
+                type: string
+              example: ["12", "11", "10"]
+      404:
+        description: Неизвестный набор данных
+    """
+    if dataset not in SNAPSHOT_DATASETS:
+        return jsonify({"error": f"Неизвестный набор данных: {dataset}"}), 404
+    return jsonify(list_snapshots(dataset))
+
+@app.route("/snapshots/<dataset>/rollback", methods=["POST"])
+def rollback_snapshots(dataset):
+    """
+    Откат набора данных на предыдущую версию
+    ---
+    parameters:
+      - name: dataset
+        in: path
+        type: string
+        enum: ["segments", "cohort", "timeline"]
+        required: true
+    responses:
+      200:
+        description: Указатель переключён, текущая версия удалена, копия на диске снята
+        schema:
+          type: object
+          properties:
+            from:
+              type: string
+              example: "12"
+            to:
+              type: string
+              example: "11"
+            disk:
+              type: string
+              enum: ["invalidated", "missing", "error"]
+              description: Копия на диске снята (больше не отдаётся и не восстанавливается в Redis)
+      404:
+        description: Неизвестный набор данных
+      409:
+        description: Нет предыдущей версии
+    """
+    if dataset not in SNAPSHOT_DATASETS:
+        return jsonify({"error": f"Неизвестный набор данных: {dataset}"}), 404
+    try:
+        result = rollback_snapshot(dataset)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 409
+
+    # Копия на диске — это снятая версия: её нельзя отдавать из резервного пути
+    # и восстанавливать в Redis при тёплом старте
+    try:
+        invalidated = disk_snapshot.invalidate(dataset, f"откат версии {result['from']} -> {result['to']}")
+        result["disk"] = "invalidated" if invalidated else "missing"
+    except OSError as e:
+        logging.warning(f"[api] не удалось снять копию {dataset} на диске после отката: {e}")
+        result["disk"] = "error"
+    return jsonify(result)
 
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=8000)
\ No newline at end of file
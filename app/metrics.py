@@ -0,0 +1,169 @@
+import glob
+import os
+import shutil
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest)
+from prometheus_client.multiprocess import MultiProcessCollector
+
+# Метрики Prometheus для API, воркеров Celery и этапов пайплайна.
+# Воркеры gunicorn и процессы пула Celery — отдельные процессы, поэтому при заданном
+# PROMETHEUS_MULTIPROC_DIR каждый пишет значения в свои файлы в этом каталоге,
+# а /metrics собирает их все. Каталоги других компонентов (воркеров Celery
+# на общем томе) перечисляются в METRICS_EXTRA_DIRS и выдаются тем же /metrics.
+
+MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+METRICS_EXTRA_DIRS = [d for d in os.getenv("METRICS_EXTRA_DIRS", "").split(",") if d]
+# Кто пишет метрики: api или worker (метка у общих для них метрик Redis)
+METRICS_COMPONENT = os.getenv("METRICS_COMPONENT", "api")
+
+if MULTIPROC_DIR:
+    os.makedirs(MULTIPROC_DIR, exist_ok=True)
+
+BYTES_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216, 67108864)
+STAGE_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+TASK_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+HTTP_REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds", "Время обработки запроса до отправки заголовков ответа",
+    ["method", "route", "status"])
+REDIS_CALL_SECONDS = Histogram(
+    "redis_call_duration_seconds", "Время команды или конвейера Redis",
+    ["component", "command"], buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5))
+REDIS_PAYLOAD_BYTES = Histogram(
+    "redis_payload_bytes", "Объём данных команды или конвейера Redis (sent — аргументы, received — ответ)",
+    ["component", "command", "direction"], buckets=BYTES_BUCKETS)
+STAGE_SECONDS = Histogram(
+    "pipeline_stage_duration_seconds", "Время этапа пайплайна без вложенных этапов",
+    ["stage"], buckets=STAGE_BUCKETS)
+STAGE_ROWS = Gauge(
+    "pipeline_stage_rows", "Число строк результата этапа в последнем прогоне",
+    ["stage"], multiprocess_mode="mostrecent")
+CELERY_TASK_SECONDS = Histogram(
+    "celery_task_duration_seconds", "Время выполнения задачи Celery",
+    ["task", "state"], buckets=TASK_BUCKETS)
+CELERY_QUEUE_WAIT_SECONDS = Histogram(
+    "celery_task_queue_wait_seconds", "Ожидание задачи в очереди: от постановки (или ETA) до старта",
+    ["task"], buckets=TASK_BUCKETS)
+CELERY_TASKS = Counter(
+    "celery_tasks", "Завершённые задачи Celery", ["task", "state"])
+
+
+def reset_multiproc_dir():
+    """
+    Очищает каталог метрик компонента перед стартом процессов
+    (gunicorn on_starting, worker_init Celery): файлы прошлого запуска не суммируются с новыми.
+    """
+    if not MULTIPROC_DIR:
+        return
+    shutil.rmtree(MULTIPROC_DIR, ignore_errors=True)
+    os.makedirs(MULTIPROC_DIR, exist_ok=True)
+
+
+class _SharedDirsCollector:
+    """Значения из файлов всех каталогов метрик, сведённые как в MultiProcessCollector."""
+
+    def __init__(self, paths):
+        self.paths = paths
+
+    def collect(self):
+        files = [f for path in self.paths for f in glob.glob(os.path.join(path, "*.db"))]
+        return MultiProcessCollector.merge(files, accumulate=True)
+
+
+def render():
+    """(тело, content type) для /metrics."""
+    if not MULTIPROC_DIR:
+        return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
+    registry = CollectorRegistry()
+    registry.register(_SharedDirsCollector([MULTIPROC_DIR] + METRICS_EXTRA_DIRS))
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+def observe_request(method, route, status, seconds):
+    HTTP_REQUEST_SECONDS.labels(method, route, str(status)).observe(seconds)
+
+
+def payload_size(value):
+    """Объём ответа Redis: длина строк (для str — в символах) во вложенных списках и словарях."""
+    if isinstance(value, (bytes, str)):
+        return len(value)
+    if isinstance(value, (list, tuple)):
+        return sum(payload_size(item) for item in value)
+    if isinstance(value, dict):
+        return sum(payload_size(k) + payload_size(v) for k, v in value.items())
+    return 0
+
+
+def observe_redis(command, seconds, sent, received):
+    REDIS_CALL_SECONDS.labels(METRICS_COMPONENT, command).observe(seconds)
+    REDIS_PAYLOAD_BYTES.labels(METRICS_COMPONENT, command, "sent").observe(sent)
+    REDIS_PAYLOAD_BYTES.labels(METRICS_COMPONENT, command, "received").observe(received)
+
+
+def observe_stage(stage, seconds, rows=None):
+    STAGE_SECONDS.labels(stage).observe(seconds)
+    if rows is not None:
+        STAGE_ROWS.labels(stage).set(rows)
+
+
+@contextmanager
+def stage_timer(stage):
+    """
+    Замер части этапа: with stage_timer("merge") as result: ...; result["rows"] = len(df).
+    """
+    result = {"rows": None}
+    started = time.perf_counter()
+    yield result
+    observe_stage(stage, time.perf_counter() - started, result["rows"])
+
+
+# =====================
+# Celery
+# =====================
+# Время постановки пишется в заголовок сообщения при публикации,
+# воркер сравнивает его (или ETA задачи с задержкой) со временем старта.
+
+PUBLISHED_AT_HEADER = "published_at"
+_task_started = {}
+
+
+def _on_publish(headers=None, **kwargs):
+    if headers is not None:
+        headers.setdefault(PUBLISHED_AT_HEADER, time.time())
+
+
+def _on_prerun(task_id=None, task=None, **kwargs):
+    now = time.time()
+    _task_started[task_id] = time.perf_counter()
+    published_at = task.request.get(PUBLISHED_AT_HEADER)
+    if published_at is None:
+        return
+    ready_at = float(published_at)
+    if task.request.eta:
+        eta = datetime.fromisoformat(str(task.request.eta))
+        if eta.tzinfo is None:
+            eta = eta.replace(tzinfo=timezone.utc)
+        ready_at = max(ready_at, eta.timestamp())
+    CELERY_QUEUE_WAIT_SECONDS.labels(task.name).observe(max(0.0, now - ready_at))
+
+
+def _on_postrun(task_id=None, task=None, state=None, **kwargs):
+    started = _task_started.pop(task_id, None)
+    if started is None:
+        return
+    CELERY_TASK_SECONDS.labels(task.name, state or "UNKNOWN").observe(time.perf_counter() - started)
+    CELERY_TASKS.labels(task.name, state or "UNKNOWN").inc()
+
+
+def connect_celery_signals():
+    """Подключает метрики задач к сигналам Celery (публикация — в API, старт и завершение — в воркере)."""
+    from celery import signals
+
+    signals.before_task_publish.connect(_on_publish, weak=False)
+    signals.task_prerun.connect(_on_prerun, weak=False)
+    signals.task_postrun.connect(_on_postrun, weak=False)
+    signals.worker_init.connect(lambda **kwargs: reset_multiproc_dir(), weak=False)
@@ -0,0 +1,81 @@
+import os
+import threading
+from collections import OrderedDict
+
+# Кэш готовых ответов в памяти воркера gunicorn.
+# Ключ содержит версию снапшота, а версии в Redis неизменяемы, поэтому
+# устаревших значений в кэше не бывает: при каждом запросе проверяется только
+# указатель версии (один короткий GET), а тело ответа и ETag берутся из памяти.
+# При смене версии набора записи прежних версий этого набора удаляются.
+
+PAYLOAD_CACHE_MAX_BYTES = int(os.getenv("PAYLOAD_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+
+
+class LRUCache:
+    """LRU-кэш с ограничением по суммарному размеру значений в байтах."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._items = OrderedDict()
+        self._bytes = 0
+        self._versions = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def put(self, key, value, size):
+        # Значения больше всего кэша не сохраняются, чтобы не вытеснить остальное
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._items.pop(key, None)
+            if previous is not None:
+                self._bytes -= previous[1]
+            self._items[key] = (value, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, evicted_size) = self._items.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+
+    def observe_version(self, dataset, version):
+        """Запоминает текущую версию набора и удаляет записи других его версий."""
+        with self._lock:
+            if self._versions.get(dataset) == version:
+                return
+            self._versions[dataset] = version
+            stale = [key for key in self._items if key[0] == dataset and key[1] != version]
+            for key in stale:
+                self._bytes -= self._items.pop(key)[1]
+            self.invalidations += len(stale)
+
+    def stats(self):
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                "pid": os.getpid(),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / requests, 4) if requests else None,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "entries": len(self._items),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "versions": dict(self._versions),
+            }
+
+
+payload_cache = LRUCache(PAYLOAD_CACHE_MAX_BYTES)
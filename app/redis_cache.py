@@ -1,100 +1,939 @@
+from __future__ import annotations
+
+import bisect
+import gzip
+import hashlib
+import math
+import os
+import time
+import zlib
 import redis
 import json
-import pandas as pd
 from datetime import datetime
-from typing import List
+from operator import itemgetter
+from typing import TYPE_CHECKING
+
+import wire_formats
+from metrics import observe_redis, payload_size, stage_timer
+from payload_cache import payload_cache
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+try:
+    import brotli
+except ImportError:  # brotli — в requirements.txt; без него отдаются только gzip и несжатый ответ
+    brotli = None
+
+
+def _args_size(args):
+    return sum(len(a) for a in args if isinstance(a, (bytes, str)))
+
+
+class InstrumentedPipeline(redis.client.Pipeline):
+    """Конвейер, время и объём которого попадают в метрики одной записью (MULTI или PIPELINE)."""
+
+    def execute(self, raise_on_error=True):
+        command = "MULTI" if self.transaction else "PIPELINE"
+        sent = sum(_args_size(args) for args, _ in self.command_stack)
+        started = time.perf_counter()
+        result = None
+        try:
+            result = super().execute(raise_on_error)
+            return result
+        finally:
+            observe_redis(command, time.perf_counter() - started, sent, payload_size(result))
+
+
+class InstrumentedRedis(redis.Redis):
+    """Клиент Redis с метриками времени и объёма каждой команды (см. metrics)."""
+
+    def execute_command(self, *args, **options):
+        started = time.perf_counter()
+        result = None
+        try:
+            result = super().execute_command(*args, **options)
+            return result
+        finally:
+            observe_redis(str(args[0]).upper(), time.perf_counter() - started,
+                          _args_size(args[1:]), payload_size(result))
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+REDIS_HOST = os.getenv("REDIS_HOST", "redis")
+REDIS_PORT = int(os.getenv("REDIS_PORT", "6379"))
+# Соединений на процесс у каждого клиента. Потоки воркера (gthread/gevent) делят пул;
+# когда все соединения заняты, запрос ждёт свободное до REDIS_POOL_TIMEOUT секунд,
+# а не открывает новые соединения без ограничения
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", "16"))
+REDIS_POOL_TIMEOUT = float(os.getenv("REDIS_POOL_TIMEOUT", "5"))
+
+
+def _pool(**kwargs):
+    return redis.BlockingConnectionPool(host=REDIS_HOST, port=REDIS_PORT, db=0,
+                                        max_connections=REDIS_MAX_CONNECTIONS,
+                                        timeout=REDIS_POOL_TIMEOUT, **kwargs)
+
+
+r = InstrumentedRedis(connection_pool=_pool(decode_responses=True))
+# Бинарный клиент: сжатые ответы читаются как есть, без декодирования
+rb = InstrumentedRedis(connection_pool=_pool())
+
+# =====================
+# Версионированные снапшоты
+# =====================
+# Каждая запись набора данных (segments, cohort, timeline) пишется в новую версию:
+#   <набор>:v:<версия>:<имя>   — ключи данных версии
+#   <набор>:v:<версия>:keys    — set всех ключей версии (для удаления)
+#   <набор>:current            — указатель на опубликованную версию
+#   <набор>:versions           — list версий, новые в начале
+#   <набор>:version_seq        — счётчик номеров версий
+# Данные версии пишутся конвейером, пока на неё никто не ссылается, затем
+# указатель переключается одной транзакцией. Читатель один раз получает указатель
+# и читает все ключи версии одним MGET, поэтому не видит смесь двух пересчётов.
+
+SNAPSHOT_DATASETS = ("segments", "cohort", "timeline")
+# Сколько опубликованных версий хранить (текущая + предыдущие для отката)
+SNAPSHOT_RETENTION = max(1, int(os.getenv("SNAPSHOT_RETENTION", "3")))
+# Сколько раз перечитывать, если версия удалена между чтением указателя и данных
+SNAPSHOT_READ_ATTEMPTS = 3
+
+
+def snapshot_key(dataset, version, name):
+    return f"{dataset}:v:{version}:{name}"
+
+
+def _pointer_key(dataset):
+    return f"{dataset}:current"
+
+
+def _versions_key(dataset):
+    return f"{dataset}:versions"
+
+
+def current_version(dataset):
+    return r.get(_pointer_key(dataset))
+
+
+def publish_snapshot(dataset, write) -> str:
+    """
+    Пишет новую версию набора и переключает на неё указатель.
+    write(pipe, key) добавляет команды записи в конвейер,
+    key(name) возвращает полный ключ версии для имени.
+    """
+    version = str(r.incr(f"{dataset}:version_seq"))
+    keys = set()
+
+    def key(name):
+        full_key = snapshot_key(dataset, version, name)
+        keys.add(full_key)
+        return full_key
+
+    # Метрики частей записи: сериализация в конвейер (encode) и отправка в Redis (publish)
+    pipe = r.pipeline(transaction=False)
+    with stage_timer(f"encode:{dataset}") as encoded:
+        write(pipe, key)
+        encoded["rows"] = len(keys)
+    pipe.sadd(snapshot_key(dataset, version, "keys"), *keys)
+
+    with stage_timer(f"publish:{dataset}"):
+        pipe.execute()
+        switch = r.pipeline(transaction=True)
+        switch.set(_pointer_key(dataset), version)
+        switch.lpush(_versions_key(dataset), version)
+        switch.execute()
+
+    gc_snapshots(dataset)
+    return version
+
+
+def _drop_version(dataset, version):
+    keys_key = snapshot_key(dataset, version, "keys")
+    r.delete(keys_key, *r.smembers(keys_key))
+
+
+def gc_snapshots(dataset, retention=SNAPSHOT_RETENTION):
+    """Удаляет версии старше retention последних опубликованных."""
+    trim = r.pipeline(transaction=True)
+    trim.lrange(_versions_key(dataset), retention, -1)
+    trim.ltrim(_versions_key(dataset), 0, retention - 1)
+    stale, _ = trim.execute()
+    for version in stale:
+        _drop_version(dataset, version)
+    return stale
+
+
+def list_snapshots(dataset) -> dict:
+    pipe = r.pipeline(transaction=False)
+    pipe.get(_pointer_key(dataset))
+    pipe.lrange(_versions_key(dataset), 0, -1)
+    current, versions = pipe.execute()
+    return {"current": current, "versions": versions}
+
+
+def rollback_snapshot(dataset) -> dict:
+    """
+    Переключает указатель на предыдущую версию.
+    Текущая версия убирается из списка и удаляется.
+    """
+    snapshots = list_snapshots(dataset)
+    current, versions = snapshots["current"], snapshots["versions"]
+    position = versions.index(current) if current in versions else -1
+    if current is None or position + 1 >= len(versions):
+        raise ValueError(f"Нет предыдущей версии для отката: {dataset}")
+
+    previous = versions[position + 1]
+    switch = r.pipeline(transaction=True)
+    switch.set(_pointer_key(dataset), previous)
+    switch.lrem(_versions_key(dataset), 1, current)
+    switch.execute()
+
+    _drop_version(dataset, current)
+    return {"from": current, "to": previous}
+
+
+def read_snapshot(dataset, names):
+    """
+    Значения ключей names текущей версии одним MGET.
+    Возвращает {имя: значение, "version": версия} или None, если набор не опубликован.
+    """
+    for _ in range(SNAPSHOT_READ_ATTEMPTS):
+        version = current_version(dataset)
+        if version is None:
+            return None
+        values = r.mget([snapshot_key(dataset, version, name) for name in names])
+        if None not in values:
+            result = dict(zip(names, values))
+            result["version"] = version
+            return result
+    raise ValueError(f"Версия {dataset} обновляется, повторите запрос")
+
+
+# =====================
+# Готовые ответы
+# =====================
+# Ответы больших эндпоинтов собираются и сжимаются один раз при записи версии:
+#   body:identity, body:gzip, body:br — тело ответа в каждой кодировке
+#   etag                              — sha1 несжатого тела
+# Большая выдача /segments хранится кусками и отдаётся потоком (см. сегменты).
+# Эндпоинт отдаёт нужную кодировку байт в байт и отвечает 304 по ETag/Last-Modified.
+
+PAYLOAD_ENCODINGS = ["br", "gzip", "identity"] if brotli else ["gzip", "identity"]
+PAYLOAD_GZIP_LEVEL = int(os.getenv("PAYLOAD_GZIP_LEVEL", "9"))
+PAYLOAD_BROTLI_QUALITY = int(os.getenv("PAYLOAD_BROTLI_QUALITY", "9"))
+
+
+def encode_payload(body: bytes) -> dict:
+    encoded = {"identity": body, "gzip": gzip.compress(body, PAYLOAD_GZIP_LEVEL, mtime=0)}
+    if brotli:
+        encoded["br"] = brotli.compress(body, quality=PAYLOAD_BROTLI_QUALITY)
+    return encoded
+
+
+def write_payload(pipe, key, body: str, formats=None):
+    """
+    formats — то же тело в бинарных форматах: {"arrow": bytes, "msgpack": bytes},
+    хранится как body:<формат>.
+    """
+    data = body.encode("utf-8")
+    pipe.set(key("etag"), hashlib.sha1(data).hexdigest())
+    for encoding, value in encode_payload(data).items():
+        pipe.set(key(f"body:{encoding}"), value)
+    for name, value in (formats or {}).items():
+        pipe.set(key(f"body:{name}"), value)
+
+
+# Метаданные готового ответа; выдача сегментов хранится кусками (см. ниже)
+PAYLOAD_META_KEYS = {
+    "segments": ["etag", "updated_at", "chunks"],
+    "cohort": ["etag", "updated_at"],
+    "timeline": ["etag", "updated_at"],
+}
+
+
+def get_payload_meta(dataset):
+    """
+    ETag, updated_at и версия готового ответа (для сегментов ещё число кусков)
+    или None, если набор не опубликован.
+    Из Redis читается только указатель версии, остальное — из кэша воркера.
+    """
+    version = current_version(dataset)
+    if version is None:
+        return None
+    payload_cache.observe_version(dataset, version)
+
+    meta = payload_cache.get((dataset, version, "meta"))
+    if meta is None:
+        meta = read_snapshot(dataset, PAYLOAD_META_KEYS[dataset])
+        if meta is None:
+            return None
+        payload_cache.put((dataset, meta["version"], "meta"), meta,
+                          sum(len(value) for value in meta.values()))
+    return meta
+
+
+def get_payload_body(dataset, version, encoding) -> bytes | None:
+    cache_key = (dataset, version, f"body:{encoding}")
+    body = payload_cache.get(cache_key)
+    if body is None:
+        body = rb.get(snapshot_key(dataset, version, f"body:{encoding}"))
+        if body is not None:
+            payload_cache.put(cache_key, body, len(body))
+    return body
+
+
+# =====================
+# Единственный пересчёт на лист
+# =====================
+#   refresh:lock:<лист> — id задачи, которая сейчас пересчитывает лист (с TTL на случай
+#                         падения воркера). Новый запрос на пересчёт листа, у которого
+#                         уже есть задача, присоединяется к ней, а не ставит ещё одну.
+REFRESH_LOCK_TTL_SECONDS = int(os.getenv("REFRESH_LOCK_TTL_SECONDS", "7200"))
+
+# Занимает свободные ключи (SET EX) и возвращает id задач, держащих каждый ключ
+_CLAIM_SCRIPT = r.register_script("""
+local holders = {}
+for i, key in ipairs(KEYS) do
+  local holder = redis.call('GET', key)
+  if not holder then
+    redis.call('SET', key, ARGV[1], 'EX', ARGV[2])
+    holder = ARGV[1]
+  end
+  holders[i] = holder
+end
+return holders
+""")
+
+# Удаляет ключи, которые всё ещё держит задача ARGV[1]
+_RELEASE_SCRIPT = r.register_script("""
+local released = 0
+for i, key in ipairs(KEYS) do
+  if redis.call('GET', key) == ARGV[1] then
+    redis.call('DEL', key)
+    released = released + 1
+  end
+end
+return released
+""")
+
+
+def _refresh_lock_key(leaf):
+    return f"refresh:lock:{leaf}"
+
+
+def refresh_locks(leaves) -> dict:
+    """
+    {лист: (id задачи, пересчитывающей его сейчас, или None,
+    сколько секунд назад блокировка занята, или None)}; возраст — по оставшемуся TTL ключа.
+    """
+    pipe = r.pipeline(transaction=False)
+    for leaf in leaves:
+        pipe.get(_refresh_lock_key(leaf))
+        pipe.ttl(_refresh_lock_key(leaf))
+    replies = pipe.execute()
+    locks = {}
+    for leaf, holder, ttl in zip(leaves, replies[::2], replies[1::2]):
+        locks[leaf] = (holder, REFRESH_LOCK_TTL_SECONDS - ttl if holder and ttl >= 0 else None)
+    return locks
+
+
+def claim_refresh(leaves, task_id) -> dict:
+    """Атомарно занимает свободные листы за task_id; {лист: id задачи, держащей лист}."""
+    keys = [_refresh_lock_key(leaf) for leaf in leaves]
+    return dict(zip(leaves, _CLAIM_SCRIPT(keys=keys, args=[task_id, REFRESH_LOCK_TTL_SECONDS], client=r)))
+
+
+def release_refresh(leaves, task_id) -> int:
+    """Освобождает листы, которые держит task_id (чужие блокировки не трогает)."""
+    keys = [_refresh_lock_key(leaf) for leaf in leaves]
+    return _RELEASE_SCRIPT(keys=keys, args=[task_id], client=r)
+
+
+# =====================
+# Профили пересчёта
+# =====================
+# Сводка профилирования прогона (горячие функции и отчёт по этапам) хранится
+# под id задачи, чтобы /profiles/<task_id> читал её из API без доступа к диску воркера.
+
+PROFILE_TTL_SECONDS = int(os.getenv("PROFILE_TTL_SECONDS", str(7 * 24 * 3600)))
+
+
+def _profile_key(task_id):
+    return f"profile:{task_id}"
+
+
+def save_profile(task_id, profile: dict):
+    r.set(_profile_key(task_id), json.dumps(profile, ensure_ascii=False), ex=PROFILE_TTL_SECONDS)
+
+
+def get_profile(task_id) -> dict | None:
+    raw = r.get(_profile_key(task_id))
+    return json.loads(raw) if raw else None
+
+
+# =====================
+# Сегменты
+# =====================
+# Раскладка версии сегментов:
+#   chunk:<n>                            — n-й кусок выдачи /segments в NDJSON
+#   body:<gzip|br>:<n>                   — n-й сжатый кусок JSON-массива (кусков chunks + 1)
+#   arrow:head, arrow:<n>, arrow:tail     — та же выдача Arrow IPC потоком (см. wire_formats)
+#   msgpack:head, msgpack:<n>            — та же выдача массивом MessagePack
+#   chunks, etag                         — число кусков и sha1 JSON-массива
+#   updated_at                           — время пересчёта
+#   rows                                 — hash {позиция строки: JSON записи}
+#   index[:segment:<s>][:churn:<c>]      — list позиций строк в порядке выдачи
+#   customer_positions                   — hash {customer_unique_id: позиция строки в rows}
+#   geo                                  — GEO-индекс {позиция строки: координаты клиента}
+SEGMENTS = "segments"
+# Размер пачки команд при записи индекса
+SEGMENT_WRITE_BATCH = 10000
+# Записей в одном куске выдачи /segments
+SEGMENT_CHUNK_SIZE = int(os.getenv("SEGMENT_CHUNK_SIZE", "10000"))
+SEGMENTS_DEFAULT_LIMIT = 1000
+SEGMENTS_MAX_LIMIT = 10000
+# Пакетный поиск по клиентам: максимум id в запросе и размер одного HMGET
+SEGMENTS_LOOKUP_MAX_IDS = 5000
+SEGMENTS_LOOKUP_BATCH = 1000
+# Redis хранит в GEO-индексе только широты в пределах ±85.05112878
+GEO_MAX_LATITUDE = 85.05112878
+# Радиус Земли, которым Redis считает расстояния в GEOSEARCH
+GEO_EARTH_RADIUS_KM = 6372.797560856
+
+
+def segment_index_key(segment=None, churn_risk=None):
+    parts = ["index"]
+    if segment is not None:
+        parts += ["segment", segment]
+    if churn_risk is not None:
+        parts += ["churn", churn_risk]
+    return ":".join(parts)
+
+
+def build_segment_index(df: pd.DataFrame) -> dict:
+    """Позиции строк для каждого фильтра: без фильтра, по сегменту, по риску и по паре."""
+    import pandas as pd
+
+    frame = pd.DataFrame({
+        "segment": df["segment"].astype(str).values,
+        "churn": df["Churn_Risk"].astype(str).values,
+    })
+    index = {segment_index_key(): list(range(len(frame)))}
+    for segment, rows in frame.groupby("segment").groups.items():
+        index[segment_index_key(segment=segment)] = list(rows)
+    for churn, rows in frame.groupby("churn").groups.items():
+        index[segment_index_key(churn_risk=churn)] = list(rows)
+    for (segment, churn), rows in frame.groupby(["segment", "churn"]).groups.items():
+        index[segment_index_key(segment, churn)] = list(rows)
+    return index
+
 
-r = redis.Redis(host='redis', port=6379, db=0, decode_responses=True)
+def geo_members(chunk: pd.DataFrame, start: int) -> list:
+    """Плоский список долгота, широта, позиция строки для GEOADD; строки без координат пропускаются."""
+    import numpy as np
 
-REDIS_KEY = "cached_segments"
-REDIS_META_UPDATED_AT_KEY = "meta:segments_updated_at"
+    lat = chunk["geolocation_lat"].to_numpy(dtype="float64")
+    lng = chunk["geolocation_lng"].to_numpy(dtype="float64")
+    valid = (np.isfinite(lat) & np.isfinite(lng)
+             & (np.abs(lat) <= GEO_MAX_LATITUDE) & (np.abs(lng) <= 180))
+    positions = np.arange(start, start + len(chunk))[valid]
+    return [value for member in zip(lng[valid].tolist(), lat[valid].tolist(), positions.tolist())
+            for value in member]
 
-def cache_segments_to_redis(df: pd.DataFrame):
-    json_data = df.to_json(orient="records", force_ascii=False)
-    r.set(REDIS_KEY, json_data)
-    r.set(REDIS_META_UPDATED_AT_KEY, datetime.utcnow().isoformat())
+
+def _stream_compressors() -> dict:
+    """
+    Потоковые компрессоры: кусок, сжатый после flush, продолжает общий поток,
+    поэтому склейка сжатых кусков — один корректный gzip/brotli ответ.
+    """
+    compressors = {"gzip": zlib.compressobj(PAYLOAD_GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)}
+    if brotli:
+        compressors["br"] = brotli.Compressor(quality=PAYLOAD_BROTLI_QUALITY)
+    return compressors
+
+
+def _compress_piece(encoding, compressor, data, last=False):
+    if encoding == "gzip":
+        return compressor.compress(data) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+    return compressor.process(data) + (compressor.finish() if last else compressor.flush())
+
+
+def segments_output(df: pd.DataFrame) -> pd.DataFrame:
+    """Фрейм общей выдачи /segments: без customer_unique_id, сегмент и риск — категории."""
+    if "customer_unique_id" in df.columns:
+        df = df.drop(columns=["customer_unique_id"])
+    # Общие категории для всех кусков: словари Arrow пишутся один раз
+    return df.astype({"segment": "category", "Churn_Risk": "category"})
+
+
+def iter_segment_records(df: pd.DataFrame):
+    """Куски выдачи по SEGMENT_CHUNK_SIZE записей: (позиция первой записи, кусок, JSON записей)."""
+    for start in range(0, len(df), SEGMENT_CHUNK_SIZE):
+        chunk = df.iloc[start:start + SEGMENT_CHUNK_SIZE]
+        yield start, chunk, chunk.to_json(orient="records", lines=True, force_ascii=False).splitlines()
+
+
+def cache_segments_to_redis(df: pd.DataFrame, updated_at=None):
+    """updated_at — время пересчёта (по умолчанию текущее; задаётся при восстановлении с диска)."""
+    import pyarrow as pa
+
+    # customer_unique_id (если есть) идёт только в ключ hash по клиентам,
+    # общая выдача остаётся прежней
+    customer_ids = None
+    if "customer_unique_id" in df.columns:
+        customer_ids = df["customer_unique_id"].astype(str).tolist()
+
+    index = build_segment_index(df)
+    df = segments_output(df)
+    updated_at = updated_at or datetime.utcnow().isoformat()
+    with_msgpack = "msgpack" in wire_formats.BINARY_FORMATS
+    with_geo = {"geolocation_lat", "geolocation_lng"} <= set(df.columns)
+
+    def write(pipe, key):
+        # Выдача пишется кусками по SEGMENT_CHUNK_SIZE записей: в памяти воркера
+        # одновременно только один кусок, конвейер отправляется после каждого
+        etag = hashlib.sha1()
+        compressors = _stream_compressors()
+        arrow = wire_formats.ArrowStreamPieces(pa.Schema.from_pandas(df, preserve_index=False))
+        pipe.set(key("arrow:head"), arrow.head())
+        if with_msgpack:
+            pipe.set(key("msgpack:head"), wire_formats.msgpack_array_header(len(df)))
+        n_chunks = 0
+        for start, chunk, records in iter_segment_records(df):
+            piece = (("[" if n_chunks == 0 else ",") + ",".join(records)).encode("utf-8")
+            etag.update(piece)
+
+            pipe.set(key(f"chunk:{n_chunks}"), "\n".join(records))
+            for encoding, compressor in compressors.items():
+                pipe.set(key(f"body:{encoding}:{n_chunks}"), _compress_piece(encoding, compressor, piece))
+            pipe.set(key(f"arrow:{n_chunks}"), arrow.piece(chunk))
+            if with_msgpack:
+                pipe.set(key(f"msgpack:{n_chunks}"), wire_formats.msgpack_records(chunk))
+            pipe.hset(key("rows"), mapping=dict(enumerate(records, start)))
+            if customer_ids is not None:
+                # Сама запись уже есть в rows — по клиенту хранится только её позиция
+                pipe.hset(key("customer_positions"),
+                          mapping=dict(zip(customer_ids[start:start + SEGMENT_CHUNK_SIZE],
+                                           range(start, start + len(records)))))
+            members = geo_members(chunk, start) if with_geo else []
+            if members:
+                pipe.geoadd(key("geo"), members)
+            pipe.execute()
+            n_chunks += 1
+
+        closing = b"]" if n_chunks else b"[]"
+        etag.update(closing)
+        for encoding, compressor in compressors.items():
+            pipe.set(key(f"body:{encoding}:{n_chunks}"), _compress_piece(encoding, compressor, closing, last=True))
+        pipe.set(key("arrow:tail"), arrow.tail())
+        pipe.set(key("chunks"), n_chunks)
+        pipe.set(key("etag"), etag.hexdigest())
+        pipe.set(key("updated_at"), updated_at)
+        for name, rows in index.items():
+            for start in range(0, len(rows), SEGMENT_WRITE_BATCH):
+                pipe.rpush(key(name), *rows[start:start + SEGMENT_WRITE_BATCH])
+
+    return publish_snapshot(SEGMENTS, write)
+
+# Сколько кусков выдачи читать одним MGET: меньше обращений к Redis
+# при ограниченном объёме, который поток держит в памяти сверх кэша
+SEGMENT_FETCH_BATCH = max(1, int(os.getenv("SEGMENT_FETCH_BATCH", "8")))
+
+
+def _get_pieces(version, names) -> list:
+    """Куски версии сегментов: из кэша воркера, недостающие — одним MGET."""
+    pieces = [payload_cache.get((SEGMENTS, version, name)) for name in names]
+    missing = [i for i, piece in enumerate(pieces) if piece is None]
+    if missing:
+        fetched = rb.mget([snapshot_key(SEGMENTS, version, names[i]) for i in missing])
+        for i, piece in zip(missing, fetched):
+            if piece is None:
+                raise ValueError(f"Версия сегментов {version} удалена во время чтения")
+            payload_cache.put((SEGMENTS, version, names[i]), piece, len(piece))
+            pieces[i] = piece
+    return pieces
+
+
+def _iter_pieces(version, names):
+    for start in range(0, len(names), SEGMENT_FETCH_BATCH):
+        yield from _get_pieces(version, names[start:start + SEGMENT_FETCH_BATCH])
+
+
+def iter_segment_chunks(version, chunks, encoding="identity"):
+    """
+    Выдача сегментов по кускам: JSON-массив в кодировке encoding
+    (identity, gzip, br), NDJSON при encoding="ndjson",
+    Arrow IPC или MessagePack при encoding="arrow" / "msgpack".
+    Куски читаются пачками по SEGMENT_FETCH_BATCH.
+    """
+    if encoding in ("arrow", "msgpack"):
+        names = [f"{encoding}:head"] + [f"{encoding}:{n}" for n in range(chunks)]
+        if encoding == "arrow":
+            names.append("arrow:tail")
+        yield from _iter_pieces(version, names)
+        return
+
+    if encoding in ("gzip", "br"):
+        # Сжатые куски уже содержат разделители и закрывающую скобку
+        yield from _iter_pieces(version, [f"body:{encoding}:{n}" for n in range(chunks + 1)])
+        return
+
+    for n, chunk in enumerate(_iter_pieces(version, [f"chunk:{n}" for n in range(chunks)])):
+        if encoding == "ndjson":
+            yield chunk + b"\n"
+        else:
+            # Внутри записей переводов строк нет — JSON их экранирует
+            yield (b"[" if n == 0 else b",") + chunk.replace(b"\n", b",")
+    if encoding != "ndjson":
+        yield b"]" if chunks else b"[]"
 
 def get_segments_json_from_redis() -> str:
-    json_data = r.get(REDIS_KEY)
-    if json_data is None:
+    meta = get_payload_meta(SEGMENTS)
+    if meta is None:
         raise ValueError("Сегменты ещё не закэшированы")
-    return json_data
+    return b"".join(iter_segment_chunks(meta["version"], int(meta["chunks"]))).decode("utf-8")
+
+def get_segments_page(segment=None, churn_risk=None, cursor=0, limit=SEGMENTS_DEFAULT_LIMIT) -> dict:
+    """
+    Страница сегментов по индексу: читаются только позиции из нужного списка
+    и соответствующие им записи (LRANGE + HMGET), а не вся выдача.
+    Возвращает {"items": [JSON-строки записей], "total": ..., "next_cursor": ...}.
+    """
+    name = segment_index_key(segment, churn_risk)
+    # Если версию удалили между чтением позиций и записей — читаем страницу заново
+    for _ in range(SNAPSHOT_READ_ATTEMPTS):
+        version = current_version(SEGMENTS)
+        if version is None:
+            raise ValueError("Сегменты ещё не закэшированы")
+
+        key = snapshot_key(SEGMENTS, version, name)
+        pipe = r.pipeline(transaction=False)
+        pipe.llen(key)
+        pipe.lrange(key, cursor, cursor + limit - 1)
+        total, positions = pipe.execute()
+
+        items = r.hmget(snapshot_key(SEGMENTS, version, "rows"), positions) if positions else []
+        if None not in items:
+            break
+    else:
+        raise ValueError("Сегменты обновляются, повторите запрос")
+
+    end = cursor + len(positions)
+    return {
+        "items": items,
+        "total": total,
+        "next_cursor": end if end < total else None,
+    }
+
+# Записи клиентов ARGV: позиции из customer_positions (KEYS[1]), затем записи из rows (KEYS[2]).
+# Версии, записанные до customer_positions, хранят записи в hash customers (KEYS[3])
+_CUSTOMER_RECORDS_SCRIPT = r.register_script("""
+if redis.call('EXISTS', KEYS[1]) == 0 then
+  return redis.call('HMGET', KEYS[3], unpack(ARGV))
+end
+local positions = redis.call('HMGET', KEYS[1], unpack(ARGV))
+local found = {}
+for i, position in ipairs(positions) do
+  if position then
+    found[#found + 1] = position
+  end
+end
+local records = {}
+if #found > 0 then
+  records = redis.call('HMGET', KEYS[2], unpack(found))
+end
+local result, n = {}, 0
+for i, position in ipairs(positions) do
+  if position then
+    n = n + 1
+    result[i] = records[n]
+  else
+    result[i] = false
+  end
+end
+return result
+""")
+
+
+def get_customer_segments(customer_ids) -> dict:
+    """
+    Записи сегментов по customer_unique_id: {id: JSON-строка записи или None}.
+    Позиции и записи читаются скриптом пачками по SEGMENTS_LOOKUP_BATCH id
+    в одном конвейере — один round trip на запрос.
+    """
+    version = current_version(SEGMENTS)
+    if version is None:
+        raise ValueError("Сегменты ещё не закэшированы")
+
+    customer_ids = list(customer_ids)
+    keys = [snapshot_key(SEGMENTS, version, name) for name in ("customer_positions", "rows", "customers")]
+    pipe = r.pipeline(transaction=False)
+    for start in range(0, len(customer_ids), SEGMENTS_LOOKUP_BATCH):
+        _CUSTOMER_RECORDS_SCRIPT(keys=keys, args=customer_ids[start:start + SEGMENTS_LOOKUP_BATCH], client=pipe)
+    values = [value for batch in pipe.execute() for value in batch]
+    return dict(zip(customer_ids, values))
+
+def haversine_km(lng1, lat1, lng2, lat2):
+    """Расстояние по большому кругу, как его считает Redis."""
+    lng1, lat1, lng2, lat2 = map(math.radians, (lng1, lat1, lng2, lat2))
+    h = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * GEO_EARTH_RADIUS_KM * math.asin(math.sqrt(h))
+
+
+def bbox_search_circle(min_lng, min_lat, max_lng, max_lat):
+    """
+    Центр и радиус (км) круга GEOSEARCH, покрывающего bbox в градусах:
+    дальше всего от центра углы bbox. Лишние точки круга отсекает проверка по градусам.
+    """
+    center_lng, center_lat = (min_lng + max_lng) / 2, (min_lat + max_lat) / 2
+    radius_km = max(haversine_km(center_lng, center_lat, lng, lat)
+                    for lng in (min_lng, max_lng) for lat in (min_lat, max_lat))
+    # Небольшой запас на округление координат в geohash
+    return center_lng, center_lat, radius_km * 1.001 + 0.01
+
+
+def get_segments_in_area(bbox=None, center=None, radius_km=None, limit=SEGMENTS_DEFAULT_LIMIT) -> dict:
+    """
+    Записи сегментов клиентов в области по GEO-индексу версии, ближние к центру первыми:
+    bbox=(min_lng, min_lat, max_lng, max_lat) в градусах
+    или center=(lng, lat) и radius_km. Границы проверяются по координатам из geohash
+    (точность порядка метра).
+    Возвращает {"items": [JSON-строки записей], "total": число клиентов в области}.
+    """
+    if bbox is not None:
+        lng, lat, radius_km = bbox_search_circle(*bbox)
+    else:
+        lng, lat = center
+
+    for _ in range(SNAPSHOT_READ_ATTEMPTS):
+        version = current_version(SEGMENTS)
+        if version is None:
+            raise ValueError("Сегменты ещё не закэшированы")
+
+        found = r.geosearch(snapshot_key(SEGMENTS, version, "geo"), longitude=lng, latitude=lat,
+                            radius=radius_km, unit="km", sort="ASC", withcoord=True)
+        if bbox is not None:
+            min_lng, min_lat, max_lng, max_lat = bbox
+            found = [(member, (x, y)) for member, (x, y) in found
+                     if min_lng <= x <= max_lng and min_lat <= y <= max_lat]
+        positions = [member for member, _ in found[:limit]]
+        items = r.hmget(snapshot_key(SEGMENTS, version, "rows"), positions) if positions else []
+        if None not in items:
+            break
+    else:
+        raise ValueError("Сегменты обновляются, повторите запрос")
+
+    return {"items": items, "total": len(found)}
 
 def get_segments_updated_at() -> str | None:
-    return r.get(REDIS_META_UPDATED_AT_KEY)
+    snapshot = read_snapshot(SEGMENTS, ["updated_at"])
+    return snapshot["updated_at"] if snapshot else None
+
+
+# =====================
+# Срезы когорт и таймлайна
+# =====================
+# Строки таблиц когорт и таймлайна дополнительно пишутся в zset версии:
+#   slice:<имя>   — JSON строк со счётом номер месяца * SLICE_MONTH_SCALE + порядок строки
+#                   внутри месяца, поэтому ZRANGEBYSCORE по диапазону месяцев отдаёт
+#                   строки в исходном порядке, читая только нужный срез
+#   slices        — JSON {таблица: колонки}; отсутствует у версий, записанных без срезов
+SLICE_MONTH_SCALE = 10000
+
+
+def month_number(label: str) -> int:
+    """YYYY-MM -> год * 12 + месяц - 1."""
+    year, month = label[:7].split("-")
+    return int(year) * 12 + int(month) - 1
+
+
+def write_slice(pipe, key, name, members, months):
+    """zset срезов: members — JSON строк, months — их месяцы YYYY-MM."""
+    mapping = {}
+    ranks = {}
+    for member, month in zip(members, months):
+        number = month_number(month)
+        rank = ranks.get(number, 0)
+        ranks[number] = rank + 1
+        mapping[member] = number * SLICE_MONTH_SCALE + rank
+    if mapping:
+        pipe.zadd(key(name), mapping)
+
+
+def read_slices(dataset, names, month_from=None, month_to=None, extra=("updated_at",)):
+    """
+    Строки срезов текущей версии за месяцы [month_from, month_to] (YYYY-MM включительно,
+    None — без границы) и значения ключей extra — одним конвейером.
+    Возвращает ({имя: [JSON-строки]}, {"slices": ..., ключ extra: значение}) или None, если набора нет.
+    """
+    low = month_number(month_from) * SLICE_MONTH_SCALE if month_from else "-inf"
+    high = f"({(month_number(month_to) + 1) * SLICE_MONTH_SCALE}" if month_to else "+inf"
+    extra = ["slices"] + list(extra)
+    for _ in range(SNAPSHOT_READ_ATTEMPTS):
+        version = current_version(dataset)
+        if version is None:
+            return None
+
+        pipe = r.pipeline(transaction=False)
+        for name in names:
+            pipe.zrangebyscore(snapshot_key(dataset, version, name), low, high)
+        pipe.mget([snapshot_key(dataset, version, name) for name in extra])
+        *rows, values = pipe.execute()
+        values = dict(zip(extra, values))
+        if values["updated_at"] is not None and values["slices"] is None:
+            raise ValueError(f"Версия {dataset} {version} записана без срезов, нужен пересчёт")
+        if None not in values.values():
+            return dict(zip(names, rows)), values
+    raise ValueError(f"{dataset} обновляется, повторите запрос")
 
 
 # =====================
 # Когортный анализ
 # =====================
-# def cache_cohort_to_redis(
-#     state_list: List[str],
-#     retention: pd.DataFrame,
-#     cohort_data: pd.DataFrame,
-#     regional_cohort: pd.DataFrame
-# ):
-#     print("retention type", type(retention))
-#     print("retention shape", retention.shape)
-#     r.set("cohort:state_list", json.dumps(state_list, ensure_ascii=False))
-#     r.set("cohort:retention", retention.to_json(orient="split"))
-#     r.set("cohort:cohort_data", cohort_data.to_json(orient="split"))
-#     r.set("cohort:regional_cohort", regional_cohort.to_json(orient="split"))
-#     r.set("cohort:updated_at", datetime.utcnow().isoformat())
+COHORT_KEYS = ["state_list", "retention", "cohort_data", "regional_cohort", "updated_at"]
+
+
+def cohort_slice_name(state=None):
+    return f"slice:regional:{state}" if state else "slice:regional"
+
+
+def cohort_payload(cohort_json: dict) -> dict:
+    """Тело полной выдачи /cohort."""
+    return {name: cohort_json[name] for name in ["updated_at"] + COHORT_KEYS[:-1]}
 
 
+def cache_cohort_to_redis(cohort_json: dict):
+    def write(pipe, key):
+        for name in COHORT_KEYS[:-1]:
+            pipe.set(key(name), json.dumps(cohort_json[name], ensure_ascii=False))
+        # Срезы: общие таблицы по месяцу когорты, региональная — целиком и по штатам
+        for name in ["retention", "cohort_data"]:
+            rows = cohort_json[name]["data"]
+            write_slice(pipe, key, f"slice:{name}",
+                        [json.dumps(row, ensure_ascii=False) for row in rows], [row[0] for row in rows])
+        regional = cohort_json["regional_cohort"]["data"]
+        members = [json.dumps(row, ensure_ascii=False) for row in regional]
+        write_slice(pipe, key, cohort_slice_name(), members, [row[1] for row in regional])
+        by_state = {}
+        for row, member in zip(regional, members):
+            by_state.setdefault(row[0], []).append((member, row[1]))
+        for state, state_rows in by_state.items():
+            write_slice(pipe, key, cohort_slice_name(state), *zip(*state_rows))
+        pipe.set(key("slices"), json.dumps(
+            {name: cohort_json[name]["columns"] for name in ["retention", "cohort_data", "regional_cohort"]}))
+        pipe.set(key("updated_at"), cohort_json["updated_at"])
+        payload = cohort_payload(cohort_json)
+        formats = {"arrow": wire_formats.cohort_arrow(cohort_json)}
+        if "msgpack" in wire_formats.BINARY_FORMATS:
+            formats["msgpack"] = wire_formats.msgpack_payload(payload)
+        write_payload(pipe, key, json.dumps(payload, ensure_ascii=False), formats)
+
+    return publish_snapshot("cohort", write)
+
 def load_cohort_from_redis() -> dict:
-    def parse_json(key):
-        raw = r.get(f"cohort:{key}")
-        return json.loads(raw) if raw else {}
+    snapshot = read_snapshot("cohort", COHORT_KEYS)
+    if snapshot is None:
+        return {"state_list": [], "retention": {}, "cohort_data": {},
+                "regional_cohort": {}, "updated_at": None}
+
+    result = {name: json.loads(snapshot[name]) for name in COHORT_KEYS[:-1]}
+    result["updated_at"] = snapshot["updated_at"]
+    return result
 
+def get_cohort_slice(state=None, month_from=None, month_to=None) -> dict | None:
+    """
+    Срез когорт за месяцы когорты [month_from, month_to]; state — только этот штат
+    в regional_cohort. Возвращает {"updated_at", "state_list", "tables": {таблица: (колонки, [JSON-строки])}}.
+    """
+    names = ["slice:retention", "slice:cohort_data", cohort_slice_name(state)]
+    result = read_slices("cohort", names, month_from, month_to, extra=["updated_at", "state_list"])
+    if result is None:
+        return None
+    rows, values = result
+    columns = json.loads(values["slices"])
+    if state is None:
+        # zset всех штатов упорядочен по месяцу — возвращаем порядок полной таблицы (штат, месяц, смещение)
+        rows[names[2]].sort(key=lambda row: json.loads(row)[:3])
     return {
-        "state_list": json.loads(r.get("cohort:state_list") or "[]"),
-        "retention": parse_json("retention"),
-        "cohort_data": parse_json("cohort_data"),
-        "regional_cohort": parse_json("regional_cohort"),
-        "updated_at": r.get("cohort:updated_at")
+        "updated_at": values["updated_at"],
+        "state_list": values["state_list"],
+        "tables": {table: (columns[table], rows[name])
+                   for table, name in zip(["retention", "cohort_data", "regional_cohort"], names)},
     }
 
-def cache_cohort_to_redis(cohort_json: dict):
-    
-    
-    r.set("cohort:state_list", json.dumps(cohort_json["state_list"], ensure_ascii=False))
-    r.set("cohort:retention", json.dumps(cohort_json["retention"], ensure_ascii=False))
-    r.set("cohort:cohort_data", json.dumps(cohort_json["cohort_data"], ensure_ascii=False))
-    r.set("cohort:regional_cohort", json.dumps(cohort_json["regional_cohort"], ensure_ascii=False))
-    r.set("cohort:updated_at", cohort_json["updated_at"])
-    
-def load_cohort_from_redis() -> dict:
-    def parse_json(key):
-        raw = r.get(f"cohort:{key}")
-        return json.loads(raw) if raw else {}
+TIMELINE_KEYS = ["by_segment", "by_churn", "updated_at"]
+
+
+# Колонка значения в записях каждой серии таймлайна
+TIMELINE_SERIES = {"by_segment": "segment_description", "by_churn": "Churn_Risk"}
+
 
+def timeline_slice_name(series, value=None):
+    return f"slice:{series}:{value}" if value is not None else f"slice:{series}"
+
+
+def timeline_payload(by_segment_json: str, by_churn_json: str, updated_at: str) -> dict:
+    """Тело полной выдачи /timeline."""
     return {
-        "state_list": json.loads(r.get("cohort:state_list") or "[]"),
-        "retention": parse_json("retention"),
-        "cohort_data": parse_json("cohort_data"),
-        "regional_cohort": parse_json("regional_cohort"),
-        "updated_at": r.get("cohort:updated_at")
+        "by_churn": json.loads(by_churn_json),
+        "by_segment": json.loads(by_segment_json),
+        "updated_at": updated_at,
     }
 
+
+def timeline_rollup_name(level):
+    return f"rollup:{level}"
+
+
 def cache_timeline_to_redis(by_segment_json: str,
-                            by_churn_json: str):
-    r.set("timeline:by_segment", by_segment_json)
-    r.set("timeline:by_churn",   by_churn_json)
-    r.set("timeline:updated_at", datetime.utcnow().isoformat())
-    
+                            by_churn_json: str,
+                            updated_at=None,
+                            rollup=None):
+    """rollup — уровни куба свёрток {уровень: куб} (см. time_pipeline.rollup_json)."""
+    updated_at = updated_at or datetime.utcnow().isoformat()
+
+    def write(pipe, key):
+        pipe.set(key("by_segment"), by_segment_json)
+        pipe.set(key("by_churn"), by_churn_json)
+        pipe.set(key("updated_at"), updated_at)
+        # Каждый уровень куба — отдельным ключом: запрос читает только свой уровень
+        for level, cube in (rollup or {}).items():
+            pipe.set(key(timeline_rollup_name(level)), json.dumps(cube, ensure_ascii=False, separators=(",", ":")))
+        payload = timeline_payload(by_segment_json, by_churn_json, updated_at)
+        # Срезы: каждая серия целиком и по значению (сегменту или риску оттока)
+        for series, column in TIMELINE_SERIES.items():
+            records = payload[series]
+            members = [json.dumps(record, ensure_ascii=False) for record in records]
+            months = [record["order_purchase_timestamp"] for record in records]
+            write_slice(pipe, key, timeline_slice_name(series), members, months)
+            by_value = {}
+            for record, member, month in zip(records, members, months):
+                by_value.setdefault(record[column], []).append((member, month))
+            for value, value_rows in by_value.items():
+                write_slice(pipe, key, timeline_slice_name(series, value), *zip(*value_rows))
+        pipe.set(key("slices"), json.dumps(
+            {series: ["order_purchase_timestamp", column, "count"] for series, column in TIMELINE_SERIES.items()}))
+        formats = {"arrow": wire_formats.timeline_arrow(payload["by_segment"], payload["by_churn"], updated_at)}
+        if "msgpack" in wire_formats.BINARY_FORMATS:
+            formats["msgpack"] = wire_formats.msgpack_payload(payload)
+        write_payload(pipe, key, json.dumps(payload, ensure_ascii=False), formats)
+
+    return publish_snapshot("timeline", write)
+
 def load_timeline_from_redis() -> dict:
     """
-    Загружает из Redis ключи:
-      - timeline:by_churn    (JSON‑строка)
-      - timeline:by_segment  (JSON‑строка)
-      - timeline:updated_at  (ISO‑строка)
+    Загружает из текущей версии timeline одним MGET ключи:
+      - by_churn    (JSON‑строка)
+      - by_segment  (JSON‑строка)
+      - updated_at  (ISO‑строка)
     и возвращает уже готовый Python‑объект.
     """
-    # читаем «сырые» байты/строки
-    raw_churn = r.get("timeline:by_churn")
-    raw_seg   = r.get("timeline:by_segment")
-    raw_upd   = r.get("timeline:updated_at")
+    snapshot = read_snapshot("timeline", TIMELINE_KEYS) or {}
+    raw_churn = snapshot.get("by_churn")
+    raw_seg   = snapshot.get("by_segment")
+    raw_upd   = snapshot.get("updated_at")
 
     # десериализуем JSON в списки словарей
     by_churn = json.loads(raw_churn)   if raw_churn else []
@@ -113,4 +952,113 @@ def load_timeline_from_redis() -> dict:
         "by_churn":    by_churn,
         "by_segment":  by_segment,
         "updated_at":  updated_at
-    }
\ No newline at end of file
+    }
+
+def get_timeline_slice(month_from=None, month_to=None, segment=None, churn_risk=None) -> dict | None:
+    """
+    Срез таймлайна за месяцы [month_from, month_to]; segment (описание сегмента)
+    и churn_risk отбирают записи своей серии. Возвращает {"updated_at", "by_segment", "by_churn"}
+    с JSON-строками записей.
+    """
+    names = [timeline_slice_name("by_segment", segment), timeline_slice_name("by_churn", churn_risk)]
+    result = read_slices("timeline", names, month_from, month_to)
+    if result is None:
+        return None
+    rows, values = result
+    return {"updated_at": values["updated_at"], "by_segment": rows[names[0]], "by_churn": rows[names[1]]}
+
+
+# =====================
+# Куб свёрток таймлайна
+# =====================
+# Уровни куба (день, неделя, месяц, квартал) хранятся в версии timeline ключами
+# rollup:<уровень> в компактном виде: коды измерений и словари их значений.
+# Запрос выбирает уровень и измерения и суммирует строки куба в воркере API
+# без pandas и без пересчёта: берётся таблица уровня, заранее свёрнутая при записи
+# до измерений запроса и фильтров. Разобранный уровень и готовые ответы
+# кэшируются до смены версии (ответы — в main.timeline_rollup).
+
+# Во сколько раз разобранный куб в памяти больше своего JSON (для учёта в кэше воркера)
+ROLLUP_MEMORY_FACTOR = 6
+
+
+def get_timeline_rollup(level) -> dict | None:
+    """
+    Уровень куба текущей версии timeline: {"cube": куб, "updated_at", "version"}
+    или None, если набор не опубликован.
+    """
+    for _ in range(SNAPSHOT_READ_ATTEMPTS):
+        version = current_version("timeline")
+        if version is None:
+            return None
+        payload_cache.observe_version("timeline", version)
+        cache_key = ("timeline", version, timeline_rollup_name(level))
+        cached = payload_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+        raw, updated_at = r.mget([snapshot_key("timeline", version, timeline_rollup_name(level)),
+                                  snapshot_key("timeline", version, "updated_at")])
+        if updated_at is None:
+            continue  # версия удалена между чтениями — берём новую
+        if raw is None:
+            raise ValueError(f"Версия timeline {version} записана без куба свёрток, нужен пересчёт")
+        cached = {"cube": json.loads(raw), "updated_at": updated_at, "version": version}
+        payload_cache.put(cache_key, cached, len(raw) * ROLLUP_MEMORY_FACTOR)
+        return cached
+    raise ValueError("timeline обновляется, повторите запрос")
+
+
+def rollup_query(cube, dimensions=(), filters=None, period_from=None, period_to=None) -> dict:
+    """
+    Свёртка уровня куба по измерениям dimensions (остальные суммируются)
+    для строк со значениями filters {измерение: значение} и периодов, начало которых
+    лежит в [period_from, period_to] (YYYY, YYYY-MM или YYYY-MM-DD, границы включительно).
+    Возвращает {"columns": ["period", измерения..., меры...], "data": [[...]]},
+    строки упорядочены по периоду и значениям измерений.
+    """
+    columns, values, rows = cube["columns"], cube["dimensions"], cube["data"]
+    measures = columns[1 + len(values):]
+    result_columns = ["period"] + list(dimensions) + measures
+
+    # Самая короткая заранее свёрнутая таблица уровня, в которой есть измерения
+    # запроса и фильтров; если такой нет (или куб записан без aggregates) — все строки
+    needed = {*dimensions, *(filters or {})}
+    for key, aggregate in (cube.get("aggregates") or {}).items():
+        stored = key.split(",") if key else []
+        if needed.issubset(stored) and len(aggregate) < len(rows):
+            columns, rows = ["period"] + stored + measures, aggregate
+
+    # Строки куба упорядочены по периоду: диапазон периодов — непрерывный отрезок строк
+    starts = cube["starts"]
+    first_period = bisect.bisect_left(starts, period_from) if period_from else 0
+    last_period = (bisect.bisect_right([start[:len(period_to)] for start in starts], period_to)
+                   if period_to else len(starts))
+    rows = rows[bisect.bisect_left(rows, first_period, key=itemgetter(0)):
+                bisect.bisect_left(rows, last_period, key=itemgetter(0))]
+
+    for name, value in (filters or {}).items():
+        if value not in values[name]:
+            return {"columns": result_columns, "data": []}
+        position, code = columns.index(name), values[name].index(value)
+        rows = [row for row in rows if row[position] == code]
+
+    positions = [columns.index(name) for name in dimensions]
+    group_of = itemgetter(0, *positions) if positions else (lambda row: (row[0],))
+    first_measure = len(columns) - len(measures)
+    totals = {}
+    for row in rows:
+        group = group_of(row)
+        total = totals.get(group)
+        if total is None:
+            totals[group] = row[first_measure:]
+        else:
+            totals[group] = [a + b for a, b in zip(total, row[first_measure:])]
+
+    # Суммы денежных мер округляются (в кубе они уже с точностью до копейки)
+    rounded = [isinstance(value, float) for value in rows[0][first_measure:]] if rows else []
+    labels = [cube["periods"]] + [values[name] for name in dimensions]
+    data = [[label[code] for label, code in zip(labels, group)]
+            + [round(value, 2) if is_float else value for value, is_float in zip(total, rounded)]
+            for group, total in sorted(totals.items())]
+    return {"columns": result_columns, "data": data}
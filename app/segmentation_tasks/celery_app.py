@@ -1,9 +1,13 @@
 from celery import Celery
 
+from metrics import connect_celery_signals
+
 celery_app = Celery(
     "segmentation",
     broker="redis://redis_cache:6379/0",
     backend="redis://redis_cache:6379/0"
 )
 
-celery_app.autodiscover_tasks(['segmentation_tasks'])
\ No newline at end of file
+celery_app.autodiscover_tasks(['segmentation_tasks'])
+# Время выполнения и ожидания в очереди задач (см. metrics)
+connect_celery_signals()
@@ -1,90 +1,101 @@
 import pandas as pd
 import numpy as np
-from operator import attrgetter
 import json
 from datetime import datetime
 
-# Загрузка данных
-def load_data():
-    customers = pd.read_csv("research/clean_data/customers.csv")
-    geolocation = pd.read_csv("research/clean_data/geolocation.csv")
-    order_pay = pd.read_csv("research/clean_data/order_payments.csv")
-    reviews = pd.read_csv("research/clean_data/order_reviews.csv")
-    orders = pd.read_csv("research/clean_data/orders.csv")
-    item = pd.read_csv("research/clean_data/orders_items.csv")
-    category_name = pd.read_csv("research/clean_data/product_category_name_translation.csv")
-    products = pd.read_csv("research/clean_data/products.csv")
-    sellers = pd.read_csv("research/clean_data/sellers.csv")
-    return customers, geolocation, order_pay, reviews, orders, item, category_name, products, sellers
-
-# Объединение данных
-def merge_data(orders, item, order_pay, reviews, products, customers, sellers, category_name):
-    df = orders.merge(item, on='order_id', how='left')
-    df = df.merge(order_pay, on='order_id', how='outer', validate='m:m')
-    df = df.merge(reviews, on='order_id', how='outer')
-    df = df.merge(products, on='product_id', how='outer')
-    df = df.merge(customers, on='customer_id', how='outer')
-    df = df.merge(sellers, on='seller_id', how='outer')
-    df = df.merge(category_name, on="product_category_name", how="left")
-    return df
-
-# Очистка данных
-def filter_customers(df):
-    return df[~df["customer_unique_id"].isna()]
-
-# Главная функция пайплайна
-def main_pipeline():
-    customers, geolocation, order_pay, reviews, orders, item, category_name, products, sellers = load_data()
-    df = merge_data(orders, item, order_pay, reviews, products, customers, sellers, category_name)
-    df = filter_customers(df)
-    return df
+from segmentation_tasks.join_plan import CONSUMER_COLUMNS, build_order_frame
 
 # Препроцессинг и расчет когорт
+# Месяцы — целые номера (год * 12 + месяц - 1), смещение когорты — точная разница
+# календарных месяцев. Заказы сводятся к уникальным (клиент, штат, когорта, смещение),
+# по ним за один проход считаются общие и региональные числа клиентов.
+# Результат — разреженные таблицы {"columns": [...], "data": [[...], ...]}:
+# только существующие пары когорта × смещение, без пустых ячеек матрицы.
 
-def data_preprocessing():
-    data = main_pipeline()
-    data.dropna(inplace=True)
+COHORT_COLUMNS = ["cohort_month", "cohort_index", "customers"]
+RETENTION_COLUMNS = ["cohort_month", "cohort_index", "retention"]
+REGIONAL_COLUMNS = ["customer_state", "cohort_month", "cohort_index", "customers", "retention"]
+# Знаков после запятой у доли удержания (точные числа клиентов есть в customers)
+RETENTION_PRECISION = 4
 
-    data['order_purchase_timestamp'] = pd.to_datetime(data['order_purchase_timestamp'])
 
-    data['cohort_month'] = data.groupby('customer_unique_id')['order_purchase_timestamp'].transform('min').dt.to_period('M').astype(str)
-    data['order_month'] = data['order_purchase_timestamp'].dt.to_period('M').astype(str)
-    data['cohort_index'] = (
-    pd.to_datetime(data['order_month']) - pd.to_datetime(data['cohort_month'])).dt.days // 30
+def month_ordinal(timestamps):
+    """Номер месяца: год * 12 + месяц - 1."""
+    return (timestamps.dt.year * 12 + timestamps.dt.month - 1).to_numpy(dtype="int32")
 
 
-    # Основные таблицы
-    cohort_data = data.groupby(['cohort_month', 'cohort_index'])['customer_unique_id'].nunique().unstack(1)
-    retention = cohort_data.copy()
-    cohort_size = retention.iloc[:, 0]
-    retention = retention.divide(cohort_size, axis=0)
+def month_labels(ordinals):
+    """Номера месяцев -> строки YYYY-MM (каждый месяц форматируется один раз)."""
+    values, codes = np.unique(ordinals, return_inverse=True)
+    labels = np.array([f"{value // 12:04d}-{value % 12 + 1:02d}" for value in values], dtype=object)
+    return labels[codes.reshape(-1)]
 
-    regional_cohort = data.groupby(['customer_state', 'cohort_month', 'cohort_index'])['customer_unique_id'].nunique().reset_index()
+
+def cohort_triplets(data):
+    """
+    Уникальные (клиент, штат, когорта, смещение) по заказам data
+    (customer_unique_id, order_purchase_timestamp, customer_state).
+    Штат — код (-1 — пропуск), возвращается вместе со списком штатов.
+    """
+    customer = pd.factorize(data["customer_unique_id"])[0]
+    if isinstance(data["customer_state"].dtype, pd.CategoricalDtype):
+        state, states = data["customer_state"].cat.codes.to_numpy(), data["customer_state"].cat.categories
+    else:
+        state, states = pd.factorize(data["customer_state"])
+
+    order_month = month_ordinal(data["order_purchase_timestamp"])
+    cohort_month = pd.Series(order_month).groupby(customer).transform("min").to_numpy()
+    triplets = pd.DataFrame({
+        "customer": customer,
+        "state": state,
+        "cohort_month": cohort_month,
+        "cohort_index": order_month - cohort_month,
+    }).drop_duplicates()
+    return triplets, np.asarray(states, dtype=object)
+
+
+def with_retention(counts, group):
+    """Доля клиентов когорты относительно смещения 0 той же группы (NaN, если его нет)."""
+    base = counts["customers"].where(counts["cohort_index"] == 0)
+    size = base.groupby([counts[column] for column in group]).transform("max")
+    counts["retention"] = counts["customers"] / size
+    return counts
+
+
+def sparse_table(frame, columns):
+    return json.loads(frame[columns].to_json(orient="split", index=False, double_precision=RETENTION_PRECISION))
+
+
+def data_preprocessing(orders=None):
+    # orders — готовый фрейм заказов (общий этап DAG), иначе строится здесь
+    if orders is None:
+        orders = build_order_frame(CONSUMER_COLUMNS["cohort"])
+
+    # Заказы, которые переживали dropna() в широком фрейме; для числа уникальных
+    # клиентов кратность строк не важна, поэтому достаточно одной строки на заказ
+    data = orders.loc[orders['complete_weight'] > 0, CONSUMER_COLUMNS["cohort"]]
     state_list = data['customer_state'].dropna().unique().tolist()
+    triplets, states = cohort_triplets(data)
+
+    # Клиент, заказывавший из нескольких штатов, в общих числах учитывается один раз
+    overall = (triplets.drop_duplicates(["customer", "cohort_month", "cohort_index"])
+               .groupby(["cohort_month", "cohort_index"]).size().rename("customers").reset_index())
+    overall = with_retention(overall, ["cohort_month"])
 
-    # Преобразование индексов/колонок
-    retention.columns = retention.columns.astype(str)
-    retention.index = retention.index.astype(str)
-    cohort_data.columns = cohort_data.columns.astype(str)
-    cohort_data.index = cohort_data.index.astype(str)
-    regional_cohort.columns = regional_cohort.columns.astype(str)
-    
-    print("[DEBUG] regional_cohort.columns", regional_cohort.columns.tolist())
-    for col in regional_cohort.columns:
-        try:
-            samples = regional_cohort[col].head(10)
-            for i, val in enumerate(samples):
-                if isinstance(val, (dict, list, pd.DataFrame, pd.Series)):
-                    print(f"[WARNING] В колонке '{col}' на строке {i} — вложенный тип: {type(val)}")
-        except Exception as e:
-            print(f"[ERROR] Не удалось проверить колонку '{col}': {e}")
+    regional = (triplets[triplets["state"] >= 0]
+                .groupby(["state", "cohort_month", "cohort_index"]).size().rename("customers").reset_index())
+    regional = with_retention(regional, ["state", "cohort_month"])
+    regional.insert(0, "customer_state", states[regional["state"].to_numpy()] if len(regional) else [])
+    regional = regional.sort_values(["customer_state", "cohort_month", "cohort_index"], kind="stable")
 
+    for frame in (overall, regional):
+        frame["cohort_month"] = month_labels(frame["cohort_month"].to_numpy()) if len(frame) else []
 
     # Финальный JSON-ответ
     return {
         "state_list": state_list,
-        "retention": json.loads(retention.to_json(orient="split")),
-        "cohort_data": json.loads(cohort_data.to_json(orient="split")),
-        "regional_cohort": json.loads(regional_cohort.to_json(orient="split")),
+        "retention": sparse_table(overall, RETENTION_COLUMNS),
+        "cohort_data": sparse_table(overall, COHORT_COLUMNS),
+        "regional_cohort": sparse_table(regional, REGIONAL_COLUMNS),
         "updated_at": datetime.utcnow().isoformat()
-    }
\ No newline at end of file
+    }
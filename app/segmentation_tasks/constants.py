@@ -0,0 +1,35 @@
+import os
+
+# Константы, общие для API и пайплайнов. Модуль не импортирует pandas/numpy:
+# процессы API берут отсюда всё, что им нужно от пайплайнов, не загружая сами пайплайны.
+
+DATA_DIR = os.getenv("OLIST_DATA_DIR", "research/clean_data")
+SNAPSHOT_DIR = os.getenv("OLIST_SNAPSHOT_DIR", os.path.join(DATA_DIR, "_snapshot"))
+
+# Листья DAG обновления (см. dag)
+LEAVES = ["segments", "cohort", "timeline"]
+
+# Метки риска оттока RFM-скоринга (таймлайн) и выдачи /segments — в том же порядке
+CHURN_LABELS = ['Высокий риск', 'Средний риск', 'Низкий риск']
+SEGMENT_CHURN_LABELS = ['High_risk', 'Avg_risg', 'Low_risk']
+
+SEGMENT_DESCRIPTIONS = {
+    'A_Single Purchase': 'Клиенты с одной покупкой, высокий денежный объем.',
+    'B_Single Purchase': 'Клиенты с одной покупкой, средний денежный объем.',
+    'C_Single Purchase': 'Клиенты с одной покупкой, низкий денежный объем.',
+    'A_X': 'Высокоприбыльные клиенты, низкая вариативность.',
+    'B_X': 'Клиенты со средней частотой и объемом, низкая вариативность.',
+    'C_X': 'Клиенты с низким объемом, низкая вариативность.',
+    'A_Y': 'Высокоприбыльные клиенты с разумной вариативностью.',
+    'B_Y': 'Средние клиенты с некоторой вариативностью.',
+    'C_Y': 'Клиенты с низким объемом и частотой, но с вариативностью.',
+    'A_Z': 'Высокоприбыльные клиенты с большой вариативностью.',
+    'B_Z': 'Средние клиенты с высокой вариативностью.',
+    'C_Z': 'Низкие клиенты с высокой вариативностью.',
+}
+
+# Куб свёрток таймлайна (см. time_pipeline.build_rollup): уровни от мелкого к крупному,
+# измерения и меры
+ROLLUP_LEVELS = ["day", "week", "month", "quarter"]
+ROLLUP_DIMENSIONS = ["segment_description", "Churn_Risk", "customer_state"]
+ROLLUP_MEASURES = ["count", "orders", "monetary"]
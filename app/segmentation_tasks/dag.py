@@ -0,0 +1,302 @@
+import argparse
+import json
+import logging
+import os
+import resource
+import shutil
+import time
+
+import pandas as pd
+
+from metrics import observe_stage
+from segmentation_tasks import cohort_pipeline, segmentation_pipeline, time_pipeline
+from segmentation_tasks.constants import LEAVES
+from segmentation_tasks.data_store import SNAPSHOT_DIR, data_version
+from segmentation_tasks.geo_index import load_zip_index
+from segmentation_tasks.join_plan import CONSUMER_COLUMNS, build_order_frame, finalize_aggregates
+from segmentation_tasks.profiling import RunProfiler
+from segmentation_tasks.rfm_core import score_customers
+
+# Единый DAG обновления сегментов, когорт и таймлайна.
+# Общие этапы (загрузка и объединение заказов, накопительные суммы, RFM-скоринг)
+# выполняются один раз за прогон и передаются листьям внутри процесса.
+# Результаты общих этапов полного пересчёта дополнительно сохраняются
+# в локальное хранилище артефактов с ключом по версии исходных данных,
+# чтобы отдельный запуск одного листа не пересчитывал их заново.
+
+ARTIFACT_DIR = os.getenv("PIPELINE_ARTIFACT_DIR", os.path.join(SNAPSHOT_DIR, "artifacts"))
+USE_ARTIFACTS = os.getenv("PIPELINE_USE_ARTIFACTS", "1") == "1"
+# Сколько последних версий артефактов хранить
+ARTIFACT_KEEP_VERSIONS = int(os.getenv("PIPELINE_ARTIFACT_KEEP_VERSIONS", "2"))
+# Увеличивается при изменении логики этапов, чтобы не читать устаревшие артефакты
+ARTIFACT_FORMAT_VERSION = 2
+
+# Фрейм заказов, общий для всех потребителей
+ORDER_FRAME_COLUMNS = list(dict.fromkeys(c for columns in CONSUMER_COLUMNS.values() for c in columns))
+
+STAGES = {}
+
+
+def stage(name, persist=False, mode_dependent=False):
+    """
+    Регистрирует этап DAG. Функция этапа получает PipelineRun
+    и запрашивает зависимости через run.get(...).
+    persist — сохранять результат (DataFrame) в хранилище артефактов;
+    mode_dependent — результат зависит от режима incremental, в этом режиме не сохраняется.
+    """
+    def decorator(func):
+        STAGES[name] = {"func": func, "persist": persist, "mode_dependent": mode_dependent}
+        return func
+    return decorator
+
+
+@stage("orders", persist=True)
+def _orders(run):
+    return build_order_frame(ORDER_FRAME_COLUMNS)
+
+
+@stage("zip_index")
+def _zip_index(run):
+    # Индекс сохраняется рядом со снапшотом данных (см. geo_index), отдельный артефакт не нужен
+    return load_zip_index()
+
+
+@stage("customer_totals", persist=True, mode_dependent=True)
+def _customer_totals(run):
+    if run.incremental:
+        # Инкрементальный режим читает только новые заказы, общий фрейм не нужен
+        return segmentation_pipeline.build_customer_totals(
+            incremental=True, zip_index=run.get("zip_index"), workers=run.workers)
+    return segmentation_pipeline.build_customer_totals(
+        incremental=False, orders=run.get("orders"), zip_index=run.get("zip_index"),
+        workers=run.workers)
+
+
+@stage("scores", persist=True, mode_dependent=True)
+def _scores(run):
+    return score_customers(finalize_aggregates(run.get("customer_totals")))
+
+
+@stage("segments")
+def _segments(run):
+    # customer_unique_id остаётся для поиска по клиенту; в общей выдаче его убирает запись в Redis
+    return segmentation_pipeline.segments_result(run.get("customer_totals"), run.get("scores"), keep_ids=True)
+
+
+@stage("cohort")
+def _cohort(run):
+    return cohort_pipeline.data_preprocessing(run.get("orders"))
+
+
+@stage("timeline")
+def _timeline(run):
+    return time_pipeline.run_time_pipeline(run.get("orders"), run.get("scores"))
+
+
+def _rss_mb():
+    """Текущий RSS процесса в МБ (Linux, /proc)."""
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return round(pages * os.sysconf("SC_PAGE_SIZE") / 2 ** 20, 1)
+
+
+def _peak_rss_mb():
+    """Пиковый RSS процесса с момента запуска в МБ (ru_maxrss в Linux — в КБ)."""
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def _frame_mb(value):
+    if isinstance(value, pd.DataFrame):
+        return round(value.memory_usage(deep=True).sum() / 2 ** 20, 1)
+    return None
+
+
+class PipelineRun:
+    """Один прогон DAG: кэш результатов этапов и отчёт о времени."""
+
+    def __init__(self, incremental=False, use_artifacts=USE_ARTIFACTS, workers=None, progress=None,
+                 profiler=None):
+        self.incremental = incremental
+        self.workers = workers
+        self.use_artifacts = use_artifacts
+        # progress(stage, status) — вызывается перед этапом ("running") и после него ("done")
+        self.progress = progress
+        # RunProfiler, если прогон профилируется (пик памяти этапов при trace_memory)
+        self.profiler = profiler
+        self.results = {}
+        self.timings = []
+        self._version = None
+        # Время вложенных этапов вычитается из времени родителя
+        self._child_seconds = []
+
+    @property
+    def version(self):
+        if self._version is None:
+            self._version = f"v{ARTIFACT_FORMAT_VERSION}-{data_version()}"
+        return self._version
+
+    def get(self, name):
+        if name not in self.results:
+            self.results[name] = self._run_stage(name)
+        return self.results[name]
+
+    def timed(self, name, func, *args):
+        if self.progress:
+            self.progress(name, "running")
+        if self.profiler:
+            self.profiler.stage_started()
+        self._child_seconds.append(0.0)
+        started = time.perf_counter()
+        value = func(*args)
+        total = time.perf_counter() - started
+        traced_peak_mb = self.profiler.stage_finished() if self.profiler else None
+        children = self._child_seconds.pop()
+        if self._child_seconds:
+            self._child_seconds[-1] += total
+
+        rows = len(value) if isinstance(value, pd.DataFrame) else None
+        observe_stage(name, total - children, rows)
+
+        # Память после этапа: текущий и пиковый (с начала процесса) RSS и объём результата.
+        # Рост пика между этапами показывает, какой этап его поднял
+        self.timings.append({
+            "stage": name,
+            "seconds": round(total - children, 4),
+            "rows": rows,
+            "result_mb": _frame_mb(value),
+            "rss_mb": _rss_mb(),
+            "peak_rss_mb": _peak_rss_mb(),
+        })
+        if traced_peak_mb is not None:
+            self.timings[-1]["traced_peak_mb"] = traced_peak_mb
+        if self.progress:
+            self.progress(name, "done")
+        return value
+
+    def _artifact_path(self, name):
+        meta = STAGES[name]
+        if not (self.use_artifacts and meta["persist"]):
+            return None
+        if meta["mode_dependent"] and self.incremental:
+            return None
+        return os.path.join(ARTIFACT_DIR, self.version, f"{name}.parquet")
+
+    def _run_stage(self, name):
+        if name not in STAGES:
+            raise KeyError(f"Неизвестный этап: {name}")
+
+        path = self._artifact_path(name)
+        if path and os.path.exists(path):
+            value = self.timed(name, pd.read_parquet, path)
+            self.timings[-1]["source"] = "artifact"
+            return value
+
+        value = self.timed(name, STAGES[name]["func"], self)
+        self.timings[-1]["source"] = "computed"
+        if path:
+            _save_artifact(path, value)
+        return value
+
+    def report(self):
+        return {
+            "incremental": self.incremental,
+            "stages": self.timings,
+            "total_seconds": round(sum(t["seconds"] for t in self.timings), 4),
+        }
+
+
+def _save_artifact(path, df):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    df.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, path)
+
+    # Удаляем старые версии артефактов
+    versions = sorted(
+        (os.path.join(ARTIFACT_DIR, d) for d in os.listdir(ARTIFACT_DIR)),
+        key=os.path.getmtime, reverse=True)
+    for old in versions[ARTIFACT_KEEP_VERSIONS:]:
+        shutil.rmtree(old, ignore_errors=True)
+
+
+def run_pipeline(leaves=None, incremental=False, writers=None, use_artifacts=USE_ARTIFACTS, workers=None,
+                 progress=None, profile=False, trace_memory=False, profile_name=None):
+    """
+    Выполняет DAG для указанных листьев (по умолчанию всех) и возвращает отчёт по этапам.
+    writers — {лист: функция записи результата}, например в Redis;
+    запись каждого листа тоже попадает в отчёт как этап write:<лист>.
+    workers — число процессов для расчёта сумм RFM (по умолчанию RFM_WORKERS).
+    progress — функция, получающая словарь хода прогона при начале и завершении каждого этапа:
+    {"stage", "status", "stages_done", "leaves", "leaves_done"}.
+    profile — профилировать прогон cProfile (см. profiling): сводка горячих функций
+    попадает в отчёт как "profile", полная статистика — в файл <profile_name>.prof;
+    trace_memory — дополнительно пик tracemalloc каждого этапа (traced_peak_mb).
+    """
+    leaves = list(leaves or LEAVES)
+    unknown = set(leaves) - set(LEAVES)
+    if unknown:
+        raise ValueError(f"Неизвестные листья DAG: {sorted(unknown)}")
+
+    done = {"stages": 0, "leaves": 0}
+
+    def on_stage(stage_name, status):
+        done["stages"] += status == "done"
+        progress({"stage": stage_name, "status": status, "stages_done": done["stages"],
+                  "leaves": leaves, "leaves_done": done["leaves"]})
+
+    profiler = RunProfiler(trace_memory=trace_memory) if profile else None
+    run = PipelineRun(incremental=incremental, use_artifacts=use_artifacts, workers=workers,
+                      progress=on_stage if progress else None, profiler=profiler)
+    if profiler:
+        profiler.start()
+    try:
+        for leaf in leaves:
+            result = run.get(leaf)
+            if writers and leaf in writers:
+                run.timed(f"write:{leaf}", writers[leaf], result)
+                run.timings[-1]["source"] = "computed"
+            done["leaves"] += 1
+    finally:
+        if profiler:
+            profiler.stop()
+
+    report = run.report()
+    report["leaves"] = leaves
+    if profiler:
+        report["profile"] = {
+            **profiler.summary(),
+            "path": profiler.dump(profile_name or time.strftime("run-%Y%m%d-%H%M%S")),
+        }
+    logging.info(f"[dag] отчёт по этапам: {json.dumps(report, ensure_ascii=False)}")
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Прогон DAG сегментации без записи в Redis")
+    parser.add_argument("--leaf", action="append", choices=LEAVES, help="лист DAG (можно несколько)")
+    parser.add_argument("--incremental", action="store_true")
+    parser.add_argument("--no-artifacts", action="store_true")
+    parser.add_argument("--workers", type=int, default=None, help="процессов для расчёта RFM")
+    parser.add_argument("--profile", action="store_true", help="профилировать прогон cProfile")
+    parser.add_argument("--trace-memory", action="store_true", help="с --profile: пик tracemalloc этапов")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    result = run_pipeline(args.leaf, incremental=args.incremental,
+                          use_artifacts=not args.no_artifacts, workers=args.workers,
+                          profile=args.profile, trace_memory=args.trace_memory)
+    traced = args.profile and args.trace_memory
+    print(f"{'stage':<20}{'source':>10}{'rows':>10}{'seconds':>10}{'result MB':>11}{'RSS MB':>9}{'peak MB':>9}"
+          + (f"{'traced MB':>11}" if traced else ""))
+    for row in result["stages"]:
+        print(f"{row['stage']:<20}{row['source']:>10}{str(row['rows'] or '-'):>10}{row['seconds']:>10}"
+              f"{str(row['result_mb'] or '-'):>11}{str(row['rss_mb'] or '-'):>9}{row['peak_rss_mb']:>9}"
+              + (f"{row['traced_peak_mb']:>11}" if traced else ""))
+    print(f"{'total':<40}{result['total_seconds']:>10}")
+    if "profile" in result:
+        print(f"\n{'cumtime':>10}{'tottime':>10}{'calls':>10}  function ({result['profile']['path']})")
+        for row in result["profile"]["hotspots"]["cumulative"][:20]:
+            print(f"{row['cumtime']:>10}{row['tottime']:>10}{row['calls']:>10}  {row['function']}")
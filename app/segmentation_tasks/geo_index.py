@@ -0,0 +1,118 @@
+import glob
+import logging
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from segmentation_tasks.data_store import SNAPSHOT_DIR, data_version, load_table
+
+# Индекс «почтовый префикс -> центроид».
+# Строится один раз из geolocation (среднее по каждому городу префикса, затем
+# суммы и количество этих центроидов на префикс) и сохраняется рядом со снапшотом
+# с ключом по версии geolocation.csv. Пайплайн не группирует geolocation заново,
+# а находит строки индекса по отсортированному массиву префиксов (searchsorted).
+
+GEO_COLUMNS = ["geolocation_zip_code_prefix", "geolocation_city",
+               "geolocation_lat", "geolocation_lng"]
+ZIP_INDEX_COLUMNS = ["lat_sum", "lat_count", "lng_sum", "lng_count"]
+# Увеличивается при изменении способа построения индекса
+ZIP_INDEX_FORMAT_VERSION = 1
+
+# Индекс, уже загруженный в этом процессе
+_loaded = {}
+
+
+class ZipCentroidIndex:
+    """
+    Отсортированные префиксы и массивы сумм/количеств центроидов городов.
+    Префикс, которого нет в geolocation, даёт нули (как пропуск в старом merge).
+    """
+
+    def __init__(self, prefixes, columns):
+        self.prefixes = np.asarray(prefixes, dtype=np.int64)
+        self.columns = {name: np.asarray(columns[name], dtype=np.float64) for name in ZIP_INDEX_COLUMNS}
+
+    def __len__(self):
+        return len(self.prefixes)
+
+    @classmethod
+    def from_geolocation(cls, geolocation):
+        # observed=True: город — категория, без него groupby строил бы все пары город × индекс
+        city_zip = geolocation.groupby(
+            ["geolocation_city", "geolocation_zip_code_prefix"], observed=True
+        )[["geolocation_lat", "geolocation_lng"]].mean().reset_index()
+        stats = city_zip.groupby("geolocation_zip_code_prefix").agg(
+            lat_sum=("geolocation_lat", "sum"), lat_count=("geolocation_lat", "count"),
+            lng_sum=("geolocation_lng", "sum"), lng_count=("geolocation_lng", "count"))
+        # groupby сортирует ключи — массив префиксов готов для searchsorted
+        return cls(stats.index.to_numpy(dtype=np.int64), stats)
+
+    def positions(self, zip_prefixes):
+        """Номера строк индекса для префиксов; -1 — префикса нет (или он пустой)."""
+        keys = pd.to_numeric(pd.Series(zip_prefixes), errors="coerce").fillna(-1).to_numpy(dtype=np.int64)
+        if not len(self.prefixes):
+            return np.full(len(keys), -1)
+        found = np.minimum(np.searchsorted(self.prefixes, keys), len(self.prefixes) - 1)
+        return np.where(self.prefixes[found] == keys, found, -1)
+
+    def lookup(self, zip_prefixes):
+        """{колонка: массив значений} для каждого префикса, нули для неизвестных."""
+        found = self.positions(zip_prefixes)
+        missing = found < 0
+        return {name: np.where(missing, 0.0, values[found]) for name, values in self.columns.items()}
+
+    def centroids(self, zip_prefixes):
+        """Широта и долгота центроида префикса (NaN для неизвестных)."""
+        stats = self.lookup(zip_prefixes)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return stats["lat_sum"] / stats["lat_count"], stats["lng_sum"] / stats["lng_count"]
+
+    def save(self, path):
+        # Запись через временный файл: индекс могут собирать несколько задач одновременно
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, prefixes=self.prefixes, **self.columns)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data["prefixes"], {name: data[name] for name in ZIP_INDEX_COLUMNS})
+
+
+def _index_path(version):
+    return os.path.join(SNAPSHOT_DIR, f"zip_centroids.v{ZIP_INDEX_FORMAT_VERSION}-{version}.npz")
+
+
+def load_zip_index():
+    """
+    Индекс центроидов для текущей версии geolocation.csv: из памяти процесса,
+    из файла рядом со снапшотом или (при изменении данных) построенный заново.
+    """
+    version = data_version(["geolocation"])
+    if version in _loaded:
+        return _loaded[version]
+
+    path = _index_path(version)
+    if os.path.exists(path):
+        index = ZipCentroidIndex.load(path)
+    else:
+        started = time.perf_counter()
+        index = ZipCentroidIndex.from_geolocation(load_table("geolocation", GEO_COLUMNS))
+        os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+        index.save(path)
+        # Индексы прежних версий данных больше не нужны
+        for old in glob.glob(os.path.join(SNAPSHOT_DIR, "zip_centroids.*.npz")):
+            if old != path:
+                try:
+                    os.remove(old)
+                except OSError:
+                    pass
+        logging.info(f"[geo_index] индекс центроидов собран за {time.perf_counter() - started:.3f} с, "
+                     f"префиксов: {len(index)}")
+
+    _loaded.clear()
+    _loaded[version] = index
+    return index
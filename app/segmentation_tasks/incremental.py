@@ -0,0 +1,142 @@
+import json
+import logging
+import os
+import time
+
+import pandas as pd
+
+from segmentation_tasks.data_store import SNAPSHOT_DIR
+from segmentation_tasks.join_plan import build_order_frame, pooled_m2
+
+# Инкрементальное обновление сегментации.
+# Хранятся накопительные суммы на клиента (последняя покупка, frequency, monetary,
+# M2 платежей, суммы координат) и водяной знак — максимальная
+# order_purchase_timestamp обработанных заказов. При обновлении читаются только
+# заказы новее водяного знака, их суммы складываются с сохранёнными.
+#
+# Ограничение: платежи, позиции и отзывы, добавленные к уже обработанным заказам,
+# не учитываются — для этого нужен полный пересчёт (incremental=False).
+
+STATE_DIR = os.getenv("SEGMENT_STATE_DIR", os.path.join(SNAPSHOT_DIR, "segments_state"))
+STATE_PATH = os.path.join(STATE_DIR, "state.json")
+
+# Колонки, которые сворачиваются максимумом; M2 платежей — по Chan et al. (pooled_m2);
+# остальные — суммой
+MAX_COLUMNS = ["last_purchase"]
+M2_COLUMN = "monetary_m2"
+
+
+def load_state():
+    try:
+        with open(STATE_PATH, encoding="utf-8") as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    totals_path = os.path.join(STATE_DIR, state["totals_file"])
+    if not os.path.exists(totals_path):
+        return None
+    state["totals"] = pd.read_parquet(totals_path)
+    if M2_COLUMN not in state["totals"].columns:
+        # Состояние с суммами квадратов вместо M2 — нужен полный пересчёт
+        return None
+    state["watermark"] = pd.Timestamp(state["watermark"]) if state["watermark"] else None
+    return state
+
+
+def save_state(totals, watermark, watermark_order_ids):
+    """
+    Сохраняет суммы в новый файл и атомарно переключает на него state.json,
+    чтобы суммы и водяной знак не разошлись при падении посередине записи.
+    """
+    os.makedirs(STATE_DIR, exist_ok=True)
+    previous = None
+    try:
+        with open(STATE_PATH, encoding="utf-8") as f:
+            previous = json.load(f)["totals_file"]
+    except (OSError, ValueError, KeyError):
+        pass
+
+    totals_file = f"customer_totals.{time.time_ns()}.parquet"
+    totals.to_parquet(os.path.join(STATE_DIR, totals_file), index=False)
+
+    tmp_path = f"{STATE_PATH}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({
+            "totals_file": totals_file,
+            "watermark": watermark.isoformat() if watermark is not None else None,
+            "watermark_order_ids": sorted(watermark_order_ids),
+            "customers": len(totals),
+            "updated_at": pd.Timestamp.utcnow().isoformat(),
+        }, f)
+    os.replace(tmp_path, STATE_PATH)
+
+    if previous and previous != totals_file:
+        try:
+            os.remove(os.path.join(STATE_DIR, previous))
+        except OSError:
+            pass
+
+
+def fold_totals(state_totals, delta_totals):
+    """Складывает накопительные суммы двух прогонов по customer_unique_id."""
+    if len(delta_totals) == 0:
+        return state_totals
+    combined = pd.concat([state_totals, delta_totals], ignore_index=True)
+    rules = {c: ("max" if c in MAX_COLUMNS else "sum")
+             for c in combined.columns if c not in ("customer_unique_id", M2_COLUMN)}
+    folded = combined.groupby("customer_unique_id", sort=False).agg(rules)
+    folded[M2_COLUMN] = pooled_m2(combined["customer_unique_id"], combined["frequency"],
+                                  combined["monetary"], combined[M2_COLUMN])
+    return folded.reset_index()[combined.columns]
+
+
+def advance_watermark(orders, watermark=None, watermark_order_ids=()):
+    """
+    Новый водяной знак и id заказов с этой же меткой времени:
+    заказы с меткой, равной водяному знаку, при следующем прогоне читаются снова,
+    а уже обработанные исключаются по id.
+    """
+    timestamps = orders["order_purchase_timestamp"].dropna()
+    if timestamps.empty:
+        return watermark, set(watermark_order_ids)
+
+    latest = timestamps.max()
+    latest_ids = set(orders.loc[orders["order_purchase_timestamp"] == latest, "order_id"])
+    if watermark is not None and latest == watermark:
+        return watermark, set(watermark_order_ids) | latest_ids
+    if watermark is not None and latest < watermark:
+        return watermark, set(watermark_order_ids)
+    return latest, latest_ids
+
+
+def refresh_customer_totals(build_totals, columns, full=False, orders=None):
+    """
+    Возвращает актуальные накопительные суммы на клиента.
+
+    build_totals(orders) — функция, считающая суммы по фрейму заказов.
+    full=True или отсутствие состояния — пересчёт по всей истории,
+    иначе — свёртка только заказов новее водяного знака.
+    orders — уже построенный фрейм всех заказов для полного пересчёта.
+    """
+    state = None if full else load_state()
+    started = time.perf_counter()
+
+    if state is None:
+        if orders is None:
+            orders = build_order_frame(columns)
+        totals = build_totals(orders)
+        watermark, watermark_order_ids = advance_watermark(orders)
+        mode = "full"
+    else:
+        orders = build_order_frame(columns, since=state["watermark"],
+                                   exclude_order_ids=state["watermark_order_ids"])
+        totals = fold_totals(state["totals"], build_totals(orders))
+        watermark, watermark_order_ids = advance_watermark(
+            orders, state["watermark"], state["watermark_order_ids"])
+        mode = "incremental"
+
+    save_state(totals, watermark, watermark_order_ids)
+    logging.info(f"[incremental] {mode}: заказов {len(orders)}, клиентов {len(totals)}, "
+                 f"водяной знак {watermark}, {time.perf_counter() - started:.3f} с")
+    return totals
@@ -0,0 +1,316 @@
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+from metrics import stage_timer
+from segmentation_tasks.data_store import load_table, ROW_COMPLETE_COLUMN
+
+# План объединения на уровне заказа.
+# Вместо цепочки merge (items × payments × reviews на каждый заказ)
+# платежи, позиции и отзывы сначала агрегируются по order_id,
+# а затем присоединяются к заказам — одна строка на заказ.
+#
+# Чтобы RFM совпадал с прежним результатом, для каждого заказа считается,
+# сколько строк он давал в старом широком фрейме:
+#   row_weight      — все строки (до dropna), используется таймлайном;
+#   complete_weight — строки без пропусков (после dropna), используется RFM и когортами.
+
+ORDER_LEVEL_COLUMNS = {
+    "order_status": "orders",
+    "order_purchase_timestamp": "orders",
+    "order_approved_at": "orders",
+    "order_delivered_carrier_date": "orders",
+    "order_delivered_customer_date": "orders",
+    "order_estimated_delivery_date": "orders",
+    "customer_unique_id": "customers",
+    "customer_zip_code_prefix": "customers",
+    "customer_city": "customers",
+    "customer_state": "customers",
+}
+
+# Соединять таблицы по 64-битным хэшам id вместо строк: меньше памяти и быстрее
+# merge/groupby на больших данных. Вероятность коллизии ~ n² / 2⁶⁵ (для миллиона
+# ключей ~3·10⁻⁸); customer_unique_id и order_id в результате остаются строками.
+# customer_id не хэшируется: outer merge с клиентами сортирует строки по ключу,
+# и порядок строк (а с ним суммы координат и state_list) должен совпадать со строковым.
+HASH_IDS = os.getenv("OLIST_HASH_IDS", "0") == "1"
+HASHED_ID_COLUMNS = ["order_id", "product_id", "seller_id"]
+
+# Колонки уровня заказа, которые нужны каждому потребителю
+CONSUMER_COLUMNS = {
+    "segments": ["customer_unique_id", "order_purchase_timestamp", "customer_zip_code_prefix"],
+    "cohort": ["customer_unique_id", "order_purchase_timestamp", "customer_state"],
+    "timeline": ["customer_unique_id", "order_purchase_timestamp", "customer_state"],
+}
+
+
+def hash_ids(values):
+    """uint64-хэши строковых id."""
+    return pd.util.hash_pandas_object(values, index=False).values
+
+
+def _key_flags(df, key):
+    """Series {ключ: строка без пропусков} для таблицы-справочника."""
+    if df[key].duplicated().any():
+        # В старом merge дубликаты ключей размножали строки — здесь они схлопываются
+        logging.warning(f"[join_plan] неуникальный ключ {key}: результат может отличаться от merge_data")
+        df = df.drop_duplicates(key)
+    return pd.Series(df[ROW_COMPLETE_COLUMN].values, index=np.asarray(df[key], dtype=object))
+
+
+def _map_flag(keys, flags):
+    # Ключи-категории (например, product_category_name) сопоставляются по значениям
+    if isinstance(keys.dtype, pd.CategoricalDtype):
+        keys = keys.astype(object)
+    return keys.map(flags).fillna(False).astype(bool)
+
+
+def _item_stats(tables, legacy_dropna):
+    items = tables["items"]
+    if legacy_dropna:
+        # Строка позиции переживает dropna, только если полны сама позиция,
+        # её товар, категория товара (с переводом) и продавец
+        products = tables["products"]
+        category_ok = _key_flags(tables["category_translation"], "product_category_name")
+        product_ok = products[ROW_COMPLETE_COLUMN] & _map_flag(products["product_category_name"], category_ok)
+        product_ok = _key_flags(products.assign(**{ROW_COMPLETE_COLUMN: product_ok}), "product_id")
+        seller_ok = _key_flags(tables["sellers"], "seller_id")
+        ok = (items[ROW_COMPLETE_COLUMN]
+              & _map_flag(items["product_id"], product_ok)
+              & _map_flag(items["seller_id"], seller_ok))
+    else:
+        ok = pd.Series(True, index=items.index)
+
+    stats = pd.DataFrame({"order_id": items["order_id"].values, "ok": ok.values})
+    return stats.groupby("order_id")["ok"].agg(n_items="size", n_items_complete="sum")
+
+
+def _payment_stats(tables, legacy_dropna):
+    payments = tables["order_payments"]
+    ok = payments[ROW_COMPLETE_COLUMN] if legacy_dropna else payments["payment_value"].notna()
+    value = payments["payment_value"].where(ok, 0.0)
+    stats = pd.DataFrame({
+        "order_id": payments["order_id"].values,
+        "ok": ok.values,
+        "value": value.values,
+    })
+    # Разброс платежей заказа — сумма квадратов отклонений от среднего заказа (M2):
+    # в отличие от Σx² − (Σx)²/n она не теряет точность на крупных близких платежах
+    grouped = stats.groupby("order_id")
+    n_ok = grouped["ok"].transform("sum")
+    mean = grouped["value"].transform("sum") / n_ok.where(n_ok > 0)
+    stats["deviation_sq"] = ((stats["value"] - mean) ** 2).where(stats["ok"], 0.0)
+    return stats.groupby("order_id").agg(
+        n_payments=("ok", "size"),
+        n_payments_complete=("ok", "sum"),
+        payment_sum=("value", "sum"),
+        payment_m2=("deviation_sq", "sum"),
+    )
+
+
+def _review_stats(tables, legacy_dropna):
+    reviews = tables["order_reviews"]
+    ok = reviews[ROW_COMPLETE_COLUMN] if legacy_dropna else pd.Series(True, index=reviews.index)
+    stats = pd.DataFrame({"order_id": reviews["order_id"].values, "ok": ok.values})
+    return stats.groupby("order_id")["ok"].agg(n_reviews="size", n_reviews_complete="sum")
+
+
+def build_order_frame(columns, legacy_dropna=True, since=None, exclude_order_ids=(), hash_keys=None):
+    """
+    Строит фрейм «одна строка на заказ» с нужными колонками уровня заказа
+    и агрегатами платежей/позиций/отзывов. Клиенты без заказов дают строку
+    с пустым order_id и нулевым complete_weight.
+
+    columns — колонки уровня заказа (см. ORDER_LEVEL_COLUMNS и CONSUMER_COLUMNS).
+    legacy_dropna — воспроизводить отбрасывание строк с любыми пропусками,
+    как делал dropna() по широкому фрейму. Для этого читаются флаги полноты
+    товаров, продавцов и категорий; при False эти таблицы не загружаются.
+    since — взять только заказы с order_purchase_timestamp >= since
+    (кроме exclude_order_ids); позиции, платежи, отзывы и клиенты читаются
+    только для этих заказов, клиенты без заказов не добавляются.
+    hash_keys — соединять по хэшам id (по умолчанию OLIST_HASH_IDS).
+    """
+    if hash_keys is None:
+        hash_keys = HASH_IDS
+    unknown = set(columns) - set(ORDER_LEVEL_COLUMNS)
+    if unknown:
+        raise KeyError(f"Неизвестные колонки уровня заказа: {sorted(unknown)}")
+
+    order_columns = [c for c in columns if ORDER_LEVEL_COLUMNS[c] == "orders"]
+    customer_columns = [c for c in columns if ORDER_LEVEL_COLUMNS[c] == "customers"]
+    if "customer_unique_id" not in customer_columns:
+        customer_columns.append("customer_unique_id")
+
+    count_columns = ["n_items", "n_items_complete", "n_payments", "n_payments_complete",
+                     "n_reviews", "n_reviews_complete"]
+    keep = ["order_id"] + list(columns) + count_columns + [
+        "payment_sum", "payment_m2", "row_weight",
+        "complete_weight", "payment_sum_weighted", "payment_m2_weighted"]
+
+    order_spec = ["order_id", "customer_id", ROW_COMPLETE_COLUMN] + order_columns
+    # Метрики частей этапа: чтение таблиц (load) и объединение (merge)
+    with stage_timer("load") as loaded:
+        if since is None:
+            orders = load_table("orders", order_spec)
+            order_filter = customer_filter = None
+        else:
+            if "order_purchase_timestamp" not in order_spec:
+                order_spec.append("order_purchase_timestamp")
+            orders = load_table("orders", order_spec, filters=[("order_purchase_timestamp", ">=", pd.Timestamp(since))])
+            orders = orders[~orders["order_id"].isin(list(exclude_order_ids))]
+            if orders.empty:
+                return pd.DataFrame(columns=keep)
+            order_filter = [("order_id", "in", orders["order_id"].tolist())]
+            customer_filter = [("customer_id", "in", orders["customer_id"].unique().tolist())]
+
+        spec = {
+            "customers": (["customer_id", ROW_COMPLETE_COLUMN] + customer_columns, customer_filter),
+            "items": (["order_id", "product_id", "seller_id", ROW_COMPLETE_COLUMN], order_filter),
+            "order_payments": (["order_id", "payment_value", ROW_COMPLETE_COLUMN], order_filter),
+            "order_reviews": (["order_id", ROW_COMPLETE_COLUMN], order_filter),
+        }
+        if legacy_dropna:
+            spec["products"] = (["product_id", "product_category_name", ROW_COMPLETE_COLUMN], None)
+            spec["sellers"] = (["seller_id", ROW_COMPLETE_COLUMN], None)
+            spec["category_translation"] = (["product_category_name", ROW_COMPLETE_COLUMN], None)
+        tables = {table: load_table(table, table_columns, filters)
+                  for table, (table_columns, filters) in spec.items()}
+        loaded["rows"] = len(orders) + sum(len(t) for t in tables.values())
+
+    with stage_timer("merge") as merged:
+        df = orders.rename(columns={ROW_COMPLETE_COLUMN: "order_ok"})
+        order_key = "order_id"
+        if hash_keys:
+            # order_id заказа остаётся строкой (водяной знак, выдача), соединение — по хэшу
+            order_key = "_order_key"
+            df[order_key] = hash_ids(df["order_id"])
+            for table in tables.values():
+                for column in HASHED_ID_COLUMNS:
+                    if column in table.columns:
+                        table[column] = hash_ids(table[column])
+
+        # Агрегаты присоединяются на уровне заказа, до outer merge с клиентами:
+        # ключ заказа ещё без пропусков и сохраняет тип
+        df = df.join(_item_stats(tables, legacy_dropna), on=order_key)
+        df = df.join(_payment_stats(tables, legacy_dropna), on=order_key)
+        df = df.join(_review_stats(tables, legacy_dropna), on=order_key)
+
+        customers = tables["customers"].rename(columns={ROW_COMPLETE_COLUMN: "customer_ok"})
+        # outer, как в merge_data: клиенты без заказов тоже дают строку (с пустым order_id)
+        df = df.merge(customers, on="customer_id", how="outer" if since is None else "left", validate="m:1")
+        df = df[~df["customer_unique_id"].isna()]
+
+        df[count_columns] = df[count_columns].fillna(0).astype("int64")
+        df[["payment_sum", "payment_m2"]] = df[["payment_sum", "payment_m2"]].fillna(0.0)
+
+        # Заказ без позиций/платежей/отзывов давал в outer/left join одну строку с пропусками
+        df["row_weight"] = (df["n_items"].clip(lower=1)
+                            * df["n_payments"].clip(lower=1)
+                            * df["n_reviews"].clip(lower=1))
+
+        if legacy_dropna:
+            order_ok = (df["order_ok"].fillna(False).astype(bool)
+                        & df["customer_ok"].fillna(False).astype(bool)).astype("int64")
+        else:
+            order_ok = pd.Series(1, index=df.index)
+
+        # Каждый платёж повторялся для каждой позиции и каждого отзыва заказа
+        fan_out = order_ok * df["n_items_complete"] * df["n_reviews_complete"]
+        df["complete_weight"] = fan_out * df["n_payments_complete"]
+        df["payment_sum_weighted"] = fan_out * df["payment_sum"]
+        # Повтор платежей не меняет среднее заказа, отклонения повторяются fan_out раз
+        df["payment_m2_weighted"] = fan_out * df["payment_m2"]
+
+        df = df[keep].reset_index(drop=True)
+        merged["rows"] = len(df)
+    return df
+
+
+def pooled_m2(keys, count, total, m2):
+    """
+    M2 (сумма квадратов отклонений от среднего) групп keys по частям с известными
+    count, total и M2 — объединение по Chan et al.: ΣM2ᵢ + Σnᵢ(x̄ᵢ − x̄)².
+    Работает с центрированными величинами, поэтому точен и для крупных близких значений.
+    """
+    count = pd.Series(np.asarray(count, dtype="float64"), index=total.index)
+    group_mean = total.groupby(keys).transform("sum") / count.groupby(keys).transform("sum")
+    with np.errstate(invalid="ignore", divide="ignore"):
+        between = count * (total / count - group_mean) ** 2
+    return (m2 + between.where(count > 0, 0.0)).groupby(keys).sum()
+
+
+def customer_totals(orders):
+    """
+    Накопительные суммы на клиента: дата последней покупки, frequency, monetary
+    и M2 платежей (monetary_m2). Считаются по строкам старого широкого фрейма
+    (с учётом complete_weight) и складываются между прогонами (см. incremental).
+    """
+    valid = orders[orders["complete_weight"] > 0]
+    totals = valid.groupby("customer_unique_id").agg(
+        last_purchase=("order_purchase_timestamp", "max"),
+        frequency=("complete_weight", "sum"),
+        monetary=("payment_sum_weighted", "sum"),
+    )
+    totals["monetary_m2"] = pooled_m2(valid["customer_unique_id"], valid["complete_weight"],
+                                      valid["payment_sum_weighted"], valid["payment_m2_weighted"])
+    return totals.reset_index()
+
+
+def finalize_aggregates(totals):
+    """recency/frequency/monetary/std_dev из накопительных сумм customer_totals."""
+    rfm = totals[totals["frequency"] > 0]
+    current_date = rfm["last_purchase"].max() + pd.Timedelta(days=1)
+
+    rfm = rfm[["customer_unique_id", "frequency", "monetary"]].assign(
+        recency=(current_date - rfm["last_purchase"]).dt.days,
+        std_dev=sample_std(rfm["frequency"], rfm["monetary_m2"]),
+    )
+    return rfm[["customer_unique_id", "recency", "frequency", "monetary", "std_dev"]].reset_index(drop=True)
+
+
+def customer_aggregates(orders):
+    """
+    Агрегаты RFM на клиента из фрейма заказов.
+    frequency, monetary и std_dev совпадают с расчётом по широкому фрейму.
+    """
+    return finalize_aggregates(customer_totals(orders))
+
+
+def sample_std(count, m2):
+    """Выборочное стандартное отклонение (ddof=1) по count и M2."""
+    count = np.asarray(count, dtype="float64")
+    m2 = np.asarray(m2, dtype="float64")
+    with np.errstate(invalid="ignore", divide="ignore"):
+        variance = m2 / (count - 1)
+    variance = np.where(count > 1, np.clip(variance, 0, None), np.nan)
+    return np.sqrt(variance)
+
+
+def compare_rfm(legacy, new, tolerance=1e-6):
+    """
+    Сравнивает frequency/monetary/recency двух таблиц RFM по customer_unique_id.
+    Возвращает отчёт о расхождениях; пустой список mismatches — полное совпадение.
+    """
+    merged = legacy.merge(new, on="customer_unique_id", how="outer",
+                          suffixes=("_legacy", "_new"), indicator=True)
+    report = {
+        "customers_legacy": int((merged["_merge"] != "right_only").sum()),
+        "customers_new": int((merged["_merge"] != "left_only").sum()),
+        "only_legacy": int((merged["_merge"] == "left_only").sum()),
+        "only_new": int((merged["_merge"] == "right_only").sum()),
+        "mismatches": [],
+    }
+    both = merged[merged["_merge"] == "both"]
+    for column in ["frequency", "monetary", "recency"]:
+        diff = (both[f"{column}_legacy"] - both[f"{column}_new"]).abs()
+        bad = diff > tolerance * np.maximum(1.0, both[f"{column}_legacy"].abs())
+        if bad.any():
+            report["mismatches"].append({
+                "column": column,
+                "customers": int(bad.sum()),
+                "max_abs_diff": float(diff.max()),
+                "examples": both.loc[bad, "customer_unique_id"].head(5).tolist(),
+            })
+    return report
@@ -0,0 +1,68 @@
+import logging
+import os
+import time
+
+import pandas as pd
+from billiard import Pool
+
+# Параллельный расчёт накопительных сумм RFM по партициям клиентов.
+# Заказы хэш-партиционируются по customer_unique_id, поэтому каждый клиент
+# целиком попадает в одну партицию и суммы партиций просто склеиваются.
+# Глобальные шаги — квартильные границы, сортировка ABC по накопленной сумме
+# и квантили риска оттока — выполняются один раз по склеенной таблице клиентов
+# (rfm_core.score_customers), поэтому квантили точные.
+#
+# Используется billiard (пул из зависимостей Celery): стандартный multiprocessing
+# не разрешает создавать дочерние процессы из демонических воркеров Celery.
+
+RFM_WORKERS = int(os.getenv("RFM_WORKERS", "1"))
+
+# Фрейм текущего расчёта: передаётся дочерним процессам через fork без сериализации
+_shared_orders = None
+_shared_compute = None
+
+
+def partition_codes(customer_ids, n_partitions):
+    """Номер партиции для каждого customer_unique_id (стабильный хэш)."""
+    hashes = pd.util.hash_pandas_object(customer_ids, index=False).values
+    return hashes % n_partitions
+
+
+def _compute_partition(partition):
+    mask = _shared_compute["codes"] == partition
+    return _shared_compute["func"](_shared_orders[mask])
+
+
+def parallel_customer_totals(orders, compute_totals, workers=None):
+    """
+    Считает compute_totals(orders) по партициям клиентов в пуле из workers процессов
+    и склеивает результат. При workers <= 1 считает в текущем процессе.
+    """
+    global _shared_orders, _shared_compute
+
+    workers = workers or RFM_WORKERS
+    if workers <= 1 or len(orders) == 0:
+        return compute_totals(orders)
+
+    started = time.perf_counter()
+    _shared_orders = orders
+    _shared_compute = {
+        "func": compute_totals,
+        "codes": partition_codes(orders["customer_unique_id"], workers),
+    }
+    pool = Pool(processes=workers)
+    try:
+        # Задача на партицию, а не pool.map: готовность результата map billiard засчитывает
+        # только одному процессу, и остальные перед выходом до 30 с ждут подтверждения
+        # доставки своих результатов (pool.join ждёт их вместе с ними)
+        pending = [pool.apply_async(_compute_partition, (partition,)) for partition in range(workers)]
+        parts = [result.get() for result in pending]
+    finally:
+        pool.terminate()
+        pool.join()
+        _shared_orders = _shared_compute = None
+
+    totals = pd.concat(parts, ignore_index=True)
+    logging.info(f"[parallel_rfm] {workers} партиций, заказов {len(orders)}, клиентов {len(totals)}, "
+                 f"{time.perf_counter() - started:.3f} с")
+    return totals
@@ -0,0 +1,108 @@
+import cProfile
+import glob
+import os
+import pstats
+import tracemalloc
+
+from segmentation_tasks.data_store import SNAPSHOT_DIR
+
+# Профилирование прогона DAG по запросу (profile=True у задачи или /reload?profile=1).
+# cProfile включается на весь прогон, сводка «горячих» функций сохраняется
+# вместе с отчётом по этапам (см. redis_cache.save_profile), полная статистика —
+# файлом .prof для snakeviz/pstats. С trace_memory дополнительно включается
+# tracemalloc и для каждого этапа записывается пик выделенной памяти.
+# Процессы расчёта RFM (workers > 1) не профилируются.
+
+PROFILE_DIR = os.getenv("PIPELINE_PROFILE_DIR", os.path.join(SNAPSHOT_DIR, "profiles"))
+# Сколько функций в сводке и сколько файлов .prof хранить
+PROFILE_TOP = int(os.getenv("PIPELINE_PROFILE_TOP", "40"))
+PROFILE_KEEP_FILES = int(os.getenv("PIPELINE_PROFILE_KEEP_FILES", "20"))
+PROFILE_SORT_KEYS = ("cumulative", "tottime")
+
+
+def _function_name(func):
+    path, line, name = func
+    if path == "~":
+        # Встроенные функции: {method 'sum' of 'numpy.ndarray' objects}
+        return name
+    # Пути пакетов укорачиваются до имени пакета
+    for marker in ("site-packages/", "dist-packages/"):
+        if marker in path:
+            path = path.split(marker, 1)[1]
+            break
+    else:
+        path = os.path.relpath(path) if os.path.isabs(path) else path
+    return f"{path}:{line}({name})"
+
+
+class RunProfiler:
+    """cProfile на весь прогон и (опционально) пик tracemalloc каждого этапа."""
+
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.profiler = cProfile.Profile()
+        # Пики выполняющихся этапов (вложенные — в конце)
+        self._peaks = []
+
+    def start(self):
+        if self.trace_memory:
+            tracemalloc.start()
+        self.profiler.enable()
+
+    def stop(self):
+        self.profiler.disable()
+        if self.trace_memory:
+            tracemalloc.stop()
+
+    def stage_started(self):
+        if not self.trace_memory:
+            return
+        # Вложенный этап сбрасывает счётчик пика: пик родителя до этого момента запоминается
+        if self._peaks:
+            self._peaks[-1] = max(self._peaks[-1], tracemalloc.get_traced_memory()[1])
+        self._peaks.append(0)
+        tracemalloc.reset_peak()
+
+    def stage_finished(self):
+        """Пик отслеживаемой памяти за время этапа в МБ (None без trace_memory)."""
+        if not self.trace_memory:
+            return None
+        peak = max(self._peaks.pop(), tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+        if self._peaks:
+            self._peaks[-1] = max(self._peaks[-1], peak)
+        return round(peak / 2 ** 20, 1)
+
+    def hotspots(self, sort="cumulative", top=PROFILE_TOP):
+        stats = pstats.Stats(self.profiler)
+        column = {"cumulative": 3, "tottime": 2}[sort]
+        rows = sorted(stats.stats.items(), key=lambda item: -item[1][column])[:top]
+        return [{
+            "function": _function_name(func),
+            "calls": calls,
+            "primitive_calls": primitive_calls,
+            "tottime": round(tottime, 4),
+            "cumtime": round(cumtime, 4),
+        } for func, (primitive_calls, calls, tottime, cumtime, _) in rows]
+
+    def summary(self, top=PROFILE_TOP):
+        stats = pstats.Stats(self.profiler)
+        return {
+            "total_calls": stats.total_calls,
+            "trace_memory": self.trace_memory,
+            "hotspots": {sort: self.hotspots(sort, top) for sort in PROFILE_SORT_KEYS},
+        }
+
+    def dump(self, name):
+        """Сохраняет полную статистику в PROFILE_DIR/<name>.prof и возвращает путь."""
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        path = os.path.join(PROFILE_DIR, f"{name}.prof")
+        self.profiler.dump_stats(path)
+        # Старые файлы удаляются
+        files = sorted(glob.glob(os.path.join(PROFILE_DIR, "*.prof")), key=os.path.getmtime, reverse=True)
+        for old in files[PROFILE_KEEP_FILES:]:
+            try:
+                os.remove(old)
+            except OSError:
+                pass
+        return path
@@ -0,0 +1,75 @@
+import logging
+import os
+import uuid
+
+from celery.result import AsyncResult
+from celery.states import PENDING, READY_STATES
+
+from segmentation_tasks.celery_app import celery_app
+from segmentation_tasks.constants import LEAVES
+from redis_cache import claim_refresh, refresh_locks, release_refresh
+
+# Постановка пересчёта из API и стартовой задачи.
+# Задача ставится по имени через send_task, поэтому модуль задач (и пайплайны с pandas)
+# в процесс API не импортируется — их загружает только воркер.
+
+REFRESH_TASK = "segmentation_tasks.tasks.run_refresh"
+
+# Задержка запуска пересчёта: запросы, пришедшие за это время,
+# присоединяются к уже поставленной задаче (0 — запускать сразу)
+REFRESH_DEBOUNCE_SECONDS = float(os.getenv("REFRESH_DEBOUNCE_SECONDS", "5"))
+# Сколько задача может оставаться PENDING после задержки запуска, прежде чем её блокировка
+# считается брошенной (сообщение потеряно брокером или API упал между захватом и отправкой).
+# Запас покрывает ожидание свободного воркера; запущенная задача сразу переходит в PROGRESS
+REFRESH_PENDING_GRACE_SECONDS = float(os.getenv("REFRESH_PENDING_GRACE_SECONDS", "600"))
+
+
+def _is_stale(holder, age):
+    """Блокировка задачи holder, занятая age секунд назад, больше не защищает пересчёт."""
+    state = AsyncResult(holder, app=celery_app).state
+    if state in READY_STATES:
+        return True
+    return (state == PENDING and age is not None
+            and age > REFRESH_DEBOUNCE_SECONDS + REFRESH_PENDING_GRACE_SECONDS)
+
+
+def submit_refresh(leaves=None, incremental=False, profile=False, trace_memory=False):
+    """
+    Ставит пересчёт листов (по умолчанию всех) с защитой от повторов.
+    Лист, который уже пересчитывает другая задача (поставленная или выполняемая),
+    не пересчитывается второй раз — запрос присоединяется к ней; новая задача
+    ставится только для свободных листов и стартует через REFRESH_DEBOUNCE_SECONDS.
+    Режим incremental и профилирование (profile, trace_memory) учитываются только новой задачей.
+    Возвращает {"task_id": новая задача или та, к которой присоединились,
+    "coalesced": новая задача не понадобилась, "tasks": {лист: id задачи},
+    "profiled": новая задача профилируется}.
+    """
+    leaves = list(leaves or LEAVES)
+
+    # Блокировки завершившихся задач (воркер упал до освобождения) снимаются сразу,
+    # так и не запущенных — по истечении задержки и запаса
+    for leaf, (holder, age) in refresh_locks(leaves).items():
+        if holder and _is_stale(holder, age):
+            logging.warning(f"[tasks] снята брошенная блокировка {leaf} задачи {holder}")
+            release_refresh([leaf], holder)
+
+    task_id = str(uuid.uuid4())
+    holders = claim_refresh(leaves, task_id)
+    claimed = [leaf for leaf in leaves if holders[leaf] == task_id]
+    if claimed:
+        try:
+            celery_app.send_task(
+                REFRESH_TASK,
+                kwargs={"leaves": claimed, "incremental": incremental,
+                        "profile": profile, "trace_memory": trace_memory},
+                task_id=task_id, countdown=REFRESH_DEBOUNCE_SECONDS or None)
+        except Exception:
+            release_refresh(claimed, task_id)
+            raise
+        logging.info(f"[tasks] пересчёт {claimed} поставлен задачей {task_id}")
+    else:
+        task_id = holders[leaves[0]]
+        logging.info(f"[tasks] пересчёт {leaves} уже выполняется, присоединились к {task_id}")
+
+    return {"task_id": task_id, "coalesced": not claimed, "tasks": holders,
+            "profiled": bool(claimed and profile)}
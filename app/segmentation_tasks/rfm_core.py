@@ -0,0 +1,136 @@
+import numpy as np
+import pandas as pd
+
+from segmentation_tasks.constants import CHURN_LABELS, SEGMENT_DESCRIPTIONS
+
+# Векторизованное ядро RFM/ABC/XYZ, общее для сегментации и таймлайна.
+# Повторяет логику прежнего process_data без построчных lambda/apply:
+# квартили и ABC/XYZ считаются через np.quantile и np.searchsorted.
+
+RFM_WEIGHTS = {'R': 0.5, 'F': 0.3, 'M': 0.2}
+
+CHURN_QUANTILES = [0, 0.25, 0.75, 1]
+
+# Границы ABC по накопленному проценту выручки: <=80 — A, <=95 — B, иначе C
+ABC_CLASSES = np.array(['A', 'B', 'C'])
+ABC_BOUNDS = np.array([80.0, 95.0])
+
+# Границы XYZ по стандартному отклонению платежей, интервалы (a, b]
+XYZ_BINS = np.array([-1, 0.01, 50, float('inf')])
+XYZ_CATEGORIES = ['X', 'Y', 'Z', 'Single Purchase']
+
+
+# Все сегменты в порядке кода abc * len(XYZ_CATEGORIES) + xyz
+SEGMENT_NAMES = np.array([f"{abc}_{xyz}" for abc in ABC_CLASSES for xyz in XYZ_CATEGORIES])
+
+
+def aggregate_rows(df):
+    """
+    Агрегаты RFM по строкам заказов (как в прежнем process_data):
+    recency, frequency (число строк), monetary (сумма платежей), std_dev платежей.
+    """
+    df = df.dropna()
+    grouped = df.groupby('customer_unique_id')
+    rfm = grouped.agg(
+        last_purchase=('order_purchase_timestamp', 'max'),
+        frequency=('order_id', 'count'),
+        monetary=('payment_value', 'sum'),
+        std_dev=('payment_value', 'std'),
+    ).reset_index()
+
+    current_date = df['order_purchase_timestamp'].max() + pd.Timedelta(days=1)
+    rfm['recency'] = (current_date - rfm['last_purchase']).dt.days
+    return rfm[['customer_unique_id', 'recency', 'frequency', 'monetary', 'std_dev']]
+
+
+def quantile_edges(values, q, duplicates='drop'):
+    """Границы квантилей как в pd.qcut (линейная интерполяция)."""
+    values = np.asarray(values, dtype='float64')
+    edges = np.quantile(values[~np.isnan(values)], q)
+    unique_edges = np.unique(edges)
+    if len(unique_edges) != len(edges) and duplicates == 'raise':
+        raise ValueError(f"Bin edges must be unique: {edges!r}.")
+    return unique_edges
+
+
+def assign_bins(values, edges):
+    """
+    Номер интервала (e[i], e[i+1]] для каждого значения; первый интервал включает e[0].
+    Эквивалент pd.cut(..., include_lowest=True, labels=False) для отсортированных edges.
+    """
+    values = np.asarray(values, dtype='float64')
+    if len(edges) < 2:
+        # Все значения совпадают — интервалов нет, как и в pd.qcut
+        return np.full(len(values), np.nan)
+    codes = np.searchsorted(edges, values, side='left') - 1
+    # Значение, равное нижней границе, попадает в первый интервал
+    codes[values == edges[0]] = 0
+    outside = np.isnan(values) | (values < edges[0]) | (values > edges[-1])
+    if outside.any():
+        return np.where(outside, np.nan, codes)
+    return codes
+
+
+def quartile_codes(values, edges=None):
+    """Квартиль 0..3 (меньше при совпадающих границах), как pd.qcut(x, 4, labels=False, duplicates='drop')."""
+    if edges is None:
+        edges = quantile_edges(values, [0, 0.25, 0.5, 0.75, 1])
+    return assign_bins(values, edges)
+
+
+def churn_risk(weighted, labels=CHURN_LABELS, edges=None):
+    """Риск оттока по квантилям взвешенного RFM, как pd.qcut(x, q=[0, .25, .75, 1], labels=labels)."""
+    if edges is None:
+        edges = quantile_edges(weighted, CHURN_QUANTILES, duplicates='raise')
+    codes = assign_bins(weighted, edges)
+    codes = np.where(np.isnan(codes), -1, codes).astype('int8')
+    return pd.Categorical.from_codes(codes, categories=labels, ordered=True)
+
+
+def abc_codes(cumulative_percent):
+    return np.searchsorted(ABC_BOUNDS, np.asarray(cumulative_percent, dtype='float64'), side='left')
+
+
+def xyz_codes(std_dev):
+    std_dev = np.asarray(std_dev, dtype='float64')
+    codes = np.searchsorted(XYZ_BINS, std_dev, side='left') - 1
+    # Нет разброса (одна покупка) или значение вне интервалов — Single Purchase
+    single = np.isnan(std_dev) | (codes < 0) | (codes > 2)
+    return np.where(single, len(XYZ_CATEGORIES) - 1, codes)
+
+
+def score_customers(rfm, churn_labels=CHURN_LABELS):
+    """
+    Квартили RFM, взвешенный балл, риск оттока, ABC/XYZ и сегменты
+    по таблице клиентов с колонками customer_unique_id, recency, frequency, monetary, std_dev.
+    """
+    rfm = rfm.copy()
+
+    # Квантильный анализ
+    rfm['r_quartile'] = quartile_codes(rfm['recency'].values)
+    rfm['f_quartile'] = quartile_codes(rfm['frequency'].values)
+    rfm['m_quartile'] = quartile_codes(rfm['monetary'].values)
+    rfm['rfm_score'] = rfm[['r_quartile', 'f_quartile', 'm_quartile']].sum(axis=1)
+
+    rfm['RFM_Weighted'] = (rfm['r_quartile'] * RFM_WEIGHTS['R'] +
+                           rfm['f_quartile'] * RFM_WEIGHTS['F'] +
+                           rfm['m_quartile'] * RFM_WEIGHTS['M'])
+    rfm['Churn_Risk'] = churn_risk(rfm['RFM_Weighted'].values, churn_labels)
+
+    # ABC
+    rfm = rfm.sort_values('monetary', ascending=False)
+    rfm['cumulative_value'] = rfm['monetary'].cumsum()
+    total_value = rfm['monetary'].sum()
+    rfm['cumulative_percent'] = rfm['cumulative_value'] / total_value * 100
+    abc = abc_codes(rfm['cumulative_percent'].values)
+    rfm['abc_class'] = ABC_CLASSES[abc]
+
+    # XYZ
+    xyz = xyz_codes(rfm['std_dev'].values)
+    rfm['x_category'] = pd.Categorical.from_codes(xyz, categories=XYZ_CATEGORIES)
+
+    # Сегментация клиентов
+    segment = SEGMENT_NAMES[abc * len(XYZ_CATEGORIES) + xyz]
+    rfm['segment'] = segment
+    rfm['segment_description'] = pd.Series(segment, index=rfm.index).map(SEGMENT_DESCRIPTIONS)
+    return rfm
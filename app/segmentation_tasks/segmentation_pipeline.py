@@ -1,24 +1,44 @@
-import os
+import logging
+from functools import partial
 import pandas as pd
 import json
 
+from segmentation_tasks.constants import SEGMENT_CHURN_LABELS
+from segmentation_tasks.data_store import load_tables
+from segmentation_tasks.geo_index import GEO_COLUMNS, load_zip_index
+from segmentation_tasks.join_plan import (
+    CONSUMER_COLUMNS, build_order_frame, compare_rfm, customer_aggregates,
+    customer_totals, finalize_aggregates)
+from segmentation_tasks.incremental import refresh_customer_totals
+from segmentation_tasks.parallel_rfm import parallel_customer_totals
+from segmentation_tasks.rfm_core import CHURN_LABELS as RFM_CHURN_LABELS, aggregate_rows, score_customers
+
 
 import warnings
 warnings.filterwarnings("ignore")
 
 # Загрузка данных
+# Таблицы читаются из общего колоночного снапшота (см. data_store)
+
+# Метки риска оттока в выдаче /segments
+CHURN_LABELS = SEGMENT_CHURN_LABELS
+
+
 def load_data():
-    customers = pd.read_csv("research/clean_data/customers.csv")
-    geolocation = pd.read_csv("research/clean_data/geolocation.csv")
-    order_pay = pd.read_csv("research/clean_data/order_payments.csv")
-    reviews = pd.read_csv("research/clean_data/order_reviews.csv")
-    orders = pd.read_csv("research/clean_data/orders.csv")
-    item = pd.read_csv("research/clean_data/orders_items.csv")
-    category_name = pd.read_csv(
-        "research/clean_data/product_category_name_translation.csv")
-    products = pd.read_csv("research/clean_data/products.csv")
-    sellers = pd.read_csv("research/clean_data/sellers.csv")
-    return customers, geolocation, order_pay, reviews, orders, item, category_name, products, sellers
+    tables = load_tables({
+        "customers": None,
+        "geolocation": GEO_COLUMNS,
+        "order_payments": None,
+        "order_reviews": None,
+        "orders": None,
+        "items": None,
+        "category_translation": None,
+        "products": None,
+        "sellers": None,
+    })
+    return (tables["customers"], tables["geolocation"], tables["order_payments"],
+            tables["order_reviews"], tables["orders"], tables["items"],
+            tables["category_translation"], tables["products"], tables["sellers"])
 
 # Объединение данных
 
@@ -49,7 +69,7 @@ def main_pipeline():
                     customers, sellers, category_name)
     df = filter_customers(df)
     
-    city_zip = geolocation.groupby(["geolocation_city", "geolocation_zip_code_prefix"])[
+    city_zip = geolocation.groupby(["geolocation_city", "geolocation_zip_code_prefix"], observed=True)[
     ["geolocation_lat", "geolocation_lng"]].mean().reset_index()
 
     geo_result = city_zip
@@ -65,95 +85,17 @@ def process_data(df):
         df['order_purchase_timestamp'])
     df['customer_unique_id'] = df['customer_unique_id'].astype(str)
 
-    # Убираем строки с отсутствующими customer_id или order_purchase_timestamp
-    df = df.dropna()
+    # RFM по строкам (строки с пропусками отбрасываются внутри)
+    return segment_rfm(aggregate_rows(df))
 
-    # RFM
-    current_date = df['order_purchase_timestamp'].max() + pd.Timedelta(days=1)
-    rfm = df.groupby('customer_unique_id').agg({
-        'order_purchase_timestamp': lambda x: (current_date - x.max()).days,
-        'order_id': 'count',
-        'payment_value': 'sum'
-    }).rename(columns={
-        'order_purchase_timestamp': 'recency',
-        'order_id': 'frequency',
-        'payment_value': 'monetary'
-    }).reset_index()
-
-    # Применяем квантильный анализ
-    rfm['r_quartile'] = pd.qcut(
-        rfm['recency'], 4, labels=False, duplicates='drop')
-    rfm['f_quartile'] = pd.qcut(
-        rfm['frequency'], 4, labels=False, duplicates='drop')
-    rfm['m_quartile'] = pd.qcut(
-        rfm['monetary'], 4, labels=False, duplicates='drop')
-    rfm['rfm_score'] = rfm[['r_quartile',
-                            'f_quartile', 'm_quartile']].sum(axis=1)
-
-    weights = {'R': 0.5, 'F': 0.3, 'M': 0.2}
-    rfm['RFM_Weighted'] = (rfm['r_quartile'] * weights['R'] +
-                           rfm['f_quartile'] * weights['F'] +
-                           rfm['m_quartile'] * weights['M'])
-
-    rfm['Churn_Risk'] = pd.qcut(rfm['RFM_Weighted'], q=[0, 0.25, 0.75, 1], labels=[
-                                'High_risk', 'Avg_risg', 'Low_risk'])
-
-    # ABC
-    rfm = rfm.sort_values('monetary', ascending=False)
-    rfm['cumulative_value'] = rfm['monetary'].cumsum()
-    total_value = rfm['monetary'].sum()
-    rfm['cumulative_percent'] = rfm['cumulative_value'] / total_value * 100
-
-    def assign_abc_category(row):
-        if row['cumulative_percent'] <= 80:
-            return 'A'
-        elif row['cumulative_percent'] <= 95:
-            return 'B'
-        else:
-            return 'C'
-
-    rfm['abc_class'] = rfm.apply(assign_abc_category, axis=1)
-
-    # XYZ
-    rfm['std_dev'] = df.groupby('customer_unique_id')[
-        'payment_value'].transform(lambda x: x.std())
-    rfm['x_category'] = pd.cut(
-        rfm['std_dev'], bins=[-1, 0.01, 50, float('inf')], labels=['X', 'Y', 'Z'])
-    rfm['x_category'] = rfm['x_category'].cat.add_categories(
-        ['Single Purchase'])
-    rfm['x_category'] = rfm['x_category'].fillna('Single Purchase')
-
-    new_categories = ['X', 'Y', 'Z', 'Single Purchase']
-    rfm['x_category'] = pd.Categorical(
-        rfm['x_category'], categories=new_categories)
-
-    # Сегментация клиентов
-    segments = rfm.copy()
-    segments['abc_class'] = segments['abc_class'].astype(str)
-    segments['x_category'] = segments['x_category'].astype(str)
-    segments['segment'] = segments['abc_class'] + "_" + segments['x_category']
-
-    segment_descriptions = {
-        'A_Single Purchase': 'Клиенты с одной покупкой, высокий денежный объем.',
-        'B_Single Purchase': 'Клиенты с одной покупкой, средний денежный объем.',
-        'C_Single Purchase': 'Клиенты с одной покупкой, низкий денежный объем.',
-        'A_X': 'Высокоприбыльные клиенты, низкая вариативность.',
-        'B_X': 'Клиенты со средней частотой и объемом, низкая вариативность.',
-        'C_X': 'Клиенты с низким объемом, низкая вариативность.',
-        'A_Y': 'Высокоприбыльные клиенты с разумной вариативностью.',
-        'B_Y': 'Средние клиенты с некоторой вариативностью.',
-        'C_Y': 'Клиенты с низким объемом и частотой, но с вариативностью.',
-        'A_Z': 'Высокоприбыльные клиенты с большой вариативностью.',
-        'B_Z': 'Средние клиенты с высокой вариативностью.',
-        'C_Z': 'Низкие клиенты с высокой вариативностью.',
-    }
-
-    segments['segment_description'] = segments['segment'].map(
-        segment_descriptions)
-
-    result = segments[["customer_unique_id", "Churn_Risk", "segment"]]
 
-    return result
+def segment_rfm(rfm):
+    """
+    Сегменты и риск оттока по таблице клиентов
+    с колонками recency, frequency, monetary, std_dev.
+    """
+    segments = score_customers(rfm, churn_labels=CHURN_LABELS)
+    return segments[["customer_unique_id", "Churn_Risk", "segment"]]
 
 
 def save_to_json(data, filename):
@@ -162,29 +104,119 @@ def save_to_json(data, filename):
                   f, ensure_ascii=False, indent=4)
 
 
-# Основная функция
-def run_segmentation_pipeline(data_dict):
-    df = merge_data(data_dict['orders'], data_dict['items'], data_dict['order_payments'],
-                    data_dict['order_reviews'], data_dict['products'], data_dict['customers'],
-                    data_dict['sellers'], data_dict['category_translation'])
-    df = filter_customers(df)
-
+GEO_TOTAL_COLUMNS = ["lat_sum", "lat_count", "lng_sum", "lng_count"]
+
+
+def coordinate_totals(orders, zip_index):
+    """
+    Суммы координат на клиента по заказам.
+    Суммы и количество центроидов префикса берутся из индекса (geo_index) по номеру
+    строки, без merge с geolocation. Каждый заказ взвешивается числом строк, которые
+    он давал в старом merge_data, поэтому среднее совпадает с усреднением по широкому
+    фрейму. Клиенты без заказов не учитываются: иначе их вклад нельзя было бы убрать
+    из накопленных сумм.
+    """
+    orders = orders[orders["order_id"].notna()]
+    stats = zip_index.lookup(orders["customer_zip_code_prefix"])
+    row_weight = orders["row_weight"].to_numpy(dtype="float64")
+    weighted = pd.DataFrame({column: stats[column] * row_weight for column in GEO_TOTAL_COLUMNS})
+    weighted.insert(0, "customer_unique_id", orders["customer_unique_id"].to_numpy())
+
+    return weighted.groupby("customer_unique_id")[GEO_TOTAL_COLUMNS].sum().reset_index()
+
+
+def finalize_coordinates(totals):
+    lat_long = totals[["customer_unique_id"]].copy()
+    lat_long["geolocation_lat"] = totals["lat_sum"] / totals["lat_count"].where(totals["lat_count"] > 0)
+    lat_long["geolocation_lng"] = totals["lng_sum"] / totals["lng_count"].where(totals["lng_count"] > 0)
+    return lat_long
+
+
+def customer_coordinates(orders, zip_index=None):
+    """Средние координаты клиента по заказам."""
+    if zip_index is None:
+        zip_index = load_zip_index()
+    return finalize_coordinates(coordinate_totals(orders, zip_index))
+
+
+def compute_totals(orders, zip_index):
+    """Накопительные суммы RFM и координат на клиента по фрейму заказов."""
+    totals = customer_totals(orders).merge(
+        coordinate_totals(orders, zip_index), on="customer_unique_id", how="outer")
+    sum_columns = ["frequency", "monetary", "monetary_m2"] + GEO_TOTAL_COLUMNS
+    totals[sum_columns] = totals[sum_columns].fillna(0)
+    return totals
+
+
+def build_customer_totals(incremental=False, orders=None, zip_index=None, workers=None):
+    """
+    Накопительные суммы RFM и координат на клиента.
+    incremental=True — свернуть только заказы новее сохранённого водяного знака
+    (см. segmentation_tasks.incremental); иначе пересчёт по всей истории,
+    который заодно обновляет сохранённое состояние.
+    orders/zip_index — уже загруженные заказы и индекс центроидов (общие этапы DAG).
+    workers — число процессов для расчёта по партициям клиентов (по умолчанию RFM_WORKERS).
+    """
+    if zip_index is None:
+        zip_index = load_zip_index()
+
+    build_totals = partial(parallel_customer_totals,
+                           compute_totals=partial(compute_totals, zip_index=zip_index),
+                           workers=workers)
+
+    # Заказы с агрегатами платежей/позиций/отзывов вместо широкого merge_data
+    return refresh_customer_totals(build_totals, CONSUMER_COLUMNS["segments"],
+                                   full=not incremental, orders=orders)
+
+
+def segments_result(totals, scores=None, keep_ids=False):
+    """
+    Итоговая таблица сегментов с координатами.
+    scores — готовый результат rfm_core.score_customers (общий этап DAG).
+    keep_ids — оставить customer_unique_id (нужен для поиска клиента в Redis).
+    """
     # Геообработка
-    geo_df = data_dict["geolocation"].groupby(
-        ["geolocation_city", "geolocation_zip_code_prefix"]
-    )[['geolocation_lat', 'geolocation_lng']].mean().reset_index()
-
-    lat_long = df.merge(geo_df, left_on="customer_zip_code_prefix",
-                        right_on="geolocation_zip_code_prefix", how="left")
-    lat_long = lat_long[["customer_unique_id", "geolocation_lat", "geolocation_lng"]]
-    lat_long = lat_long.groupby("customer_unique_id")[["geolocation_lat", "geolocation_lng"]].mean().reset_index()
+    lat_long = finalize_coordinates(totals)
 
     # RFM сегментация
-    segments = process_data(df)
-    
+    if scores is None:
+        segments = segment_rfm(finalize_aggregates(totals))
+    else:
+        segments = scores[["customer_unique_id", "Churn_Risk", "segment"]].copy()
+        segments["Churn_Risk"] = segments["Churn_Risk"].cat.rename_categories(
+            dict(zip(RFM_CHURN_LABELS, CHURN_LABELS)))
+
     # Итоговый результат
     result = segments.merge(lat_long, on="customer_unique_id", how="left")
     result.drop_duplicates(inplace=True)
-    result = result.drop(columns=["customer_unique_id"])
+    if not keep_ids:
+        result = result.drop(columns=["customer_unique_id"])
+
+    return result
+
 
-    return result
\ No newline at end of file
+# Основная функция
+def run_segmentation_pipeline(incremental=False, workers=None):
+    return segments_result(build_customer_totals(incremental, workers=workers))
+
+
+def compare_with_legacy_merge():
+    """
+    Сверяет frequency/monetary/recency плана на уровне заказа
+    с расчётом по старому широкому merge_data. Возвращает отчёт о расхождениях.
+    """
+    df, _ = main_pipeline()
+    df['customer_unique_id'] = df['customer_unique_id'].astype(str)
+    df = df.dropna()
+    current_date = df['order_purchase_timestamp'].max() + pd.Timedelta(days=1)
+    legacy = df.groupby('customer_unique_id').agg(
+        last_purchase=('order_purchase_timestamp', 'max'),
+        frequency=('order_id', 'count'),
+        monetary=('payment_value', 'sum'),
+    ).reset_index()
+    legacy['recency'] = (current_date - legacy['last_purchase']).dt.days
+
+    new = customer_aggregates(build_order_frame(CONSUMER_COLUMNS["segments"]))
+    report = compare_rfm(legacy.drop(columns=['last_purchase']), new)
+    logging.info(f"[join_plan] сверка с merge_data: {report}")
+    return report
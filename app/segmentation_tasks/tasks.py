@@ -1,32 +1,150 @@
+import logging
+from datetime import datetime
+
+import disk_snapshot
 from segmentation_tasks.celery_app import celery_app
-from segmentation_tasks.segmentation_pipeline import load_data, run_segmentation_pipeline
-from segmentation_tasks.cohort_pipeline import data_preprocessing
-from segmentation_tasks.time_pipeline import run_time_pipeline
-from redis_cache import cache_segments_to_redis, cache_cohort_to_redis, cache_timeline_to_redis
-
-@celery_app.task
-def run_segmentation():
-    customers, geolocation, order_pay, reviews, orders, item, category_name, products, sellers = load_data()
-    data_dict = {
-        'customers': customers,
-        'geolocation': geolocation,
-        'order_payments': order_pay,
-        'order_reviews': reviews,
-        'orders': orders,
-        'items': item,
-        'category_translation': category_name,
-        'products': products,
-        'sellers': sellers
-    }
-    df = run_segmentation_pipeline(data_dict)
-    cache_segments_to_redis(df)
-
-@celery_app.task
-def run_cohort_analysis():
-    cohort_json = data_preprocessing()
+from segmentation_tasks.dag import LEAVES, run_pipeline
+from segmentation_tasks.data_store import data_version
+from segmentation_tasks.refresh import REFRESH_TASK
+from redis_cache import (
+    cache_segments_to_redis, cache_cohort_to_redis, cache_timeline_to_redis,
+    current_version, release_refresh, save_profile)
+
+
+def _save_to_disk(save, *args):
+    # Копия на диске нужна для ответа без Redis и быстрого старта;
+    # если диск недоступен, пересчёт всё равно публикуется в Redis
+    try:
+        save(*args, data_version=data_version())
+    except OSError as e:
+        logging.warning(f"[tasks] не удалось сохранить копию на диск ({save.__name__}): {e}")
+
+
+def _cache_segments(df):
+    updated_at = datetime.utcnow().isoformat()
+    _save_to_disk(disk_snapshot.save_segments, df, updated_at)
+    cache_segments_to_redis(df, updated_at=updated_at)
+
+
+def _cache_cohort(cohort_json):
+    _save_to_disk(disk_snapshot.save_cohort, cohort_json)
     cache_cohort_to_redis(cohort_json)
-    
-@celery_app.task
-def run_timeline():
-    json_timeline_by_segment, json_timeline_by_churn = run_time_pipeline()
-    cache_timeline_to_redis(json_timeline_by_segment, json_timeline_by_churn)
\ No newline at end of file
+
+
+def _cache_timeline(result):
+    json_timeline_by_segment, json_timeline_by_churn, rollup = result
+    updated_at = datetime.utcnow().isoformat()
+    _save_to_disk(disk_snapshot.save_timeline, json_timeline_by_segment, json_timeline_by_churn, updated_at, rollup)
+    cache_timeline_to_redis(json_timeline_by_segment, json_timeline_by_churn, updated_at=updated_at, rollup=rollup)
+
+
+# Запись результата каждого листа DAG: копия на диск, затем публикация в Redis
+WRITERS = {
+    "segments": _cache_segments,
+    "cohort": _cache_cohort,
+    "timeline": _cache_timeline,
+}
+
+# Восстановление листа в Redis из копии на диске (аргументы — disk_snapshot.load_result)
+RESTORERS = {
+    "segments": lambda manifest, df: cache_segments_to_redis(df, updated_at=manifest["updated_at"]),
+    "cohort": lambda manifest, cohort_json: cache_cohort_to_redis(cohort_json),
+    "timeline": lambda manifest, by_segment, by_churn, rollup: cache_timeline_to_redis(
+        by_segment, by_churn, updated_at=manifest["updated_at"], rollup=rollup),
+}
+
+
+def warm_from_disk(leaves=None) -> dict:
+    """
+    Публикует в Redis копии листов с диска, если в Redis их нет (например, после
+    потери данных Redis). Возвращает {лист: состояние}, где состояние —
+    "redis" (уже опубликован), "warmed" (восстановлен с диска),
+    "missing" (копии нет) или "corrupt" (копия не прошла проверку),
+    и список листов, которые нужно пересчитать: без копии или с копией,
+    посчитанной по другой версии исходных данных.
+    """
+    current_data = data_version()
+    states, stale = {}, []
+    for leaf in leaves or LEAVES:
+        manifest = disk_snapshot.load_manifest(leaf)
+        if manifest is None or manifest["data_version"] != current_data:
+            stale.append(leaf)
+        if current_version(leaf) is not None:
+            states[leaf] = "redis"
+            continue
+        if manifest is None:
+            states[leaf] = "missing"
+            continue
+        try:
+            args = disk_snapshot.load_result(manifest)
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning(f"[tasks] копия {leaf} на диске повреждена: {e}")
+            states[leaf] = "corrupt"
+            if leaf not in stale:
+                stale.append(leaf)
+            continue
+        RESTORERS[leaf](manifest, *args)
+        states[leaf] = "warmed"
+        logging.info(f"[tasks] {leaf} восстановлен в Redis с диска (версия {manifest['id']})")
+    return {"states": states, "stale": stale}
+
+
+def _progress(task):
+    """Ход прогона DAG как состояние PROGRESS задачи (виден в /status/<task_id>)."""
+    if not task.request.id:
+        # Вызов без воркера (например, из консоли) — состояние публиковать некуда
+        return None
+    return lambda meta: task.update_state(state="PROGRESS", meta=meta)
+
+
+def _store_profile(task_id, report):
+    """
+    Переносит сводку профилирования из отчёта в Redis (см. /profiles/<task_id>);
+    в результате задачи остаётся только путь к файлу .prof.
+    """
+    profile = report.pop("profile", None)
+    if profile is None or not task_id:
+        return report
+    save_profile(task_id, {
+        **profile,
+        "task_id": task_id,
+        "leaves": report["leaves"],
+        "incremental": report["incremental"],
+        "stages": report["stages"],
+        "total_seconds": report["total_seconds"],
+        "created_at": datetime.utcnow().isoformat(),
+    })
+    report["profile"] = {"path": profile["path"]}
+    return report
+
+
+@celery_app.task(bind=True, name=REFRESH_TASK)
+def run_refresh(self, leaves=None, incremental=False, workers=None, profile=False, trace_memory=False):
+    # Все листья (или выбранные) за один прогон: общие этапы считаются один раз
+    try:
+        report = run_pipeline(leaves, incremental=incremental, writers=WRITERS, workers=workers,
+                              progress=_progress(self), profile=profile, trace_memory=trace_memory,
+                              profile_name=self.request.id)
+        return _store_profile(self.request.id, report)
+    finally:
+        if self.request.id:
+            release_refresh(leaves or LEAVES, self.request.id)
+
+
+@celery_app.task(bind=True)
+def run_segmentation(self, incremental=False, workers=None, profile=False, trace_memory=False):
+    report = run_pipeline(["segments"], incremental=incremental, writers=WRITERS, workers=workers,
+                          profile=profile, trace_memory=trace_memory, profile_name=self.request.id)
+    return _store_profile(self.request.id, report)
+
+@celery_app.task(bind=True)
+def run_cohort_analysis(self, profile=False, trace_memory=False):
+    report = run_pipeline(["cohort"], writers=WRITERS, profile=profile, trace_memory=trace_memory,
+                          profile_name=self.request.id)
+    return _store_profile(self.request.id, report)
+
+@celery_app.task(bind=True)
+def run_timeline(self, profile=False, trace_memory=False):
+    report = run_pipeline(["timeline"], writers=WRITERS, profile=profile, trace_memory=trace_memory,
+                          profile_name=self.request.id)
+    return _store_profile(self.request.id, report)
@@ -1,169 +1,178 @@
-import os
+from itertools import combinations
+
+import numpy as np
 import pandas as pd
 
-def load_data():
-    customers = pd.read_csv("research/clean_data/customers.csv")
-    geolocation = pd.read_csv("research/clean_data/geolocation.csv")
-    order_pay = pd.read_csv("research/clean_data/order_payments.csv")
-    reviews = pd.read_csv("research/clean_data/order_reviews.csv")
-    orders = pd.read_csv("research/clean_data/orders.csv")
-    item = pd.read_csv("research/clean_data/orders_items.csv")
-    category_name = pd.read_csv(
-        "research/clean_data/product_category_name_translation.csv")
-    products = pd.read_csv("research/clean_data/products.csv")
-    sellers = pd.read_csv("research/clean_data/sellers.csv")
-    return customers, geolocation, order_pay, reviews, orders, item, category_name, products, sellers
-
-
-def merge_data(orders, item, order_pay, reviews, products, customers, sellers, category_name):
-    df = orders.merge(item, on='order_id', how='left')
-    df = df.merge(order_pay, on='order_id', how='outer', validate='m:m')
-    df = df.merge(reviews, on='order_id', how='outer')
-    df = df.merge(products, on='product_id', how='outer')
-    df = df.merge(customers, on='customer_id', how='outer')
-    df = df.merge(sellers, on='seller_id', how='outer')
-    df = df.merge(category_name, on="product_category_name", how="left")
-    return df
-
-
-def filter_customers(df):
-    return df[~df["customer_unique_id"].isna()]
-
-
-def main_pipeline():
-    customers, geolocation, order_pay, reviews, orders, item, category_name, products, sellers = load_data()
-    df = merge_data(orders, item, order_pay, reviews, products,
-                    customers, sellers, category_name)
-    df = filter_customers(df)
-    return df
-
-
-def process_data(df):
-    # Приводим столбцы к нужному типу данных
-    df['order_purchase_timestamp'] = pd.to_datetime(
-        df['order_purchase_timestamp'])
-    df['customer_unique_id'] = df['customer_unique_id'].astype(str)
-
-    # Убираем строки с отсутствующими customer_id или order_purchase_timestamp
-    df = df.dropna()
-
-    # RFM
-    current_date = df['order_purchase_timestamp'].max() + pd.Timedelta(days=1)
-    rfm = df.groupby('customer_unique_id').agg({
-        'order_purchase_timestamp': lambda x: (current_date - x.max()).days,
-        'order_id': 'count',
-        'payment_value': 'sum'
-    }).rename(columns={
-        'order_purchase_timestamp': 'recency',
-        'order_id': 'frequency',
-        'payment_value': 'monetary'
-    }).reset_index()
-
-    # Применяем квантильный анализ
-    rfm['r_quartile'] = pd.qcut(
-        rfm['recency'], 4, labels=False, duplicates='drop')
-    rfm['f_quartile'] = pd.qcut(
-        rfm['frequency'], 4, labels=False, duplicates='drop')
-    rfm['m_quartile'] = pd.qcut(
-        rfm['monetary'], 4, labels=False, duplicates='drop')
-    rfm['rfm_score'] = rfm[['r_quartile',
-                            'f_quartile', 'm_quartile']].sum(axis=1)
-
-    weights = {'R': 0.5, 'F': 0.3, 'M': 0.2}
-    rfm['RFM_Weighted'] = (rfm['r_quartile'] * weights['R'] +
-                           rfm['f_quartile'] * weights['F'] +
-                           rfm['m_quartile'] * weights['M'])
-
-    rfm['Churn_Risk'] = pd.qcut(rfm['RFM_Weighted'], q=[0, 0.25, 0.75, 1], labels=[
-                                'Высокий риск', 'Средний риск', 'Низкий риск'])
-
-    # ABC
-    rfm = rfm.sort_values('monetary', ascending=False)
-    rfm['cumulative_value'] = rfm['monetary'].cumsum()
-    total_value = rfm['monetary'].sum()
-    rfm['cumulative_percent'] = rfm['cumulative_value'] / total_value * 100
-
-    def assign_abc_category(row):
-        if row['cumulative_percent'] <= 80:
-            return 'A'
-        elif row['cumulative_percent'] <= 95:
-            return 'B'
+from segmentation_tasks.constants import ROLLUP_DIMENSIONS, ROLLUP_LEVELS, ROLLUP_MEASURES
+from segmentation_tasks.join_plan import CONSUMER_COLUMNS, build_order_frame, customer_aggregates
+from segmentation_tasks.rfm_core import score_customers
+
+
+# =====================
+# Куб свёрток
+# =====================
+# Число строк (count — как в сериях таймлайна, с кратностью row_weight), заказов (orders)
+# и сумма платежей (monetary) по периоду × сегмент × риск оттока × штат.
+# Дневной уровень считается одним проходом по заказам, более крупные — из более мелких
+# уровней куба без повторного чтения заказов: неделя и месяц из дней, квартал из месяцев.
+# Измерения хранятся кодами в словари значений (None — клиент без оценки или без штата).
+
+ROLLUP_PARENTS = {"week": "day", "month": "day", "quarter": "month"}
+# Свёртка уровня до меньшего набора измерений хранится, только если она не больше
+# этой доли строк уровня: почти такие же длинные таблицы не ускоряют запрос
+ROLLUP_AGGREGATE_MAX_SHARE = 0.5
+
+
+def _encode(values):
+    """(коды, словарь значений) измерения; пропуски получают код последнего значения None."""
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        # Порядок категорий сохраняется (как у Churn_Risk в сериях таймлайна)
+        codes, dictionary = values.cat.codes.to_numpy(dtype="int64"), values.cat.categories.tolist()
+    else:
+        codes, uniques = pd.factorize(values, sort=True)
+        dictionary = uniques.tolist()
+    missing = codes < 0
+    if missing.any():
+        codes = np.where(missing, len(dictionary), codes)
+        dictionary = dictionary + [None]
+    return codes, dictionary
+
+
+def _period_starts(days, level):
+    """Начала периодов уровня level для дат-начал периодов более мелкого уровня."""
+    days = pd.DatetimeIndex(days)
+    if level == "day":
+        return days.normalize()
+    if level == "week":
+        return days - pd.to_timedelta(days.weekday, unit="D")
+    return days.to_period({"month": "M", "quarter": "Q"}[level]).to_timestamp()
+
+
+def _period_labels(starts, level):
+    if level == "month":
+        return starts.strftime("%Y-%m").tolist()
+    if level == "quarter":
+        return [f"{start.year}-Q{start.quarter}" for start in starts]
+    # День и неделя (понедельник) — датой начала
+    return starts.strftime("%Y-%m-%d").tolist()
+
+
+def _roll_up(cube, level):
+    return (cube.assign(period=_period_starts(cube["period"], level))
+            .groupby(["period"] + ROLLUP_DIMENSIONS, sort=True)[ROLLUP_MEASURES].sum()
+            .reset_index())
+
+
+def build_rollup_frames(orders, scores):
+    """
+    Уровни куба DataFrame'ами {уровень: фрейм} с кодами измерений
+    и словари значений измерений {измерение: [значения]}.
+    """
+    frame = orders[orders["order_purchase_timestamp"].notna()]
+    labels = scores.set_index("customer_unique_id")
+    # Метки клиента берутся по позиции в scores, без merge по строковым id
+    position = labels.index.get_indexer(frame["customer_unique_id"].astype(str))
+
+    columns, dictionaries = {}, {}
+    for column in ROLLUP_DIMENSIONS:
+        if column in frame.columns:
+            values = frame[column]
         else:
-            return 'C'
-
-    rfm['abc_class'] = rfm.apply(assign_abc_category, axis=1)
-
-    # XYZ
-    rfm['std_dev'] = df.groupby('customer_unique_id')[
-        'payment_value'].transform(lambda x: x.std())
-    rfm['x_category'] = pd.cut(
-        rfm['std_dev'], bins=[-1, 0.01, 50, float('inf')], labels=['X', 'Y', 'Z'])
-    rfm['x_category'] = rfm['x_category'].cat.add_categories(
-        ['Single Purchase'])
-    rfm['x_category'] = rfm['x_category'].fillna('Single Purchase')
-
-    new_categories = ['X', 'Y', 'Z', 'Single Purchase']
-    rfm['x_category'] = pd.Categorical(
-        rfm['x_category'], categories=new_categories)
-
-    # Сегментация клиентов
-    segments = rfm.copy()
-    segments['abc_class'] = segments['abc_class'].astype(str)
-    segments['x_category'] = segments['x_category'].astype(str)
-    segments['segment'] = segments['abc_class'] + "_" + segments['x_category']
-
-    segment_descriptions = {
-        'A_Single Purchase': 'Клиенты с одной покупкой, высокий денежный объем.',
-        'B_Single Purchase': 'Клиенты с одной покупкой, средний денежный объем.',
-        'C_Single Purchase': 'Клиенты с одной покупкой, низкий денежный объем.',
-        'A_X': 'Высокоприбыльные клиенты, низкая вариативность.',
-        'B_X': 'Клиенты со средней частотой и объемом, низкая вариативность.',
-        'C_X': 'Клиенты с низким объемом, низкая вариативность.',
-        'A_Y': 'Высокоприбыльные клиенты с разумной вариативностью.',
-        'B_Y': 'Средние клиенты с некоторой вариативностью.',
-        'C_Y': 'Клиенты с низким объемом и частотой, но с вариативностью.',
-        'A_Z': 'Высокоприбыльные клиенты с большой вариативностью.',
-        'B_Z': 'Средние клиенты с высокой вариативностью.',
-        'C_Z': 'Низкие клиенты с высокой вариативностью.',
+            # Клиент без оценки (позиция -1) получает пропуск
+            values = pd.Series(labels[column].array.take(position, allow_fill=True))
+        columns[column], dictionaries[column] = _encode(values)
+
+    day = pd.DataFrame({
+        "period": frame["order_purchase_timestamp"].to_numpy(),
+        **columns,
+        "count": frame["row_weight"].to_numpy(),
+        "orders": 1,
+        "monetary": frame["payment_sum"].to_numpy(),
+    })
+    cubes = {"day": _roll_up(day, "day")}
+    for level in ROLLUP_LEVELS[1:]:
+        cubes[level] = _roll_up(cubes[ROLLUP_PARENTS[level]], level)
+    return cubes, dictionaries
+
+
+def _rows(cube, starts, dimensions):
+    """Строки куба [код периода, коды измерений dimensions..., меры...] в порядке куба."""
+    period_codes = np.searchsorted(starts.values, cube["period"].to_numpy())
+    data = zip(period_codes.tolist(),
+               *(cube[column].tolist() for column in dimensions),
+               cube["count"].tolist(), cube["orders"].tolist(), cube["monetary"].round(2).tolist())
+    return [list(row) for row in data]
+
+
+def rollup_json(cube, level, dictionaries):
+    """
+    Уровень куба в компактном виде для хранения:
+    {"level", "periods": [метка], "starts": [YYYY-MM-DD], "dimensions": {измерение: [значения]},
+    "columns": ["period", измерения..., меры...], "data": [[код периода, коды измерений..., меры...]],
+    "aggregates": {"изм1,изм2": [[код периода, коды изм1 и изм2, меры...]]}}.
+    aggregates — тот же уровень, заранее свёрнутый до меньших наборов измерений
+    (ключ — измерения через запятую в порядке columns, "" — только периоды; только
+    свёртки не длиннее ROLLUP_AGGREGATE_MAX_SHARE строк уровня): запрос суммирует
+    самую короткую подходящую таблицу, а не все строки куба.
+    Строки упорядочены по периоду.
+    """
+    starts = pd.DatetimeIndex(cube["period"].unique())
+    aggregates = {}
+    for size in range(len(ROLLUP_DIMENSIONS)):
+        for dimensions in combinations(ROLLUP_DIMENSIONS, size):
+            frame = (cube.groupby(["period", *dimensions], sort=True)[ROLLUP_MEASURES].sum()
+                     .reset_index())
+            if len(frame) <= ROLLUP_AGGREGATE_MAX_SHARE * len(cube):
+                aggregates[",".join(dimensions)] = _rows(frame, starts, dimensions)
+    return {
+        "level": level,
+        "periods": _period_labels(starts, level),
+        "starts": starts.strftime("%Y-%m-%d").tolist(),
+        "dimensions": {column: dictionaries[column] for column in ROLLUP_DIMENSIONS},
+        "columns": ["period"] + ROLLUP_DIMENSIONS + ROLLUP_MEASURES,
+        "data": _rows(cube, starts, ROLLUP_DIMENSIONS),
+        "aggregates": aggregates,
     }
 
-    segments['segment_description'] = segments['segment'].map(
-        segment_descriptions)
-
-    return segments
-
-
-def time_to_json(df, feat):
-    # Убедимся, что колонка в формате datetime
-    df = df.copy()
-    df['order_purchase_timestamp'] = pd.to_datetime(df['order_purchase_timestamp'])
-
-    # Группировка по месяцу и признаку
-    grouped = (
-        df.set_index('order_purchase_timestamp')
-          .groupby([pd.Grouper(freq='M'), feat])
-          .size()
-          .reset_index(name='count')
-    )
-    grouped['order_purchase_timestamp'] = grouped['order_purchase_timestamp'].dt.strftime('%Y-%m')
-
-    # Сериализация в JSON строку
-    json_str = grouped.to_json(orient='records', force_ascii=False)
-    return json_str
-
-
-def run_time_pipeline():
-    data = main_pipeline()
-    data_time = data[["customer_unique_id", "order_purchase_timestamp"]]
-
-    processed_data = process_data(data)
-    data_labels_time = processed_data[[
-        "customer_unique_id", "segment_description", "Churn_Risk"
-    ]]
-
-    work_df = data_time.merge(data_labels_time, on="customer_unique_id", how="left")
-
-    json_by_segment = time_to_json(work_df, feat="segment_description")
-    json_by_churn = time_to_json(work_df, feat="Churn_Risk")
 
-    return json_by_segment, json_by_churn
\ No newline at end of file
+def series_json(month, dictionaries, feat, categorical):
+    """
+    Помесячная серия таймлайна по признаку feat из месячного уровня куба:
+    JSON-список записей {"order_purchase_timestamp": "YYYY-MM", feat: значение, "count": число строк
+    с кратностью row_weight}. Для категориального признака — все месяцы диапазона × все категории
+    (с нулями), иначе только встречающиеся пары; клиенты без значения признака не попадают.
+    """
+    dictionary = dictionaries[feat]
+    counts = month.groupby(["period", feat])["count"].sum()
+    if None in dictionary:
+        counts = counts[counts.index.get_level_values(feat) != dictionary.index(None)]
+    if categorical:
+        months = pd.date_range(month["period"].min(), month["period"].max(), freq="MS")
+        codes = [code for code, value in enumerate(dictionary) if value is not None]
+        counts = counts.reindex(pd.MultiIndex.from_product([months, codes], names=["period", feat]),
+                                fill_value=0)
+    grouped = counts.reset_index(name="count")
+    grouped = pd.DataFrame({
+        "order_purchase_timestamp": grouped["period"].dt.strftime("%Y-%m"),
+        feat: np.array(dictionary, dtype=object)[grouped[feat].to_numpy()],
+        "count": grouped["count"],
+    })
+    return grouped.to_json(orient='records', force_ascii=False)
+
+
+def run_time_pipeline(orders=None, scores=None):
+    # orders и scores — результаты общих этапов DAG, иначе считаются здесь.
+    # Одна строка на заказ; row_weight — сколько строк заказ давал в старом merge_data
+    if orders is None:
+        orders = build_order_frame(CONSUMER_COLUMNS["timeline"])
+    processed_data = scores if scores is not None else score_customers(customer_aggregates(orders))
+
+    # Серии by_segment/by_churn — срезы месячного уровня куба
+    cubes, dictionaries = build_rollup_frames(orders, processed_data)
+    json_by_segment = series_json(cubes["month"], dictionaries, "segment_description",
+                                  isinstance(processed_data["segment_description"].dtype, pd.CategoricalDtype))
+    json_by_churn = series_json(cubes["month"], dictionaries, "Churn_Risk",
+                                isinstance(processed_data["Churn_Risk"].dtype, pd.CategoricalDtype))
+    rollup = {level: rollup_json(cubes[level], level, dictionaries) for level in ROLLUP_LEVELS}
+
+    return json_by_segment, json_by_churn, rollup
@@ -1,9 +1,42 @@
-from segmentation_tasks.tasks import run_segmentation, run_cohort_analysis, run_timeline
+import logging
+import os
+import time
+
+import redis
+
+from redis_cache import r
+from segmentation_tasks.refresh import submit_refresh
+from segmentation_tasks.tasks import warm_from_disk
+
+# Сколько ждать готовности Redis (в том числе загрузки AOF/RDB после перезапуска)
+STARTUP_REDIS_WAIT_SECONDS = float(os.getenv("STARTUP_REDIS_WAIT_SECONDS", "120"))
+
+
+def wait_for_redis(timeout=STARTUP_REDIS_WAIT_SECONDS):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return r.ping()
+        except redis.RedisError as e:
+            # BusyLoadingError — Redis ещё загружает данные с диска
+            if time.monotonic() >= deadline:
+                raise
+            logging.info(f"[startup] Redis не готов: {e}")
+            time.sleep(1)
+
 
 def launch_initial_tasks():
-    run_segmentation.delay()
-    run_cohort_analysis.delay()
-    run_timeline.delay()
-    
+    wait_for_redis()
+    # Опубликованные ранее наборы восстанавливаются с диска за секунды;
+    # пересчитываются только листы без копии или с копией по старым данным.
+    # Один прогон DAG вместо трёх независимых задач; при перезапуске контейнера
+    # во время пересчёта присоединяется к уже поставленной задаче
+    warmed = warm_from_disk()
+    logging.info(f"[startup] состояние наборов: {warmed['states']}")
+    if warmed["stale"]:
+        submit_refresh(warmed["stale"])
+
+
 if __name__ == "__main__":
-    launch_initial_tasks()
\ No newline at end of file
+    logging.basicConfig(level=logging.INFO)
+    launch_initial_tasks()
@@ -0,0 +1,64 @@
+import pandas as pd
+
+from segmentation_tasks.cohort_pipeline import data_preprocessing
+
+# (клиент, штат, дата заказа, complete_weight)
+ORDERS = [
+    # 31 января -> 1 февраля и 15 февраля: смещение 1, а не 0 (как давало days // 30)
+    ("a", "SP", "2018-01-31", 1),
+    ("a", "SP", "2018-02-01", 2),
+    ("a", "SP", "2018-02-15", 1),
+    # 1 февраля -> 31 марта (58 дней): смещение 1, а не 2
+    ("b", "SP", "2018-02-01", 1),
+    ("b", "SP", "2018-03-31", 1),
+    # 1 марта -> 31 мая: смещение 2, а не 3 (91 день)
+    ("g", "MG", "2018-03-01", 1),
+    ("g", "MG", "2018-05-31", 1),
+    # Переход года: декабрь -> январь
+    ("c", "RJ", "2017-12-31", 1),
+    ("c", "RJ", "2018-01-01", 1),
+    # Заказы из двух штатов: в общих числах клиент один, в региональных — в каждом штате
+    ("d", "SP", "2018-01-05", 1),
+    ("d", "RJ", "2018-01-20", 3),
+    ("d", "RJ", "2018-02-28", 1),
+    # Заказ, не переживший dropna() широкого фрейма, не учитывается
+    ("e", "SP", "2018-01-10", 0),
+    # Клиент без штата есть только в общих числах
+    ("f", None, "2018-01-03", 1),
+]
+
+
+def orders_frame():
+    return pd.DataFrame({
+        "customer_unique_id": [row[0] for row in ORDERS],
+        "customer_state": [row[1] for row in ORDERS],
+        "order_purchase_timestamp": pd.to_datetime([row[2] for row in ORDERS]),
+        "complete_weight": [row[3] for row in ORDERS],
+    })
+
+
+def test_calendar_month_offsets_and_dedup():
+    result = data_preprocessing(orders_frame())
+
+    assert result["cohort_data"]["columns"] == ["cohort_month", "cohort_index", "customers"]
+    assert result["cohort_data"]["data"] == [
+        ["2017-12", 0, 1], ["2017-12", 1, 1],
+        ["2018-01", 0, 3], ["2018-01", 1, 2],
+        ["2018-02", 0, 1], ["2018-02", 1, 1],
+        ["2018-03", 0, 1], ["2018-03", 2, 1],
+    ]
+    assert result["retention"]["data"] == [
+        ["2017-12", 0, 1.0], ["2017-12", 1, 1.0],
+        ["2018-01", 0, 1.0], ["2018-01", 1, 0.6667],
+        ["2018-02", 0, 1.0], ["2018-02", 1, 1.0],
+        ["2018-03", 0, 1.0], ["2018-03", 2, 1.0],
+    ]
+    # Когорта клиента общая для всех штатов (d — январь 2018 и в RJ)
+    assert result["regional_cohort"]["data"] == [
+        ["MG", "2018-03", 0, 1, 1.0], ["MG", "2018-03", 2, 1, 1.0],
+        ["RJ", "2017-12", 0, 1, 1.0], ["RJ", "2017-12", 1, 1, 1.0],
+        ["RJ", "2018-01", 0, 1, 1.0], ["RJ", "2018-01", 1, 1, 1.0],
+        ["SP", "2018-01", 0, 2, 1.0], ["SP", "2018-01", 1, 1, 0.5],
+        ["SP", "2018-02", 0, 1, 1.0], ["SP", "2018-02", 1, 1, 1.0],
+    ]
+    assert sorted(result["state_list"]) == ["MG", "RJ", "SP"]
@@ -0,0 +1,17 @@
+import disk_snapshot
+
+
+def test_invalidated_snapshot_is_not_served_or_restored(tmp_path, monkeypatch):
+    monkeypatch.setattr(disk_snapshot, "DISK_SNAPSHOT_DIR", str(tmp_path))
+    saved = disk_snapshot.save_snapshot("cohort", {"result.json": b"{}"}, b"[]", "2026-01-01T00:00:00", "d1")
+    assert disk_snapshot.load_manifest("cohort")["id"] == saved["id"]
+
+    invalidated = disk_snapshot.invalidate("cohort", "откат версии 2 -> 1")
+    assert invalidated["id"] == saved["id"]
+    assert invalidated["invalidated"]["reason"] == "откат версии 2 -> 1"
+    assert disk_snapshot.load_manifest("cohort") is None
+    assert disk_snapshot.invalidate("cohort", "повтор") is None
+
+    # Следующая запись набора снова видна
+    fresh = disk_snapshot.save_snapshot("cohort", {"result.json": b"{}"}, b"[]", "2026-01-02T00:00:00", "d1")
+    assert disk_snapshot.load_manifest("cohort")["id"] == fresh["id"]
@@ -0,0 +1,58 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from segmentation_tasks.incremental import fold_totals
+from segmentation_tasks.join_plan import _payment_stats, customer_aggregates, customer_totals
+
+# Платежи по заказам: крупные почти одинаковые суммы, на которых
+# формула Σx² − (Σx)²/n теряет все значащие цифры
+PAYMENTS = {
+    ("big", "o1"): [1e7 + 0.01, 1e7 + 0.02],
+    ("big", "o2"): [1e7 + 0.03],
+    ("big", "o3"): [1e7 + 0.04, 1e7 + 0.05, 1e7 + 0.06],
+    ("small", "o4"): [10.0, 30.0],
+    ("small", "o5"): [20.0],
+    ("single", "o6"): [7.5],
+}
+
+
+def order_frame(keys):
+    payments = pd.DataFrame(
+        [(order, value) for key in keys for order in [key[1]] for value in PAYMENTS[key]],
+        columns=["order_id", "payment_value"])
+    stats = _payment_stats({"order_payments": payments}, legacy_dropna=False)
+    orders = pd.DataFrame({
+        "customer_unique_id": [customer for customer, _ in keys],
+        "order_id": [order for _, order in keys],
+        "order_purchase_timestamp": [pd.Timestamp("2018-01-01") + pd.Timedelta(days=int(order[1:]))
+                                     for _, order in keys],
+    }).join(stats, on="order_id")
+    # Одна позиция и один отзыв на заказ: каждый платёж — одна строка широкого фрейма
+    orders["complete_weight"] = orders["n_payments_complete"]
+    orders["payment_sum_weighted"] = orders["payment_sum"]
+    orders["payment_m2_weighted"] = orders["payment_m2"]
+    return orders
+
+
+def expected_std(customer):
+    values = [v for (c, _), payments in PAYMENTS.items() if c == customer for v in payments]
+    return np.std(values, ddof=1) if len(values) > 1 else np.nan
+
+
+def test_std_dev_is_exact_for_large_near_constant_payments():
+    rfm = customer_aggregates(order_frame(list(PAYMENTS))).set_index("customer_unique_id")
+
+    assert rfm.loc["big", "std_dev"] == pytest.approx(expected_std("big"), rel=1e-6)
+    assert rfm.loc["small", "std_dev"] == pytest.approx(expected_std("small"), rel=1e-12)
+    assert np.isnan(rfm.loc["single", "std_dev"])
+
+
+def test_fold_totals_matches_single_pass():
+    keys = list(PAYMENTS)
+    whole = customer_totals(order_frame(keys)).set_index("customer_unique_id").sort_index()
+    folded = fold_totals(customer_totals(order_frame(keys[::2])), customer_totals(order_frame(keys[1::2])))
+    folded = folded.set_index("customer_unique_id").sort_index()
+
+    assert list(folded.columns) == list(whole.columns)
+    pd.testing.assert_frame_equal(folded, whole, check_exact=False, rtol=1e-9, atol=1e-9)
@@ -0,0 +1,104 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from segmentation_tasks import data_store
+from segmentation_tasks.join_plan import CONSUMER_COLUMNS, build_order_frame
+from segmentation_tasks.segmentation_pipeline import compare_with_legacy_merge, main_pipeline
+
+# Исходные таблицы в формате CSV Olist.
+# o1: 3 позиции × 2 платежа × 2 отзыва — 12 строк широкого фрейма; у одного отзыва
+# пустой review_comment_message, и dropna() оставляет 3 × 2 × 1 = 6 строк.
+# o2: одна строка без пропусков. o3: у товара второй позиции нет категории.
+# Клиент c4 без заказов даёт в outer merge строку с пустым order_id.
+TABLES = {
+    "orders": {
+        "order_id": ["o1", "o2", "o3"],
+        "customer_id": ["k1", "k2", "k3"],
+        "order_status": ["delivered"] * 3,
+        "order_purchase_timestamp": ["2018-01-10 10:00:00", "2018-02-01 12:00:00", "2018-03-05 09:30:00"],
+    },
+    "customers": {
+        "customer_id": ["k1", "k2", "k3", "k4"],
+        "customer_unique_id": ["c1", "c2", "c1", "c4"],
+        "customer_zip_code_prefix": [1001, 2001, 1001, 3005],
+        "customer_city": ["sao paulo", "rio de janeiro", "sao paulo", "porto alegre"],
+        "customer_state": ["SP", "RJ", "SP", "RS"],
+    },
+    "items": {
+        "order_id": ["o1", "o1", "o1", "o2", "o3", "o3"],
+        "order_item_id": [1, 2, 3, 1, 1, 2],
+        "product_id": ["p1", "p2", "p1", "p2", "p1", "p3"],
+        "seller_id": ["s1", "s1", "s2", "s2", "s1", "s1"],
+        "price": [10.0, 20.0, 10.0, 20.0, 10.0, 5.0],
+        "freight_value": [1.0, 2.0, 1.0, 2.0, 1.0, 0.5],
+    },
+    "order_payments": {
+        "order_id": ["o1", "o1", "o2", "o3", "o3"],
+        "payment_sequential": [1, 2, 1, 1, 2],
+        "payment_type": ["credit_card", "voucher", "boleto", "credit_card", "voucher"],
+        "payment_installments": [3, 1, 1, 2, 1],
+        "payment_value": [25.5, 18.0, 22.0, 12.25, 3.75],
+    },
+    "order_reviews": {
+        "review_id": ["r1", "r2", "r3", "r4"],
+        "order_id": ["o1", "o1", "o2", "o3"],
+        "review_score": [5, 4, 3, 5],
+        "review_comment_message": ["ok", np.nan, "bom", "otimo"],
+    },
+    "products": {
+        "product_id": ["p1", "p2", "p3"],
+        "product_category_name": ["esporte_lazer", "beleza_saude", np.nan],
+    },
+    "category_translation": {
+        "product_category_name": ["esporte_lazer", "beleza_saude"],
+        "product_category_name_english": ["sports_leisure", "health_beauty"],
+    },
+    "sellers": {
+        "seller_id": ["s1", "s2"],
+        "seller_zip_code_prefix": [1001, 2001],
+        "seller_city": ["sao paulo", "rio de janeiro"],
+        "seller_state": ["SP", "RJ"],
+    },
+    "geolocation": {
+        "geolocation_zip_code_prefix": [1001, 2001, 3005],
+        "geolocation_lat": [-23.5, -22.9, -30.0],
+        "geolocation_lng": [-46.6, -43.2, -51.2],
+        "geolocation_city": ["sao paulo", "rio de janeiro", "porto alegre"],
+        "geolocation_state": ["SP", "RJ", "RS"],
+    },
+}
+
+
+@pytest.fixture(autouse=True)
+def olist_tables(tmp_path, monkeypatch):
+    for table, columns in TABLES.items():
+        pd.DataFrame(columns).to_csv(tmp_path / data_store.TABLE_FILES[table], index=False)
+    monkeypatch.setattr(data_store, "DATA_DIR", str(tmp_path))
+    monkeypatch.setattr(data_store, "SNAPSHOT_DIR", str(tmp_path / "_snapshot"))
+
+
+def test_order_plan_matches_legacy_merge():
+    report = compare_with_legacy_merge()
+
+    assert report["mismatches"] == []
+    assert report["only_legacy"] == report["only_new"] == 0
+    assert report["customers_legacy"] == 2
+
+
+def test_weights_equal_wide_frame_row_counts():
+    wide, _ = main_pipeline()
+    orders = build_order_frame(CONSUMER_COLUMNS["segments"]).set_index("order_id")
+
+    placed = orders[orders.index.notna()]
+    rows = wide.groupby("order_id").size()
+    complete = wide.dropna().groupby("order_id").size().reindex(rows.index, fill_value=0)
+    assert rows.to_dict() == {"o1": 12, "o2": 1, "o3": 4}
+    assert complete.to_dict() == {"o1": 6, "o2": 1, "o3": 2}
+    assert placed["row_weight"].to_dict() == rows.to_dict()
+    assert placed["complete_weight"].to_dict() == complete.to_dict()
+
+    # Клиент без заказов — одна строка широкого фрейма, не пережившая dropna()
+    idle = orders[orders["customer_unique_id"] == "c4"]
+    assert wide["order_id"].isna().sum() == len(idle) == 1
+    assert idle[["row_weight", "complete_weight"]].values.tolist() == [[1, 0]]
@@ -0,0 +1,115 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from segmentation_tasks.constants import SEGMENT_CHURN_LABELS
+from segmentation_tasks.rfm_core import aggregate_rows, score_customers
+
+
+def legacy_process_data(df):
+    """
+    process_data из segmentation_pipeline до векторизации, без изменений логики;
+    возвращает промежуточную таблицу rfm вместо итоговых трёх колонок.
+    """
+    df['order_purchase_timestamp'] = pd.to_datetime(
+        df['order_purchase_timestamp'])
+    df['customer_unique_id'] = df['customer_unique_id'].astype(str)
+
+    df = df.dropna()
+
+    current_date = df['order_purchase_timestamp'].max() + pd.Timedelta(days=1)
+    rfm = df.groupby('customer_unique_id').agg({
+        'order_purchase_timestamp': lambda x: (current_date - x.max()).days,
+        'order_id': 'count',
+        'payment_value': 'sum'
+    }).rename(columns={
+        'order_purchase_timestamp': 'recency',
+        'order_id': 'frequency',
+        'payment_value': 'monetary'
+    }).reset_index()
+
+    rfm['r_quartile'] = pd.qcut(
+        rfm['recency'], 4, labels=False, duplicates='drop')
+    rfm['f_quartile'] = pd.qcut(
+        rfm['frequency'], 4, labels=False, duplicates='drop')
+    rfm['m_quartile'] = pd.qcut(
+        rfm['monetary'], 4, labels=False, duplicates='drop')
+    rfm['rfm_score'] = rfm[['r_quartile',
+                            'f_quartile', 'm_quartile']].sum(axis=1)
+
+    weights = {'R': 0.5, 'F': 0.3, 'M': 0.2}
+    rfm['RFM_Weighted'] = (rfm['r_quartile'] * weights['R'] +
+                           rfm['f_quartile'] * weights['F'] +
+                           rfm['m_quartile'] * weights['M'])
+
+    rfm['Churn_Risk'] = pd.qcut(rfm['RFM_Weighted'], q=[0, 0.25, 0.75, 1], labels=[
+                                'High_risk', 'Avg_risg', 'Low_risk'])
+
+    rfm = rfm.sort_values('monetary', ascending=False)
+    rfm['cumulative_value'] = rfm['monetary'].cumsum()
+    total_value = rfm['monetary'].sum()
+    rfm['cumulative_percent'] = rfm['cumulative_value'] / total_value * 100
+
+    def assign_abc_category(row):
+        if row['cumulative_percent'] <= 80:
+            return 'A'
+        elif row['cumulative_percent'] <= 95:
+            return 'B'
+        else:
+            return 'C'
+
+    rfm['abc_class'] = rfm.apply(assign_abc_category, axis=1)
+    return rfm
+
+
+@pytest.fixture
+def orders():
+    """Фиксированный набор строк: 60 клиентов, от 1 до 6 строк, пропуски платежей."""
+    rng = np.random.default_rng(20240501)
+    counts = rng.integers(1, 7, 60)
+    ids = np.repeat([f"c{i:02d}" for i in range(60)], counts)
+    payments = rng.gamma(2.0, 60.0, len(ids)).round(2)
+    payments[::17] = np.nan
+    return pd.DataFrame({
+        'customer_unique_id': ids,
+        'order_id': [f"o{i:03d}" for i in range(len(ids))],
+        'order_purchase_timestamp': (pd.Timestamp('2017-01-01')
+                                     + pd.to_timedelta(rng.integers(0, 600, len(ids)), unit='D')),
+        'payment_value': payments,
+    })
+
+
+PARITY_COLUMNS = ['recency', 'frequency', 'monetary', 'r_quartile', 'f_quartile', 'm_quartile',
+                  'rfm_score', 'RFM_Weighted', 'Churn_Risk', 'abc_class']
+
+
+def test_vectorized_core_matches_legacy_process_data(orders):
+    legacy = legacy_process_data(orders.copy()).set_index('customer_unique_id').sort_index()
+    new = score_customers(aggregate_rows(orders.copy()), churn_labels=SEGMENT_CHURN_LABELS)
+    new = new.set_index('customer_unique_id').sort_index()
+
+    assert new.index.equals(legacy.index)
+    for column in PARITY_COLUMNS:
+        assert new[column].astype(str).tolist() == legacy[column].astype(str).tolist(), column
+
+
+def test_std_dev_and_xyz_per_customer():
+    # Прежний код присваивал std через transform по индексу широкого фрейма
+    # (std чужих клиентов); теперь std_dev — выборочное отклонение платежей клиента
+    df = pd.DataFrame({
+        'customer_unique_id': ['same', 'same', 'near', 'near', 'mid', 'mid', 'wide', 'wide', 'single'],
+        'order_id': list('abcdefghi'),
+        'order_purchase_timestamp': pd.Timestamp('2018-01-01') + pd.to_timedelta(range(9), unit='D'),
+        'payment_value': [10.0, 10.0, 10.0, 10.01, 10.0, 20.0, 0.0, 100.0, 5.0],
+    })
+    rfm = score_customers(aggregate_rows(df)).set_index('customer_unique_id')
+
+    expected_std = {'same': 0.0, 'near': 0.01 / np.sqrt(2), 'mid': 10 / np.sqrt(2),
+                    'wide': 100 / np.sqrt(2)}
+    for customer, value in expected_std.items():
+        assert rfm.loc[customer, 'std_dev'] == pytest.approx(value, rel=1e-9)
+    assert np.isnan(rfm.loc['single', 'std_dev'])
+
+    assert rfm['x_category'].astype(str).to_dict() == {
+        'same': 'X', 'near': 'X', 'mid': 'Y', 'wide': 'Z', 'single': 'Single Purchase'}
+    assert (rfm['segment'] == rfm['abc_class'] + '_' + rfm['x_category'].astype(str)).all()
@@ -0,0 +1,114 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from redis_cache import rollup_query
+from segmentation_tasks.constants import ROLLUP_DIMENSIONS, ROLLUP_LEVELS, ROLLUP_MEASURES
+from segmentation_tasks.time_pipeline import build_rollup_frames, rollup_json
+
+SEGMENTS = ["Лояльные", "Новые", "Спящие"]
+CHURN = ["Низкий риск", "Средний риск", "Высокий риск"]
+STATES = ["SP", "RJ", "MG", None]
+
+
+# Недели 2016-12-26 и 2017-01-30 переходят через границу года и месяца
+START = pd.Timestamp("2016-12-20")
+CROSSING_WEEKS = [pd.Timestamp("2016-12-26"), pd.Timestamp("2017-01-30")]
+
+
+@pytest.fixture(scope="module")
+def frames():
+    rng = np.random.default_rng(20240502)
+    customers = [f"c{i}" for i in range(40)]
+    n = 3000
+    orders = pd.DataFrame({
+        "customer_unique_id": rng.choice(customers + ["unscored"], n),
+        "customer_state": rng.choice(np.array(STATES, dtype=object), n),
+        "order_purchase_timestamp": START + pd.to_timedelta(rng.integers(0, 120 * 24 * 60, n), unit="min"),
+        "row_weight": rng.integers(1, 4, n),
+        "payment_sum": rng.integers(100, 100000, n) / 100,
+    })
+    scores = pd.DataFrame({
+        "customer_unique_id": customers,
+        "segment_description": rng.choice(SEGMENTS, len(customers)),
+        "Churn_Risk": pd.Categorical(rng.choice(CHURN, len(customers)), categories=CHURN, ordered=True),
+    })
+    cubes, dictionaries = build_rollup_frames(orders, scores)
+    return orders, scores, cubes, dictionaries
+
+
+@pytest.fixture(scope="module")
+def rollup(frames):
+    _, _, cubes, dictionaries = frames
+    return {level: rollup_json(cubes[level], level, dictionaries) for level in ROLLUP_LEVELS}
+
+
+def direct_cube(orders, scores, level):
+    """Уровень куба одним groupby по заказам, без более мелких уровней."""
+    timestamps = orders["order_purchase_timestamp"]
+    if level == "day":
+        period = timestamps.dt.floor("D")
+    else:
+        # Неделя — с понедельника по воскресенье
+        period = timestamps.dt.to_period({"week": "W-SUN", "month": "M", "quarter": "Q"}[level]).dt.start_time
+    labels = scores.set_index("customer_unique_id")
+    frame = pd.DataFrame({
+        "period": period,
+        "segment_description": orders["customer_unique_id"].map(labels["segment_description"]),
+        "Churn_Risk": orders["customer_unique_id"].map(labels["Churn_Risk"].astype(object)),
+        "customer_state": orders["customer_state"],
+        "count": orders["row_weight"],
+        "orders": 1,
+        "monetary": orders["payment_sum"],
+    })
+    return frame.groupby(["period"] + ROLLUP_DIMENSIONS, dropna=False)[ROLLUP_MEASURES].sum()
+
+
+def decoded(cube, dictionaries):
+    values = {column: np.array(dictionaries[column], dtype=object)[cube[column].to_numpy()]
+              for column in ROLLUP_DIMENSIONS}
+    return cube.assign(**values).set_index(["period"] + ROLLUP_DIMENSIONS)[ROLLUP_MEASURES]
+
+
+@pytest.mark.parametrize("level", ROLLUP_LEVELS)
+def test_levels_match_direct_groupby(frames, level):
+    orders, scores, cubes, dictionaries = frames
+    cube = decoded(cubes[level], dictionaries)
+    expected = direct_cube(orders, scores, level)
+
+    assert len(cube) == len(expected)
+    expected = expected.loc[cube.index]
+    pd.testing.assert_frame_equal(cube[["count", "orders"]], expected[["count", "orders"]],
+                                  check_dtype=False, check_index_type=False)
+    np.testing.assert_allclose(cube["monetary"], expected["monetary"], rtol=1e-12)
+
+
+def test_crossing_weeks_collect_both_sides(frames):
+    orders, _, cubes, _ = frames
+    week = cubes["week"].groupby("period")["orders"].sum()
+    for start in CROSSING_WEEKS:
+        days = orders["order_purchase_timestamp"][
+            orders["order_purchase_timestamp"].between(start, start + pd.Timedelta(days=7), inclusive="left")]
+        # В неделе есть заказы по обе стороны границы
+        assert days.dt.month.nunique() == 2
+        assert week[start] == len(days)
+
+
+QUERIES = [
+    ([], {}, None, None),
+    (["segment_description"], {}, "2017-02", "2017-03"),
+    (["Churn_Risk"], {"customer_state": "SP"}, None, "2017-03-15"),
+    (["customer_state", "segment_description"], {}, "2017-02-01", None),
+    ([], {"segment_description": "Новые", "Churn_Risk": "Высокий риск"}, None, None),
+    (["segment_description", "Churn_Risk", "customer_state"], {}, None, None),
+]
+
+
+@pytest.mark.parametrize("level", ROLLUP_LEVELS)
+@pytest.mark.parametrize("dimensions, filters, period_from, period_to", QUERIES)
+def test_aggregates_match_full_cube(rollup, level, dimensions, filters, period_from, period_to):
+    cube = rollup[level]
+    assert cube["aggregates"]
+    full = {key: value for key, value in cube.items() if key != "aggregates"}
+    assert (rollup_query(cube, dimensions, filters, period_from, period_to)
+            == rollup_query(full, dimensions, filters, period_from, period_to))
@@ -0,0 +1,129 @@
+import io
+import json
+
+try:
+    import msgpack
+except ImportError:  # без msgpack отдаются только JSON и Arrow
+    msgpack = None
+
+# Бинарные форматы выдачи: Arrow IPC (поток) и MessagePack.
+# Кодируются один раз при записи версии в Redis (см. redis_cache).
+#
+# Arrow: строковые колонки с малым числом значений (segment, Churn_Risk, ...)
+# пишутся словарями — значение хранится один раз, в строках только коды.
+# Когорты и таймлайн в Arrow отдаются одной длинной таблицей,
+# поля, не являющиеся таблицами (updated_at, state_list), — в метаданных схемы.
+# MessagePack повторяет структуру JSON-ответа.
+# pandas и pyarrow импортируются при первом кодировании: процессу API, который
+# отдаёт уже закодированные куски, они не нужны.
+
+ARROW_MIMETYPE = "application/vnd.apache.arrow.stream"
+MSGPACK_MIMETYPES = ["application/msgpack", "application/x-msgpack"]
+BINARY_FORMATS = ["arrow", "msgpack"] if msgpack else ["arrow"]
+
+
+class ArrowStreamPieces:
+    """
+    Arrow IPC поток по кускам: head, затем по куску на батч, затем tail.
+    Склейка кусков по порядку — корректный поток; словари пишутся
+    с первым батчем и не повторяются, пока категории кусков совпадают.
+    """
+
+    def __init__(self, schema, metadata=None):
+        if metadata:
+            schema = schema.with_metadata(metadata)
+        self.schema = schema
+        import pyarrow as pa
+
+        self._sink = io.BytesIO()
+        self._writer = pa.ipc.new_stream(self._sink, schema)
+
+    def _take(self):
+        data = self._sink.getvalue()
+        self._sink.seek(0)
+        self._sink.truncate()
+        return data
+
+    def head(self):
+        return self._take()
+
+    def piece(self, frame):
+        import pyarrow as pa
+
+        self._writer.write_table(pa.Table.from_pandas(frame, schema=self.schema, preserve_index=False))
+        return self._take()
+
+    def tail(self):
+        self._writer.close()
+        return self._take()
+
+
+def arrow_frame(frame, metadata=None) -> bytes:
+    """Весь DataFrame одним Arrow IPC потоком."""
+    import pyarrow as pa
+
+    stream = ArrowStreamPieces(pa.Schema.from_pandas(frame, preserve_index=False), metadata)
+    return stream.head() + stream.piece(frame) + stream.tail()
+
+
+def msgpack_array_header(length) -> bytes:
+    return msgpack.Packer().pack_array_header(length)
+
+
+def msgpack_records(frame) -> bytes:
+    """Записи DataFrame как последовательность msgpack map (NaN -> nil, как null в JSON)."""
+    packer = msgpack.Packer()
+    records = frame.astype(object).where(frame.notna(), None).to_dict(orient="records")
+    return b"".join(packer.pack(record) for record in records)
+
+
+def msgpack_payload(payload) -> bytes:
+    return msgpack.packb(payload)
+
+
+def _sparse_frame(table):
+    import pandas as pd
+
+    return pd.DataFrame(table.get("data", []), columns=table.get("columns"))
+
+
+def cohort_arrow(cohort_json) -> bytes:
+    """
+    Когорты одной длинной таблицей:
+    customer_state (пусто — все штаты), cohort_month, cohort_index, customers, retention.
+    """
+    import pandas as pd
+
+    overall = _sparse_frame(cohort_json["cohort_data"]).merge(
+        _sparse_frame(cohort_json["retention"]), on=["cohort_month", "cohort_index"], how="left")
+    overall.insert(0, "customer_state", None)
+    regional = _sparse_frame(cohort_json["regional_cohort"])
+
+    columns = ["customer_state", "cohort_month", "cohort_index", "customers", "retention"]
+    frame = pd.concat([overall[columns], regional.reindex(columns=columns)], ignore_index=True)
+    frame = frame.astype({"customer_state": "category", "cohort_month": "string",
+                          "cohort_index": "int32", "customers": "int64", "retention": "float64"})
+    return arrow_frame(frame, {
+        "updated_at": str(cohort_json["updated_at"]),
+        "state_list": json.dumps(cohort_json["state_list"], ensure_ascii=False),
+    })
+
+
+def timeline_arrow(by_segment, by_churn, updated_at) -> bytes:
+    """
+    Таймлайн одной длинной таблицей:
+    series (segment | churn), order_purchase_timestamp, value (описание сегмента или риск), count.
+    """
+    import pandas as pd
+
+    parts = []
+    for series, records, column in [("segment", by_segment, "segment_description"),
+                                    ("churn", by_churn, "Churn_Risk")]:
+        frame = pd.DataFrame(records, columns=["order_purchase_timestamp", column, "count"])
+        frame = frame.rename(columns={column: "value"})
+        frame.insert(0, "series", series)
+        parts.append(frame)
+
+    frame = pd.concat(parts, ignore_index=True).astype({
+        "series": "category", "order_purchase_timestamp": "string", "value": "category", "count": "int64"})
+    return arrow_frame(frame, {"updated_at": updated_at})